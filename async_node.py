@@ -0,0 +1,525 @@
+""" asyncio variant of node.py for nodes serving many peers and clients
+
+Same routes and responses as node.py, served by aiohttp. Handlers never block
+the event loop: Blockchain calls (which take its lock, verify RSA signatures
+and download from peers in resolve) run on a thread pool executor, the proof of
+work runs on the Miner process pool, and peer traffic goes through one pooled
+AsyncPeerClient.
+
+Run it like node.py:
+    python async_node.py -p 5000
+"""
+
+import asyncio
+import functools
+import itertools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+from wallet import Wallet
+from blockchain import Blockchain, ADDRESS_PAGE_SIZE
+from utility.async_peer_client import AsyncPeerClient
+from utility.hash_util import hash_block
+from utility import codec
+from utility.payload import decode_payload, stream_json_blocks
+from utility import metrics
+
+# Number of threads running Blockchain calls for the handlers
+EXECUTOR_WORKERS = 32
+# Encoded chunks of GET /chain read on the executor per call
+CHAIN_STREAM_BATCH = 64
+
+routes = web.RouteTableDef()
+executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS, thread_name_prefix='node')
+
+
+async def run_blocking(function, *args, **kwargs):
+    """Run a blocking call on the executor and wait for it without blocking the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(function, *args, **kwargs))
+
+def json_response(response, status):
+    return web.json_response(response, status=status)
+
+async def get_json(request):
+    """Return the JSON body of a request, None if there is none"""
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+@web.middleware
+async def cors(request, handler):
+    # Same as flask_cors in node.py: every origin may call the API
+    if request.method == 'OPTIONS':
+        response = web.Response()
+        response.headers['Access-Control-Allow-Methods'] = 'GET, POST, DELETE, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = request.headers.get('Access-Control-Request-Headers', '*')
+    else:
+        response = await handler(request)
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+@routes.get('/')
+async def get_node_ui(request):
+    return web.FileResponse(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ui', 'node.html'))
+
+@routes.get('/network')
+async def get_network_ui(request):
+    return web.FileResponse(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ui', 'network.html'))
+
+@routes.post('/wallet')
+async def create_keys(request):
+    await run_blocking(wallet.create_keys)
+    if await run_blocking(wallet.save_keys):
+        # The same Blockchain (files, threads) keeps serving, only the key blocks are mined for changes
+        await run_blocking(blockchain.set_public_key, wallet.public_key)
+        response = {
+            'public_key': wallet.public_key,
+            'private_key': wallet.private_key,
+            'funds': await run_blocking(blockchain.get_balance)
+        }
+        return json_response(response, 201)
+    else:
+        response = {
+            'message': 'Saving the keys failed'
+        }
+        return json_response(response, 500)
+
+@routes.get('/wallet')
+async def load_keys(request):
+    if await run_blocking(wallet.load_keys):
+        # The same Blockchain (files, threads) keeps serving, only the key blocks are mined for changes
+        await run_blocking(blockchain.set_public_key, wallet.public_key)
+        response = {
+            'public_key': wallet.public_key,
+            'private_key': wallet.private_key,
+            'funds': await run_blocking(blockchain.get_balance)
+        }
+        return json_response(response, 201)
+    else:
+        response = {
+            'message': 'Loading the keys failed'
+        }
+        return json_response(response, 500)
+
+@routes.get('/balance')
+async def get_balance(request):
+    balance = await run_blocking(blockchain.get_balance)
+    if balance is not None:
+        response = {
+            'message': 'Fetched balance successfully',
+            'funds': balance
+        }
+        return json_response(response, 200)
+    else:
+        response = {
+            'message': 'Loading balance failed.',
+            'wallet_set_up': wallet.public_key is not None,
+        }
+        return json_response(response, 500)
+
+@routes.post('/transaction')
+async def add_transaction(request):
+    if wallet.public_key is None:
+        response = {
+            'message': 'No wallet set up'
+        }
+        return json_response(response, 400)
+    values = await get_json(request)
+    if not values:
+        response = {
+            'message': 'No data found',
+        }
+        return json_response(response, 400)
+    required_fields = ['recipient', 'amount']
+    if not all(field in values for field in required_fields):
+        response = {
+            'message': 'Required data is missing'
+        }
+        return json_response(response, 400)
+    recipient = values['recipient']
+    amount = values['amount']
+    # Signing and verifying are RSA operations, both stay off the event loop
+    signature = await run_blocking(wallet.sign_transaction, wallet.public_key, recipient, amount)
+    success = await run_blocking(blockchain.add_transaction, recipient, wallet.public_key, signature, amount)
+    if success:
+        response = {
+            'message': 'Successfully added transaction',
+            'transaction': {
+                'sender': wallet.public_key,
+                'recipient': recipient,
+                'amount': amount,
+                'signature': signature
+            },
+            'funds': await run_blocking(blockchain.get_balance)
+        }
+        return json_response(response, 201)
+    else:
+        response = {
+            'message': 'Creating a transaction failed.',
+        }
+        return json_response(response, 500)
+
+@routes.post('/mine')
+async def mine(request):
+    # Mining runs in the background, poll GET /mine/<job_id> for the result
+    if wallet.public_key is None:
+        response = {
+            'message': 'No wallet set up',
+            'wallet_set_up': False
+        }
+        return json_response(response, 400)
+
+    if blockchain.resolve_conflicts:
+        response = {
+            'message': 'Resolving conflicts first, block not added',
+        }
+        return json_response(response, 409)
+
+    # {"continuous": true} keeps mining block after block until the job is cancelled
+    values = await get_json(request) or {}
+    job, started = blockchain.mining.start(continuous=bool(values.get('continuous', False)))
+    if not started:
+        response = {
+            'message': 'Already mining',
+            'job': blockchain.mining.get(job.id)
+        }
+        return json_response(response, 409)
+    response = {
+        'message': 'Mining started',
+        'job': blockchain.mining.get(job.id)
+    }
+    return json_response(response, 202)
+
+@routes.get('/mine/{job_id}')
+async def get_mining_job(request):
+    job = blockchain.mining.get(request.match_info['job_id'])
+    if job is None:
+        response = {
+            'message': 'Mining job not found'
+        }
+        return json_response(response, 404)
+    response = {
+        'job': job,
+        'funds': await run_blocking(blockchain.get_balance)
+    }
+    return json_response(response, 200)
+
+@routes.delete('/mine/{job_id}')
+async def cancel_mining_job(request):
+    job = blockchain.mining.cancel(request.match_info['job_id'])
+    if job is None:
+        response = {
+            'message': 'Mining job not found'
+        }
+        return json_response(response, 404)
+    response = {
+        'message': 'Mining job cancelled',
+        'job': job
+    }
+    return json_response(response, 200)
+
+@routes.post('/resolve-conflicts')
+async def resolve_conflicts(request):
+    replaced = await run_blocking(blockchain.resolve)
+    if replaced:
+        response = {
+            'message': 'Chain was replaced',
+        }
+    else:
+        response = {
+            'message': 'Local chain kept',
+        }
+    return json_response(response, 200)
+
+@routes.post('/broadcast-transaction')
+async def broadcast_transaction(request):
+    values = decode_payload(request.content_type, await request.read(), lambda data: codec.decode_transactions(data)[0].to_dict())
+    if not values:
+        response = {
+            'message': 'No data found',
+        }
+        return json_response(response, 400)
+    required = ['sender', 'recipient', 'amount', 'signature']
+    if not all(key in values for key in required):
+        response = { 'message': 'Required data is missing' }
+        return json_response(response, 400)
+    success = await run_blocking(
+        blockchain.add_transaction,
+        recipient=values['recipient'],
+        sender=values['sender'],
+        signature=values['signature'],
+        amount=values['amount'],
+        is_receiving=True
+    )
+    if success:
+        response = {
+            'message': 'Successfully added transaction',
+            'transaction': {
+                'sender': values['sender'],
+                'recipient': values['recipient'],
+                'amount': values['amount'],
+                'signature': values['signature']
+            },
+        }
+        return json_response(response, 201)
+    else:
+        response = {
+            'message': 'Creating a transaction failed.',
+        }
+        return json_response(response, 500)
+
+@routes.post('/broadcast-transactions')
+async def broadcast_transactions(request):
+    values = decode_payload(request.content_type, await request.read(), lambda data: {'transactions': [tx.to_dict() for tx in codec.decode_transactions(data)]})
+    if not values or 'transactions' not in values:
+        response = {
+            'message': 'No data found',
+        }
+        return json_response(response, 400)
+    required = ['sender', 'recipient', 'amount', 'signature']
+    if not all(key in tx for tx in values['transactions'] for key in required):
+        response = { 'message': 'Required data is missing' }
+        return json_response(response, 400)
+    accepted = await run_blocking(blockchain.add_transactions, values['transactions'])
+    response = {
+        'accepted': accepted.count(True),
+        'rejected': accepted.count(False),
+    }
+    if all(accepted):
+        response['message'] = 'Successfully added transactions'
+        return json_response(response, 201)
+    else:
+        response['message'] = 'Some transactions failed.'
+        return json_response(response, 500)
+
+@routes.post('/broadcast-block')
+async def broadcast_block(request):
+    values = decode_payload(request.content_type, await request.read(), lambda data: {'block': codec.decode_blocks(data)[0].to_dict()})
+
+    if not values:
+        response = {
+            'message': 'No data found',
+        }
+        return json_response(response, 400)
+
+    if 'block' not in values:
+        response = {
+            'message': 'Some data is missing',
+        }
+        return json_response(response, 400)
+
+    block = values['block']
+    last_block = await run_blocking(blockchain.get_last_blockchain_value)
+
+    if block['index'] == last_block.index + 1:
+        # Checks the proof and every signature of the block
+        if await run_blocking(blockchain.add_block, block):
+            response = {'message': 'Block added successfully'}
+            return json_response(response, 201)
+        else:
+            response = {'message': 'Block seems invalid'}
+            return json_response(response, 409)
+
+    elif block['index'] > last_block.index:
+        response = {
+            'message': 'Blockchain seems to differ from local blockchain',
+        }
+        blockchain.resolve_conflicts = True
+        return json_response(response, 200)
+
+    else:
+        response = {
+            'message': 'Blockchain seems to be shorter, block not added',
+        }
+        return json_response(response, 409)
+
+@routes.get('/transactions')
+async def get_open_transactions(request):
+    transactions = await run_blocking(blockchain.get_open_transactions)
+    dict_transactions = [tx.to_dict() for tx in transactions]
+    return json_response(dict_transactions, 200)
+
+@routes.get('/chain')
+async def get_chain(request):
+    # Peers syncing a delta only ask for the blocks starting at from_height
+    try:
+        from_height = int(request.query.get('from_height', 0))
+        limit = int(request.query['limit']) if 'limit' in request.query else None
+    except ValueError:
+        from_height, limit = 0, None
+    blocks = blockchain.iter_blocks(from_height, limit)
+
+    # Peers may ask for the compact binary encoding, the UI gets JSON
+    # Both are streamed block by block (chunked transfer encoding) instead of being built in memory
+    binary = codec.CONTENT_TYPE in request.headers.get('Accept', '')
+    response = web.StreamResponse(status=200)
+    response.content_type = codec.CONTENT_TYPE if binary else 'application/json'
+    await response.prepare(request)
+    chunks = codec.iter_encode_blocks(blocks) if binary else stream_json_blocks(blocks)
+    # Reading a block takes the chain lock and may hit the disk, so batches are pulled on the executor
+    while True:
+        batch = await run_blocking(lambda: list(itertools.islice(chunks, CHAIN_STREAM_BATCH)))
+        if not batch:
+            break
+        await response.write(b''.join(chunk if isinstance(chunk, bytes) else chunk.encode() for chunk in batch))
+    await response.write_eof()
+    return response
+
+@routes.get('/chain/tip')
+async def get_chain_tip(request):
+    last_block = await run_blocking(blockchain.get_last_blockchain_value)
+    response = {
+        'height': last_block.index,
+        'length': last_block.index + 1,
+        'hash': hash_block(last_block)
+    }
+    return json_response(response, 200)
+
+@routes.get('/block/height/{height:\\d+}')
+async def get_block_by_height(request):
+    block = await run_blocking(blockchain.get_block, int(request.match_info['height']))
+    if block is None:
+        response = {
+            'message': 'Block not found'
+        }
+        return json_response(response, 404)
+    return json_response(block.to_dict(), 200)
+
+@routes.get('/block/{block_hash}')
+async def get_block_by_hash(request):
+    block = await run_blocking(blockchain.get_block_by_hash, request.match_info['block_hash'])
+    if block is None:
+        response = {
+            'message': 'Block not found'
+        }
+        return json_response(response, 404)
+    return json_response(block.to_dict(), 200)
+
+@routes.get('/tx/{transaction_id}')
+async def get_transaction(request):
+    transaction_id = request.match_info['transaction_id']
+    result = await run_blocking(blockchain.get_transaction, transaction_id)
+    if result is None:
+        response = {
+            'message': 'Transaction not found'
+        }
+        return json_response(response, 404)
+    transaction, height, position = result
+    response = {
+        'transaction': transaction.to_dict(),
+        'transaction_id': transaction_id,
+        # None while the transaction is still open
+        'block_height': height,
+        'position': position,
+        'confirmed': height is not None
+    }
+    return json_response(response, 200)
+
+@routes.get('/address/{address}/transactions')
+async def get_address_transactions(request):
+    # Pass next_cursor of a response as cursor to get the next (older) page
+    cursor = request.query.get('cursor', None)
+    try:
+        limit = int(request.query.get('limit', ADDRESS_PAGE_SIZE))
+    except ValueError:
+        limit = ADDRESS_PAGE_SIZE
+    try:
+        entries, next_cursor = await run_blocking(blockchain.get_address_history, request.match_info['address'], cursor, limit)
+    except ValueError:
+        response = {
+            'message': 'Invalid cursor'
+        }
+        return json_response(response, 400)
+    response = {
+        'transactions': entries,
+        'next_cursor': next_cursor
+    }
+    return json_response(response, 200)
+
+@routes.get('/gossip')
+async def get_gossip_stats(request):
+    return json_response(blockchain.gossip.stats(), 200)
+
+@routes.get('/metrics')
+async def get_metrics(request):
+    # Prometheus text format, see utility/metrics.py
+    return web.Response(body=metrics.REGISTRY.render().encode(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+@routes.post('/node')
+async def add_node(request):
+    values = await get_json(request)
+    if not values:
+        response = {
+            'message': 'No data found',
+        }
+        return json_response(response, 400)
+    if 'node' not in values:
+        response = {
+            'message': 'No node data found',
+        }
+        return json_response(response, 400)
+    node = values['node']
+    await run_blocking(blockchain.add_peer_node, node)
+    response = {
+        'message': 'New node added successfully',
+        'all_nodes': await run_blocking(blockchain.get_peer_nodes)
+    }
+    return json_response(response, 201)
+
+@routes.delete('/node/{node_url}')
+async def remove_node(request):
+    node_url = request.match_info['node_url']
+    if node_url == '' or node_url is None:
+        response = {
+            'message': 'No node found',
+        }
+        return json_response(response, 400)
+    await run_blocking(blockchain.remove_peer_node, node_url)
+    response = {
+        'message': 'Node removed successfully',
+        'all_nodes': await run_blocking(blockchain.get_peer_nodes)
+    }
+    return json_response(response, 200)
+
+@routes.get('/nodes')
+async def get_nodes(request):
+    nodes = await run_blocking(blockchain.get_peer_nodes)
+    response = {
+        'all_nodes': nodes
+    }
+    return json_response(response, 200)
+
+async def close_blockchain(app):
+    """Stop the threads of the blockchain and flush its files when the server shuts down"""
+    await run_blocking(blockchain.close)
+    await run_blocking(blockchain.peer_client.close)
+
+def create_app():
+    app = web.Application(middlewares=[cors])
+    app.add_routes(routes)
+    app.on_cleanup.append(close_blockchain)
+    return app
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('-p', '--port', default=5000, type=int)
+    parser.add_argument('-w', '--workers', default=None, type=int, help='Number of mining processes (default: all cores)')
+    parser.add_argument('--peer-format', default='json', choices=['json', 'binary'], help='Encoding of blocks and transactions sent to peers')
+    parser.add_argument('--storage-format', default='json', choices=['json', 'binary'], help='Encoding of chain segments of a new data directory')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    port = args.port
+    blockchain_options = {
+        'mining_workers': args.workers,
+        'peer_format': args.peer_format,
+        'storage_format': args.storage_format,
+        # Peer requests are coroutines on the client's own loop instead of blocked threads
+        'peer_client': AsyncPeerClient(),
+    }
+    wallet = Wallet(port)
+    blockchain = Blockchain(wallet.public_key, port, **blockchain_options)
+    web.run_app(create_app(), host='0.0.0.0', port=port)
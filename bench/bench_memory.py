@@ -0,0 +1,103 @@
+""" Memory benchmark: load a synthetic chain with 100k transactions through Blockchain.load_data
+
+Run from the project root:
+    python -m bench.bench_memory [--blocks 1000] [--transactions-per-block 100]
+"""
+
+import shutil
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from bench.common import working_directory
+from block import Block
+from transaction import Transaction
+from utility.storage import ChainStorage
+
+
+class DictTransaction:
+    """The Transaction layout before __slots__, kept for comparison"""
+    def __init__(self, sender, recipient, signature, amount):
+        self.sender = sender
+        self.recipient = recipient
+        self.amount = amount
+        self.signature = signature
+
+
+class DictBlock:
+    """The Block layout before __slots__, kept for comparison"""
+    def __init__(self, index, previous_hash, transactions, proof, timestamp):
+        self.index = index
+        self.previous_hash = previous_hash
+        self.timestamp = timestamp
+        self.transactions = transactions
+        self.proof = proof
+
+
+def write_synthetic_chain(node_id, block_count, transactions_per_block):
+    """Store a chain with random looking (unverified) transactions, load_data does not check signatures"""
+    storage = ChainStorage(node_id)
+    storage.append_block(Block(0, '', [], 100, 0))
+    for index in range(1, block_count):
+        transactions = [Transaction('{:0256x}'.format(tx_number % 50), '{:0256x}'.format(tx_number % 70 + 1), '{:0256x}'.format(tx_number), 1.5) for tx_number in range(index * transactions_per_block, (index + 1) * transactions_per_block)]
+        storage.append_block(Block(index, '{:064x}'.format(index), transactions, index, float(index)))
+    storage.close()
+    return storage
+
+
+def measure(load):
+    tracemalloc.start()
+    start = time.perf_counter()
+    chain = load()
+    seconds = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return chain, {'seconds': seconds, 'retained_bytes': current, 'peak_bytes': peak}
+
+
+def measure_start(node_id):
+    """ Measure starting a Blockchain on the stored chain, it is closed again afterwards """
+    from blockchain import Blockchain
+    blockchains = []
+    try:
+        _, result = measure(lambda: blockchains.append(Blockchain(None, node_id, mining_workers=1)))
+        return result
+    finally:
+        # Its miner, gossip threads and files would otherwise outlive the measurement
+        for blockchain in blockchains:
+            blockchain.close()
+
+
+def run(block_count, transactions_per_block):
+    directory = tempfile.mkdtemp()
+    try:
+        with working_directory(directory):
+            storage = write_synthetic_chain('bench', block_count, transactions_per_block)
+            records = [block.to_dict() for block in storage.load_chain()]
+            _, legacy = measure(lambda: [DictBlock(block['index'], block['previous_hash'], [DictTransaction(tx['sender'], tx['recipient'], tx['signature'], tx['amount']) for tx in block['transactions']], block['proof'], block['timestamp']) for block in records])
+            _, slotted = measure(lambda: [Block.from_dict(block) for block in records])
+            del records
+            load_data = measure_start('bench')
+            # The first start rebuilt the balances and wrote a snapshot, a restart only reads the headers
+            restart = measure_start('bench')
+        return {
+            'blocks': block_count,
+            'transactions': (block_count - 1) * transactions_per_block,
+            'dict_objects': legacy,
+            'slotted_objects': slotted,
+            'load_data': load_data,
+            'restart': restart,
+        }
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--blocks', default=1001, type=int)
+    parser.add_argument('--transactions-per-block', default=100, type=int)
+    args = parser.parse_args()
+    result = run(args.blocks, args.transactions_per_block)
+    print('{} transactions in {} blocks'.format(result['transactions'], result['blocks']))
+    for name in ['dict_objects', 'slotted_objects', 'load_data', 'restart']:
+        print('{:16} {:8.2f} s {:10.1f} MiB retained {:10.1f} MiB peak'.format(name, result[name]['seconds'], result[name]['retained_bytes'] / 2 ** 20, result[name]['peak_bytes'] / 2 ** 20))
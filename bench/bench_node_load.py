@@ -0,0 +1,130 @@
+""" Load benchmark: the Flask node (node.py) against the asyncio node (async_node.py)
+
+Both servers are started on localhost in empty data directories, get a wallet and
+a few mined blocks, and are then hit by many concurrent clients with a mix of
+reads (/chain/tip, /balance, /transactions, /chain?limit=10) and, optionally,
+/resolve-conflicts against slow peers. A slow peer is a local server that
+answers /chain/tip only after --peer-delay seconds, like a distant node would.
+
+Run from the project root:
+    python -m bench.bench_node_load [--clients 64] [--requests 2000] [--slow-peers 4] [--resolve-share 0.05] [--output load.json]
+"""
+
+import asyncio
+import random
+import time
+from argparse import ArgumentParser
+import aiohttp
+from aiohttp import web
+from bench.common import NodeProcess, free_port, percentile, write_results
+
+SERVERS = ['node.py', 'async_node.py']
+READ_PATHS = ['/chain/tip', '/balance', '/transactions', '/chain?limit=10']
+
+
+async def start_slow_peer(delay):
+    """Serve /chain/tip after delay seconds, return the runner and its node address"""
+    async def tip(request):
+        await asyncio.sleep(delay)
+        return web.json_response({'height': 0, 'length': 1, 'hash': ''})
+    app = web.Application()
+    app.router.add_get('/chain/tip', tip)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    port = free_port()
+    await web.TCPSite(runner, 'localhost', port).start()
+    return runner, 'localhost:{}'.format(port)
+
+
+async def prepare(session, url, blocks, peers):
+    """Give the node a wallet, a few blocks and the slow peers"""
+    async with session.post(url + '/wallet') as response:
+        assert response.status == 201, await response.text()
+    for _ in range(blocks):
+        async with session.post(url + '/mine') as response:
+            job = (await response.json())['job']
+        while job['state'] == 'running':
+            await asyncio.sleep(0.05)
+            async with session.get('{}/mine/{}'.format(url, job['id'])) as response:
+                job = (await response.json())['job']
+    for peer in peers:
+        async with session.post(url + '/node', json={'node': peer}) as response:
+            assert response.status == 201
+
+
+async def client(session, url, count, resolve_share, latencies, errors):
+    for _ in range(count):
+        started = time.perf_counter()
+        try:
+            if random.random() < resolve_share:
+                request = session.post(url + '/resolve-conflicts')
+            else:
+                request = session.get(url + random.choice(READ_PATHS))
+            async with request as response:
+                await response.read()
+                if response.status >= 500:
+                    errors.append(response.status)
+        except aiohttp.ClientError as error:
+            errors.append(str(error))
+        latencies.append(time.perf_counter() - started)
+
+
+async def measure(server, clients, requests, resolve_share, blocks, peers):
+    node = NodeProcess(server)
+    url = node.url
+    try:
+        # The slow peers run on this loop, wait for the node on another thread
+        await asyncio.get_running_loop().run_in_executor(None, node.wait_until_up)
+        timeout = aiohttp.ClientTimeout(total=120)
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=clients), timeout=timeout) as session:
+            await prepare(session, url, blocks, peers)
+            latencies = []
+            errors = []
+            started = time.perf_counter()
+            per_client = max(1, requests // clients)
+            await asyncio.gather(*(client(session, url, per_client, resolve_share, latencies, errors) for _ in range(clients)))
+            seconds = time.perf_counter() - started
+        return {
+            'server': server,
+            'requests': len(latencies),
+            'errors': len(errors),
+            'seconds': seconds,
+            'requests_per_second': len(latencies) / seconds,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+        }
+    finally:
+        node.stop()
+
+
+async def run(clients, requests, slow_peers, peer_delay, resolve_share, blocks):
+    runners = []
+    peers = []
+    for _ in range(slow_peers):
+        runner, node = await start_slow_peer(peer_delay)
+        runners.append(runner)
+        peers.append(node)
+    try:
+        return [await measure(server, clients, requests, resolve_share, blocks, peers) for server in SERVERS]
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--clients', default=64, type=int)
+    parser.add_argument('--requests', default=2000, type=int)
+    parser.add_argument('--slow-peers', default=4, type=int)
+    parser.add_argument('--peer-delay', default=0.5, type=float)
+    parser.add_argument('--resolve-share', default=0.05, type=float, help='Share of requests that are /resolve-conflicts')
+    parser.add_argument('--blocks', default=20, type=int)
+    parser.add_argument('--output', default=None, help='Also write the results as JSON to this file')
+    args = parser.parse_args()
+    results = asyncio.run(run(args.clients, args.requests, args.slow_peers, args.peer_delay, args.resolve_share, args.blocks))
+    for result in results:
+        print('{:14} {:6} requests {:4} errors {:8.1f} req/s  p50 {:8.1f} ms  p99 {:8.1f} ms'.format(
+            result['server'], result['requests'], result['errors'], result['requests_per_second'], result['p50_ms'], result['p99_ms']))
+    if args.output is not None:
+        parameters = {name: value for name, value in vars(args).items() if name != 'output'}
+        write_results('node_load', parameters, {result['server']: result for result in results}, args.output)
@@ -0,0 +1,53 @@
+""" Micro-benchmark of the proof of work check: legacy hexdigest path vs precomputed midstate
+
+Run from the project root:
+    python -m bench.bench_valid_proof [--transactions 100] [--nonces 200000]
+"""
+
+import hashlib as hl
+import time
+from argparse import ArgumentParser
+from transaction import Transaction
+from utility.verification import Verification
+
+
+def legacy_valid_proof(transactions, last_hash, proof):
+    """The valid_proof implementation before the midstate change"""
+    guess = (str([tx.to_ordered_dict() for tx in transactions]) + str(last_hash) + str(proof)).encode()
+    guess_hash = hl.sha256(guess).hexdigest()
+    return guess_hash[0:2] == '00'
+
+
+def run(transaction_count, nonces):
+    transactions = [Transaction('sender-{}'.format(i), 'recipient-{}'.format(i), 'ab' * 64, i + 0.5) for i in range(transaction_count)]
+    last_hash = hl.sha256(b'last block').hexdigest()
+
+    start = time.perf_counter()
+    legacy_hits = [proof for proof in range(nonces) if legacy_valid_proof(transactions, last_hash, proof)]
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    midstate = Verification.proof_hasher(transactions, last_hash)
+    midstate_hits = [proof for proof in range(nonces) if Verification.valid_proof_from(midstate, proof)]
+    midstate_seconds = time.perf_counter() - start
+
+    # Both paths have to accept exactly the same proofs
+    assert legacy_hits == midstate_hits
+    return {
+        'transactions': transaction_count,
+        'nonces': nonces,
+        'legacy_hashes_per_second': nonces / legacy_seconds,
+        'midstate_hashes_per_second': nonces / midstate_seconds,
+        'speedup': legacy_seconds / midstate_seconds,
+    }
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--transactions', default=100, type=int)
+    parser.add_argument('--nonces', default=200000, type=int)
+    args = parser.parse_args()
+    result = run(args.transactions, args.nonces)
+    print('legacy:   {:12.0f} hashes/s'.format(result['legacy_hashes_per_second']))
+    print('midstate: {:12.0f} hashes/s'.format(result['midstate_hashes_per_second']))
+    print('speedup:  {:12.1f}x'.format(result['speedup']))
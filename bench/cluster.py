@@ -0,0 +1,154 @@
+""" Drive a local multi-node cluster with a transaction and mining workload, results as JSON
+
+Starts --nodes node servers on free localhost ports, connects every node to every
+other node, funds each wallet with a mined block and then, for --seconds:
+    - --clients threads per node POST /transaction to random wallets of other nodes
+    - the first --miners nodes run a continuous mining job (POST /mine)
+Afterwards mining is stopped, every node resolves conflicts, and the run records
+transaction throughput and latency, blocks and confirmed transactions, whether
+all nodes agree on the tip, and each node's gossip statistics.
+
+Run from the project root:
+    python -m bench.cluster [--nodes 3] [--server node.py] [--seconds 20] [--clients 2] [--miners 1] [--output cluster.json]
+"""
+
+import random
+import threading
+import time
+from argparse import ArgumentParser
+import requests
+from bench.common import NodeProcess, percentile, write_results
+
+
+class Workload:
+    """Counters and latencies shared by the client threads"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.statuses = {}
+
+    def record(self, status, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+
+def wait_for_job(session, node, job):
+    while job['state'] == 'running':
+        time.sleep(0.05)
+        job = session.get('{}/mine/{}'.format(node.url, job['id'])).json()['job']
+    return job
+
+
+def mine_one(session, node):
+    response = session.post(node.url + '/mine')
+    return wait_for_job(session, node, response.json()['job'])
+
+
+def send_transactions(node, recipients, stop, workload):
+    session = requests.Session()
+    generator = random.Random()
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            # Signatures are deterministic, a random amount keeps the transaction ids distinct
+            amount = generator.randint(1, 10 ** 6) / 10 ** 8
+            status = session.post(node.url + '/transaction', json={'recipient': generator.choice(recipients), 'amount': amount}, timeout=30).status_code
+        except requests.exceptions.RequestException:
+            status = 'error'
+        workload.record(status, time.perf_counter() - started)
+
+
+def run(node_count, server, seconds, clients, miner_count, extra_args):
+    nodes = [NodeProcess(server, extra_args=extra_args) for _ in range(node_count)]
+    session = requests.Session()
+    try:
+        for node in nodes:
+            node.wait_until_up()
+        keys = [session.post(node.url + '/wallet').json()['public_key'] for node in nodes]
+        for node in nodes:
+            for peer in nodes:
+                if peer is not node:
+                    session.post(node.url + '/node', json={'node': peer.address})
+        # Every wallet needs coins before it can send, mine one block per node in turn
+        for node in nodes:
+            mine_one(session, node)
+            time.sleep(0.5)
+            for other in nodes:
+                session.post(other.url + '/resolve-conflicts')
+
+        stop = threading.Event()
+        workload = Workload()
+        threads = []
+        for number, node in enumerate(nodes):
+            recipients = [key for position, key in enumerate(keys) if position != number]
+            threads += [threading.Thread(target=send_transactions, args=(node, recipients, stop, workload)) for _ in range(clients)]
+        jobs = [(node, session.post(node.url + '/mine', json={'continuous': True}).json()['job']) for node in nodes[:miner_count]]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        mining = []
+        for node, job in jobs:
+            session.delete('{}/mine/{}'.format(node.url, job['id']))
+            mining.append(wait_for_job(session, node, job))
+        # Let the gossip queues drain, then settle forks
+        time.sleep(1)
+        for node in nodes:
+            session.post(node.url + '/resolve-conflicts')
+        tips = [session.get(node.url + '/chain/tip').json() for node in nodes]
+        chain = session.get(nodes[0].url + '/chain').json()
+        accepted = workload.statuses.get(201, 0)
+        return {
+            'transactions': {
+                'sent': len(workload.latencies),
+                'accepted': accepted,
+                'accepted_per_second': accepted / elapsed,
+                'statuses': {str(status): count for status, count in workload.statuses.items()},
+                'p50_ms': percentile(workload.latencies, 0.5) * 1000,
+                'p99_ms': percentile(workload.latencies, 0.99) * 1000,
+            },
+            'mining': {
+                'blocks_mined': sum(len(job['blocks']) for job in mining),
+                'aborts': sum(job['aborts'] for job in mining),
+                'hash_rate': sum(job['hash_rate'] for job in mining),
+            },
+            'chain': {
+                'height': tips[0]['height'],
+                'confirmed_transactions': sum(len(block['transactions']) - 1 for block in chain),
+                'converged': len(set(tip['hash'] for tip in tips)) == 1,
+                'heights': [tip['height'] for tip in tips],
+            },
+            'gossip': [session.get(node.url + '/gossip').json() for node in nodes],
+            'seconds': elapsed,
+        }
+    finally:
+        for node in nodes:
+            node.stop()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--nodes', default=3, type=int)
+    parser.add_argument('--server', default='node.py', choices=['node.py', 'async_node.py'])
+    parser.add_argument('--seconds', default=20, type=float)
+    parser.add_argument('--clients', default=2, type=int, help='Transaction sending threads per node')
+    parser.add_argument('--miners', default=1, type=int, help='Number of nodes mining continuously')
+    parser.add_argument('--peer-format', default='json', choices=['json', 'binary'])
+    parser.add_argument('--output', default=None, help='Write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+    parameters = {
+        'nodes': args.nodes,
+        'server': args.server,
+        'seconds': args.seconds,
+        'clients': args.clients,
+        'miners': args.miners,
+        'peer_format': args.peer_format,
+    }
+    results = run(args.nodes, args.server, args.seconds, args.clients, args.miners, ['--peer-format', args.peer_format])
+    write_results('cluster', parameters, results, args.output)
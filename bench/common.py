@@ -0,0 +1,140 @@
+""" Helpers shared by the benchmarks: timing, JSON results and local node processes """
+
+import json
+import os
+import platform
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@contextmanager
+def working_directory(directory):
+    """ Run the block inside directory, Wallet and ChainStorage write to the current directory """
+    previous_directory = os.getcwd()
+    os.chdir(directory)
+    try:
+        yield directory
+    finally:
+        os.chdir(previous_directory)
+
+
+def time_calls(function, repeat, setup=None) -> dict:
+    """ Call function repeat times and summarize the durations
+
+        Arguments:
+            :function: The call to measure, gets no arguments
+            :repeat: How often it is called
+            :setup: Called before every call and not measured (e.g. to drop a cache)
+        :return: dict with calls, total seconds, calls per second and the min/median/max of one call
+    """
+    durations = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    durations.sort()
+    total = sum(durations)
+    return {
+        'calls': repeat,
+        'seconds': total,
+        'calls_per_second': repeat / total if total > 0 else 0,
+        'min_seconds': durations[0],
+        'median_seconds': durations[len(durations) // 2],
+        'max_seconds': durations[-1],
+    }
+
+
+def percentile(values, share):
+    """ Return the value below which share (0 to 1) of the values lie, 0 if there are none """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))] if ordered else 0
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(name, parameters, results, output=None) -> dict:
+    """ Wrap results with the run parameters and environment and write them as JSON
+
+        Arguments:
+            :name: The benchmark name
+            :parameters: The options of the run, runs are only comparable with equal parameters
+            :results: dict of measurement name -> dict of numbers
+            :output: File to write to, stdout if None
+        :return: the written document
+    """
+    document = {
+        'benchmark': name,
+        'created': time.time(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'parameters': parameters,
+        'results': results,
+    }
+    if output is None:
+        json.dump(document, sys.stdout, indent=2)
+        print()
+    else:
+        with open(output, mode='w') as file:
+            json.dump(document, file, indent=2)
+    return document
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('localhost', 0))
+        return probe.getsockname()[1]
+
+
+class NodeProcess:
+    """A node server (node.py or async_node.py) running on localhost in its own data directory
+
+    Attributes:
+        :port: The port it listens on
+        :url: http://localhost:<port>
+        :address: localhost:<port>, the form peers are registered with
+        :directory: Its working directory, removed by stop
+    """
+    def __init__(self, server='node.py', port=None, workers=1, extra_args=()):
+        self.port = port or free_port()
+        self.url = 'http://localhost:{}'.format(self.port)
+        self.address = 'localhost:{}'.format(self.port)
+        self.directory = tempfile.mkdtemp()
+        arguments = [sys.executable, os.path.join(ROOT, server), '-p', str(self.port), '-w', str(workers)] + list(extra_args)
+        self.__log = open(os.path.join(self.directory, 'node.log'), mode='w')
+        self.__process = subprocess.Popen(arguments, cwd=self.directory, stdout=self.__log, stderr=subprocess.STDOUT, start_new_session=True)
+
+    def wait_until_up(self, seconds=30):
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            try:
+                if requests.get(self.url + '/nodes', timeout=1).status_code == 200:
+                    return
+            except requests.exceptions.RequestException:
+                pass
+            time.sleep(0.1)
+        raise RuntimeError('Node on port {} did not start, see {}'.format(self.port, self.directory))
+
+    def stop(self):
+        # The Flask reloader runs the node in a child process, stop the whole group
+        os.killpg(self.__process.pid, signal.SIGTERM)
+        self.__process.wait()
+        self.__log.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,51 @@
+""" Compare two JSON result files of bench.micro or bench.cluster
+
+Prints every numeric result of both runs side by side with their ratio (after / before).
+
+Run from the project root:
+    python -m bench.compare before.json after.json
+"""
+
+import json
+import sys
+from argparse import ArgumentParser
+
+
+def flatten(values, prefix='') -> dict:
+    """ Map dotted paths to the numbers in nested dicts and lists """
+    if isinstance(values, bool):
+        return {prefix: int(values)}
+    if isinstance(values, (int, float)):
+        return {prefix: values}
+    if isinstance(values, dict):
+        items = values.items()
+    elif isinstance(values, list):
+        items = enumerate(values)
+    else:
+        return {}
+    flat = {}
+    for key, value in items:
+        flat.update(flatten(value, '{}.{}'.format(prefix, key) if prefix else str(key)))
+    return flat
+
+
+def compare(before, after) -> list:
+    """ Return (path, before, after, ratio) for every number both runs have """
+    old = flatten(before['results'])
+    new = flatten(after['results'])
+    return [(path, old[path], new[path], new[path] / old[path] if old[path] else None) for path in old if path in new]
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('before')
+    parser.add_argument('after')
+    args = parser.parse_args()
+    with open(args.before) as file:
+        before = json.load(file)
+    with open(args.after) as file:
+        after = json.load(file)
+    if before['benchmark'] != after['benchmark'] or before['parameters'] != after['parameters']:
+        print('Warning: the runs used different benchmarks or parameters', file=sys.stderr)
+    for path, old, new, ratio in compare(before, after):
+        print('{:50} {:16.6g} {:16.6g} {:>8}'.format(path, old, new, '{:.2f}x'.format(ratio) if ratio is not None else '-'))
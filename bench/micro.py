@@ -0,0 +1,121 @@
+""" Micro-benchmarks of the hot paths on a synthetic chain, results as JSON
+
+Measures proof_of_work, hash_block, Verification.verify_chain,
+Wallet.verify_transaction (RSA and signature cache hit), Blockchain.get_balance,
+load_data (first start and restart from a snapshot) and save_data.
+
+Run from the project root:
+    python -m bench.micro [--blocks 200] [--transactions-per-block 50] [--addresses 10] [--output micro.json]
+Compare two runs with:
+    python -m bench.compare before.json after.json
+"""
+
+import random
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from blockchain import Blockchain
+from utility.hash_util import hash_block
+from utility.miner import Miner
+from utility.verification import Verification
+from wallet import Wallet
+from bench.common import time_calls, working_directory, write_results
+from bench.synthetic import load_wallets, build_chain, write_chain
+
+
+def forget_hashes(chain):
+    """ Drop the hashes memoized by hash_block so they are computed again """
+    for block in chain:
+        block._hash = None
+
+
+def bench_proof_of_work(chain, repeat, workers):
+    miner = Miner(workers=workers)
+    blocks = chain[1:repeat + 1]
+    nonces = []
+
+    def search():
+        block = blocks[len(nonces) % len(blocks)]
+        miner.proof_of_work(block.transactions[:-1], block.previous_hash)
+        nonces.append(miner.nonces_tried)
+    result = time_calls(search, len(blocks))
+    result['nonces'] = sum(nonces)
+    result['hash_rate'] = sum(nonces) / result['seconds']
+    return result
+
+
+def bench_hash_block(chain, repeat):
+    blocks = chain[1:]
+    result = time_calls(lambda: [hash_block(block) for block in blocks], repeat, setup=lambda: forget_hashes(blocks))
+    result['blocks_per_second'] = len(blocks) * repeat / result['seconds']
+    return result
+
+
+def bench_verify_chain(chain, repeat):
+    result = time_calls(lambda: Verification.verify_chain(chain), repeat, setup=lambda: forget_hashes(chain))
+    result['blocks_per_second'] = len(chain) * repeat / result['seconds']
+    return result
+
+
+def bench_verify_transaction(chain, repeat, cached):
+    transactions = [tx for block in chain for tx in block.transactions[:-1]][:repeat]
+    if cached:
+        Wallet.verify_transactions(transactions)
+        setup = None
+    else:
+        setup = Wallet.signature_cache.clear
+    position = iter(transactions)
+    return time_calls(lambda: Wallet.verify_transaction(next(position)), len(transactions), setup=setup)
+
+
+def bench_get_balance(blockchain, wallets, repeat):
+    generator = random.Random(0)
+    addresses = [wallet.public_key for wallet in wallets]
+    return time_calls(lambda: blockchain.get_balance(generator.choice(addresses)), repeat)
+
+
+def run(block_count, transactions_per_block, address_count, repeat, workers):
+    wallets = load_wallets(address_count)
+    chain = build_chain(wallets, block_count, transactions_per_block)
+    results = {
+        'proof_of_work': bench_proof_of_work(chain, min(repeat, block_count - 1), workers),
+        'hash_block': bench_hash_block(chain, max(1, repeat // 10)),
+        'verify_chain': bench_verify_chain(chain, max(1, repeat // 10)),
+        'verify_transaction_rsa': bench_verify_transaction(chain, repeat, cached=False),
+        'verify_transaction_cached': bench_verify_transaction(chain, repeat, cached=True),
+    }
+    directory = tempfile.mkdtemp()
+    try:
+        with working_directory(directory):
+            write_chain('bench', chain)
+            del chain
+            blockchains = []
+            # The first start replays every block and writes a snapshot, later starts restore from it
+            results['load_data'] = time_calls(lambda: blockchains.append(Blockchain(None, 'bench', mining_workers=1)), 1)
+            results['load_data_restart'] = time_calls(lambda: blockchains.append(Blockchain(None, 'bench', mining_workers=1)), 1)
+            blockchain = blockchains[-1]
+            results['get_balance'] = bench_get_balance(blockchain, wallets, repeat * 100)
+            results['save_data'] = time_calls(blockchain.save_data, max(1, repeat // 10))
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--blocks', default=200, type=int)
+    parser.add_argument('--transactions-per-block', default=50, type=int)
+    parser.add_argument('--addresses', default=10, type=int)
+    parser.add_argument('--repeat', default=50, type=int, help='Calls per measurement (scaled down for the slow ones)')
+    parser.add_argument('--workers', default=1, type=int, help='Mining processes for the proof_of_work measurement')
+    parser.add_argument('--output', default=None, help='Write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+    parameters = {
+        'blocks': args.blocks,
+        'transactions_per_block': args.transactions_per_block,
+        'addresses': args.addresses,
+        'repeat': args.repeat,
+        'workers': args.workers,
+    }
+    results = run(args.blocks, args.transactions_per_block, args.addresses, args.repeat, args.workers)
+    write_results('micro', parameters, results, args.output)
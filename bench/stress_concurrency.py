@@ -0,0 +1,141 @@
+""" Stress test of Blockchain under concurrent readers, transaction writers and a miner
+
+Every reader takes the read lock around a group of calls and checks that it
+sees one consistent state:
+    - the confirmed coins (balances plus pending spends) equal the mined rewards
+    - no wallet has a negative balance
+    - the last blocks link to each other by hash
+At the end the chain is verified and reloaded from disk, and the balances must match.
+
+Run from the project root:
+    python -m bench.stress_concurrency [--seconds 10] [--wallets 4] [--readers 8]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from blockchain import Blockchain, MINING_REWARD
+from utility.hash_util import hash_block
+from utility.verification import Verification
+from wallet import Wallet
+
+
+class Counters:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.errors = []
+
+    def add(self, name, count=1):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + count
+
+    def error(self, message):
+        with self.lock:
+            self.errors.append(message)
+
+
+def check_state(blockchain, wallets):
+    """ Return a description of the inconsistency found in one read-locked view, None if there is none """
+    with blockchain.lock.read():
+        tip = blockchain.get_last_blockchain_value()
+        balances = [blockchain.get_balance(wallet.public_key) for wallet in wallets]
+        pending = sum(tx.amount for tx in blockchain.get_open_transactions())
+        recent = blockchain.get_blocks(max(0, tip.index - 2))
+    if any(balance < 0 for balance in balances):
+        return 'negative balance {}'.format(balances)
+    if abs(sum(balances) + pending - MINING_REWARD * tip.index) > 1e-6:
+        return 'coins {} + {} pending != {} mined'.format(sum(balances), pending, MINING_REWARD * tip.index)
+    for previous, block in zip(recent, recent[1:]):
+        if block.previous_hash != hash_block(previous):
+            return 'block {} does not link to block {}'.format(block.index, previous.index)
+    return None
+
+
+def reader(blockchain, wallets, stop, counters):
+    while not stop.is_set():
+        problem = check_state(blockchain, wallets)
+        if problem is not None:
+            counters.error(problem)
+        counters.add('reads')
+
+
+def writer(blockchain, wallet, wallets, stop, counters):
+    recipients = [other.public_key for other in wallets if other is not wallet]
+    while not stop.is_set():
+        recipient = random.choice(recipients)
+        amount = random.choice([1, 2, 0.5])
+        signature = wallet.sign_transaction(wallet.public_key, recipient, amount)
+        if blockchain.add_transaction(recipient, wallet.public_key, signature, amount, is_receiving=True):
+            counters.add('transactions_accepted')
+        else:
+            counters.add('transactions_rejected')
+
+
+def miner(blockchain, stop, counters):
+    while not stop.is_set():
+        if blockchain.mine_block() is not None:
+            counters.add('blocks_mined')
+
+
+def run(seconds, wallet_count, reader_count):
+    directory = tempfile.mkdtemp()
+    previous_directory = os.getcwd()
+    os.chdir(directory)
+    try:
+        wallets = []
+        for number in range(wallet_count):
+            wallet = Wallet(number)
+            wallet.create_keys()
+            wallets.append(wallet)
+        blockchain = Blockchain(wallets[0].public_key, 'stress', mining_workers=1)
+        # Fund every wallet with one mining reward
+        for wallet in wallets:
+            blockchain.public_key = wallet.public_key
+            blockchain.mine_block()
+        blockchain.public_key = wallets[0].public_key
+
+        stop = threading.Event()
+        counters = Counters()
+        threads = [threading.Thread(target=miner, args=(blockchain, stop, counters))]
+        threads += [threading.Thread(target=writer, args=(blockchain, wallet, wallets, stop, counters)) for wallet in wallets]
+        threads += [threading.Thread(target=reader, args=(blockchain, wallets, stop, counters)) for _ in range(reader_count)]
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        if not Verification.verify_chain(blockchain.chain):
+            counters.error('chain does not verify')
+        blockchain.save_data()
+        reloaded = Blockchain(wallets[0].public_key, 'stress', mining_workers=1)
+        for wallet in wallets:
+            if blockchain.get_balance(wallet.public_key) != reloaded.get_balance(wallet.public_key):
+                counters.error('balance differs after reload')
+        counters.values['blocks'] = blockchain.get_last_blockchain_value().index + 1
+        return counters
+    finally:
+        os.chdir(previous_directory)
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--seconds', default=10, type=float)
+    parser.add_argument('--wallets', default=4, type=int)
+    parser.add_argument('--readers', default=8, type=int)
+    args = parser.parse_args()
+    result = run(args.seconds, args.wallets, args.readers)
+    for name, value in sorted(result.values.items()):
+        print('{:24} {}'.format(name, value))
+    for message in result.errors[:20]:
+        print('ERROR', message)
+    print('{} inconsistencies'.format(len(result.errors)))
+    sys.exit(1 if result.errors else 0)
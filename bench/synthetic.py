@@ -0,0 +1,88 @@
+""" Synthetic, fully valid chains for the benchmarks
+
+Wallet keys are generated once and kept in a key directory (RSA key generation
+takes a while), so repeated runs use the same addresses. Transactions are real
+signed transfers between those addresses and every block carries a valid proof
+of work, so the chains pass Verification.verify_chain and signature checks.
+
+Signing every transaction would dominate the setup time, so a pool of signed
+transfers is created per run and blocks draw from it. A transfer can therefore
+appear in several blocks; the transaction index keeps the first one.
+"""
+
+import os
+import random
+import tempfile
+from block import Block
+from transaction import Transaction
+from utility.hash_util import hash_block
+from utility.miner import Miner
+from utility.storage import ChainStorage
+from wallet import Wallet
+from bench.common import working_directory
+
+# Where pregenerated wallet keys are kept between runs
+KEY_DIRECTORY = os.environ.get('BENCH_KEY_DIRECTORY', os.path.join(tempfile.gettempdir(), 'blockchain-bench-keys'))
+# Number of distinct signed transfers blocks are built from
+TRANSFER_POOL_SIZE = 1000
+GENESIS_BLOCK = Block(0, '', [], 100, 0)
+
+
+def load_wallets(count, key_directory=KEY_DIRECTORY) -> list:
+    """ Return count wallets with keys, generating and saving the ones not in key_directory yet """
+    os.makedirs(key_directory, exist_ok=True)
+    wallets = []
+    with working_directory(key_directory):
+        for number in range(count):
+            wallet = Wallet('bench-{}'.format(number))
+            if not os.path.exists('wallet-{}.txt'.format(wallet.node_id)):
+                wallet.create_keys()
+                wallet.save_keys()
+            wallet.load_keys()
+            wallets.append(wallet)
+    return wallets
+
+
+def signed_transfers(wallets, count, seed=0) -> list:
+    """ Sign count transfers between random pairs of wallets """
+    generator = random.Random(seed)
+    transfers = []
+    for _ in range(count):
+        sender, recipient = generator.sample(wallets, 2)
+        amount = generator.choice([0.5, 1, 1.5, 2])
+        signature = sender.sign_transaction(sender.public_key, recipient.public_key, amount)
+        transfers.append(Transaction(sender.public_key, recipient.public_key, signature, amount))
+    return transfers
+
+
+def build_chain(wallets, block_count, transactions_per_block, transfer_pool_size=TRANSFER_POOL_SIZE, seed=0) -> list:
+    """ Build a valid chain of block_count blocks (genesis included)
+
+        Arguments:
+            :wallets: The addresses sending, receiving and mining
+            :block_count: Number of blocks including the genesis block
+            :transactions_per_block: Number of transfers per block, the mining reward comes on top
+            :transfer_pool_size: Number of distinct signed transfers blocks draw from
+            :seed: Makes the chain reproducible for the same wallets
+        :return: list of Block
+    """
+    generator = random.Random(seed)
+    transfers = signed_transfers(wallets, min(transfer_pool_size, max(1, transactions_per_block * (block_count - 1))), seed) if transactions_per_block > 0 else []
+    miner = Miner(workers=1)
+    chain = [GENESIS_BLOCK]
+    for index in range(1, block_count):
+        transactions = [generator.choice(transfers) for _ in range(transactions_per_block)]
+        previous_hash = hash_block(chain[-1])
+        proof = miner.proof_of_work(transactions, previous_hash)
+        reward = Transaction('MINING', wallets[index % len(wallets)].public_key, '', 10)
+        chain.append(Block(index, previous_hash, transactions + [reward], proof, float(index)))
+    return chain
+
+
+def write_chain(node_id, chain, record_format='json') -> ChainStorage:
+    """ Store a chain as the data directory of node_id in the current directory """
+    storage = ChainStorage(node_id, record_format=record_format)
+    for block in chain:
+        storage.append_block(block)
+    storage.close()
+    return storage
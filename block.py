@@ -1,11 +1,47 @@
+import json
 from time import time
 from utility.printable import Printable
+from transaction import Transaction
 
 class Block(Printable):
+    # Slots instead of a per-instance __dict__, _hash memoizes the canonical hash (see hash_block)
+    __slots__ = ('index', 'previous_hash', 'timestamp', 'transactions', 'proof', '_hash')
+
     def __init__(self, index, previous_hash, transactions, proof, timestamp=time()):
         self.index = index
         self.previous_hash = previous_hash
         self.timestamp = timestamp
         self.transactions = transactions
         self.proof = proof
+        self._hash = None
+
+    def to_dict(self) -> dict:
+        """Return the block as a plain dict, used for JSON responses and storage"""
+        return {
+            'index': self.index,
+            'previous_hash': self.previous_hash,
+            'timestamp': self.timestamp,
+            'transactions': [tx.to_dict() for tx in self.transactions],
+            'proof': self.proof,
+        }
+
+    @classmethod
+    def from_dict(cls, block: dict) -> 'Block':
+        return cls(
+            block['index'],
+            block['previous_hash'],
+            [Transaction.from_dict(tx) for tx in block['transactions']],
+            block['proof'],
+            block['timestamp']
+        )
 
+    def canonical_bytes(self) -> bytes:
+        """The serialization the block hash is computed from, signatures are not part of it"""
+        hashable_block = {
+            'index': self.index,
+            'previous_hash': self.previous_hash,
+            'timestamp': self.timestamp,
+            'transactions': [tx.to_ordered_dict() for tx in self.transactions],
+            'proof': self.proof,
+        }
+        return json.dumps(hashable_block, sort_keys=True).encode()
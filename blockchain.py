@@ -1,9 +1,21 @@
-import functools
-import json
+import logging
+import time
 from typing import Union, Any, Optional
 # App
-from utility.hash_util import hash_block
 from utility.verification import Verification
+from utility.balance_index import BalanceIndex
+from utility.mempool import Mempool, MAX_MEMPOOL_SIZE, MAX_PENDING_PER_SENDER
+from utility.storage import ChainStorage
+from utility.lazy_chain import LazyChain, BlockStream, BLOCK_CACHE_SIZE
+from utility.snapshot import SnapshotStore
+from utility.address_index import DIRECTIONS
+from utility.miner import Miner
+from utility.mining_service import MiningService
+from utility.peer_client import PeerClient
+from utility.gossip import GossipQueue, TransactionBatcher
+from utility.rwlock import ReadWriteLock, read_locked, write_locked
+from utility import codec
+from utility import metrics
 from block import Block
 from transaction import Transaction
 from wallet import Wallet
@@ -11,108 +23,324 @@ import requests
 
 # Global Constant
 MINING_REWARD = 10
+# Number of blocks requested per page when syncing from a peer
+CHAIN_PAGE_SIZE = 100
+# Maximum number of open transactions mined into one block (without the reward)
+MAX_BLOCK_TRANSACTIONS = 500
+# Default and maximum number of entries per page of an address history
+ADDRESS_PAGE_SIZE = 50
+MAX_ADDRESS_PAGE_SIZE = 500
+# Number of blocks after which a snapshot of the balances and open transactions is written
+SNAPSHOT_EVERY = 100
+# The mempool log is folded into mempool.json once it has more records than this and the mempool
+MEMPOOL_COMPACT_EVERY = 1000
+
+logger = logging.getLogger(__name__)
+
+LOAD_SECONDS = metrics.timer('blockchain_load_data_seconds', 'Time spent in load_data')
+SAVE_SECONDS = metrics.timer('blockchain_save_data_seconds', 'Time spent in save_data')
+RESOLVE_SECONDS = metrics.timer('blockchain_resolve_seconds', 'Time spent in resolve, by whether the chain was replaced', ['result'])
+CHAIN_HEIGHT = metrics.gauge('blockchain_chain_height', 'Height of the last block of the chain')
+MEMPOOL_DEPTH = metrics.gauge('blockchain_mempool_transactions', 'Open transactions waiting to be mined')
 
 
 class Blockchain:
 
-    def __init__(self, public_key, node_id):
-        # Initialize our blockchain
-        genesis_block = Block(0, '', [], 100, 0)
-        # Initializing our (empty) blockchain list
-        self.chain = [genesis_block]
-        # unhandled transactions
-        self.__open_transactions = []
+    def __init__(self, public_key, node_id, mining_workers=None, max_block_transactions=MAX_BLOCK_TRANSACTIONS, max_mempool_size=MAX_MEMPOOL_SIZE, max_pending_per_sender=MAX_PENDING_PER_SENDER, peer_format='json', storage_format='json', block_cache_size=BLOCK_CACHE_SIZE, snapshot_every=SNAPSHOT_EVERY, peer_client=None):
+        # unhandled transactions, keyed by transaction_id
+        self.__mempool = Mempool(max_size=max_mempool_size, max_per_sender=max_pending_per_sender)
+        # Set when storing mempool changes failed, the next save writes the whole mempool
+        self.__mempool_unsaved = False
+        self.max_block_transactions = max_block_transactions
         self.public_key = public_key
         self.__peer_nodes = set()
         self.node_id = node_id
         self.resolve_conflicts = False
+        # Running sent/received totals so get_balance does not scan the whole chain
+        self.__balances = BalanceIndex()
+        # Append-only chain segments plus small mempool and peer files
+        self.__storage = ChainStorage(node_id, record_format=storage_format)
+        self.block_cache_size = block_cache_size
+        # Checkpoints of the balances and open transactions, a restart only replays the blocks after the latest one
+        self.__snapshots = SnapshotStore(self.__storage.directory)
+        self.snapshot_every = snapshot_every
+        # Proof of work search spread over mining_workers processes (default: all cores)
+        self.miner = Miner(mining_workers)
+        # Background mining jobs started through POST /mine
+        self.mining = MiningService(self)
+        # Pooled, concurrent HTTP client for everything we send to peers
+        # async_node.py passes an AsyncPeerClient, close() only closes a client created here
+        self.__owns_peer_client = peer_client is None
+        self.peer_client = peer_client or PeerClient()
+        # 'json' or 'binary' (utility/codec.py) for blocks and transactions we send to peers
+        self.peer_format = peer_format
+        # New transactions and blocks reach peers in the background
+        self.gossip = GossipQueue(self.peer_client, self.__on_gossip_response)
+        # Our own transactions are relayed in batches through /broadcast-transactions
+        self.__tx_batcher = TransactionBatcher(self.__broadcast_transactions)
+        # Guards the chain, mempool, balances and peers: reads run in parallel, changes one at a time
+        # Slow work (signature checks, proof of work, peer requests) is done before the lock is taken
+        self.lock = ReadWriteLock()
         self.load_data()
+        # Read when /metrics is requested, the node serves the Blockchain created last
+        CHAIN_HEIGHT.set_function(lambda: len(self.__chain) - 1)
+        MEMPOOL_DEPTH.set_function(lambda: len(self.__mempool))
 
     # Decorator acts as a get to the property
     @property
+    @read_locked
     def chain(self) -> list[Block]:
         # Return a copy of list not reference
+        # This decodes every block, use iter_blocks or get_last_blockchain_value where possible
         return self.__chain[:]
 
-    @chain.setter
-    def chain(self, value: list[Block]) -> None:
-        self.__chain = value
+    @read_locked
+    def get_blocks(self, from_height=0, limit=None) -> list[Block]:
+        """Return the blocks starting at from_height, at most limit of them, as one list"""
+        end = None if limit is None else from_height + limit
+        return list(self.__chain.iter_blocks(max(from_height, 0), end))
 
+    def iter_blocks(self, from_height=0, limit=None) -> BlockStream:
+        """
+        Return the blocks starting at from_height, at most limit of them, as a stream read one block at a time
+        Blocks are read without the block cache and the lock is only held while reading one block,
+        so streaming the whole chain neither holds it in memory nor blocks writers.
+        The range is fixed when the stream is opened. If the chain is replaced meanwhile,
+        the stream stops before the first replaced block, so the blocks yielded always link up.
+        """
+        from_height = max(from_height, 0)
+        with self.lock.read():
+            end = len(self.__chain) if limit is None else min(len(self.__chain), from_height + limit)
+            hashes = [self.__chain.hash_at(height) for height in range(from_height, end)]
+        return BlockStream(len(hashes), self.__stream_blocks(from_height, hashes))
+
+    def __stream_blocks(self, from_height, hashes):
+        for height, expected_hash in enumerate(hashes, from_height):
+            with self.lock.read():
+                if height >= len(self.__chain) or self.__chain.hash_at(height) != expected_hash:
+                    return
+                block = next(self.__chain.iter_blocks(height, height + 1))
+            yield block
+
+    @read_locked
+    def get_block(self, height) -> Optional[Block]:
+        """Return the block at height, None if there is no such block"""
+        if height < 0 or height >= len(self.__chain):
+            return None
+        return self.__chain[height]
+
+    @read_locked
+    def get_block_by_hash(self, block_hash) -> Optional[Block]:
+        """Return the block with the given hash, None if it is not part of our chain"""
+        height = self.__chain.height_of(block_hash)
+        if height is None:
+            return None
+        return self.__chain[height]
+
+    @read_locked
+    def get_transaction(self, transaction_id) -> Optional[tuple]:
+        """
+        Find a transaction by its id, confirmed or open
+        :param transaction_id: The transaction_id of the transaction
+        :return: (transaction, height, position) with height and position None for open transactions, or None if it is unknown
+        """
+        location = self.__chain.locate_transaction(transaction_id)
+        if location is not None:
+            height, position = location
+            return self.__chain[height].transactions[position], height, position
+        transaction = self.__mempool.get(transaction_id)
+        if transaction is not None:
+            return transaction, None, None
+        return None
+
+    @read_locked
+    def get_address_history(self, address, cursor=None, limit=ADDRESS_PAGE_SIZE) -> tuple:
+        """
+        Return one page of the confirmed transactions of an address, newest first
+        :param address: The public key (or 'MINING')
+        :param cursor: The next_cursor of the previous page, None for the newest entries
+        :param limit: Number of entries per page, at most MAX_ADDRESS_PAGE_SIZE
+        :return: (entries, next_cursor) with next_cursor None on the last page
+        :raises ValueError: if the cursor is malformed
+        """
+        before = None
+        if cursor is not None:
+            before = tuple(int(part) for part in cursor.split('-'))
+            if len(before) != 3:
+                raise ValueError('Invalid cursor {}'.format(cursor))
+        limit = max(1, min(limit, MAX_ADDRESS_PAGE_SIZE))
+        page = self.__chain.addresses.page(address, before, limit + 1)
+        entries = []
+        for height, position, direction, _ in page[:limit]:
+            transaction = self.__chain[height].transactions[position]
+            entries.append({
+                'block_height': height,
+                'position': position,
+                'direction': DIRECTIONS[direction],
+                'amount': transaction.amount,
+                'transaction_id': transaction.transaction_id,
+                'transaction': transaction.to_dict()
+            })
+        next_cursor = None
+        if len(page) > limit:
+            height, position, direction, _ = page[limit - 1]
+            next_cursor = '{}-{}-{}'.format(height, position, direction)
+        return entries, next_cursor
+
+    @read_locked
     def get_open_transactions(self) -> list[Transaction]:
-        return self.__open_transactions[:]
+        return self.__mempool.transactions()
 
+    @write_locked
     def load_data(self):
+        with LOAD_SECONDS.time():
+            self.__load_data()
+
+    def __load_data(self):
         try:
-            with open('blockchain-{}.txt'.format(self.node_id), mode='r') as file:
-                # give use all the lines in a list readlines() fn
-                file_content = file.readlines()
-
-                # When using pickle
-                # file_content = pickle.loads(file.read())
-
-                # Integrate With Pickle
-                # blockchain = file_content['chain']
-                # open_transactions = file_content['ot']
-
-                # [:-1] range remove the last char =\n
-                blockchain = json.loads(file_content[0][:-1])
-                updated_blockchain = []
-                for block in blockchain:
-                    converted_tx = [Transaction(tx['sender'], tx['recipient'], tx['signature'], tx['amount']) for tx in block['transactions']]
-
-                    updated_block = Block(
-                        block['index'],
-                        block['previous_hash'],
-                        converted_tx,
-                        block['proof'],
-                        block['timestamp']
-                    )
-                    updated_blockchain.append(updated_block)
-
-                self.chain = updated_blockchain
-                open_transactions = json.loads(file_content[1][:-1])
-                updated_transactions = []
-                for tx in open_transactions:
-                    updated_transaction = Transaction(tx['sender'], tx['recipient'], tx['signature'], tx['amount'])
-                    updated_transactions.append(updated_transaction)
-                self.__open_transactions = updated_transactions
-                peer_nodes = json.loads(file_content[2])
-                self.__peer_nodes = set(peer_nodes)
-        except (IOError, IndexError):
-            print('Failed to load blockchain-{}.txt'.format(self.node_id))
-        finally:
-            print('CleanUp!')
+            # Import a blockchain-<node_id>.txt written by older versions once
+            if self.__storage.migrate_legacy_file():
+                logger.info('Migrated blockchain-%s.txt to segmented storage', self.node_id)
+
+            # Only the header index is read here, blocks are decoded when they are used
+            self.__chain = LazyChain(self.__storage, self.block_cache_size)
+            if len(self.__chain) == 0:
+                # Nothing stored yet, initialize our blockchain with the genesis block
+                genesis_block = Block(0, '', [], 100, 0)
+                self.__chain.append(genesis_block)
+
+            peer_nodes = self.__storage.load_peer_nodes()
+            self.__peer_nodes = set(peer_nodes)
+            self.__restore_state()
+        except (IOError, IndexError, ValueError, KeyError):
+            logger.exception('Failed to load blockchain-%s', self.node_id)
+        else:
+            logger.info('Loaded %d blocks and %d open transactions of blockchain-%s', len(self.__chain), len(self.__mempool), self.node_id)
+
+    def __restore_state(self):
+        """ Restore the balances and open transactions from the latest valid snapshot and replay the blocks after it
 
+            Without a valid snapshot everything is rebuilt from the genesis block.
+            The mempool is stored on every change, so its open transactions win
+            over the ones in the snapshot if they can be read.
+        """
+        snapshot = self.__snapshots.latest_valid(self.__chain)
+        if snapshot is not None:
+            height = snapshot['height']
+            self.__balances = BalanceIndex.from_dict(snapshot['balances'])
+            open_transactions = snapshot['open_transactions']
+        else:
+            height = 0
+            self.__balances = BalanceIndex()
+            open_transactions = []
+        stored_transactions = self.__storage.load_open_transactions()
+        if stored_transactions is not None:
+            open_transactions = stored_transactions
+        self.__mempool.clear()
+        for tx in open_transactions:
+            self.__mempool.add(Transaction.from_dict(tx))
+        for block in self.__chain.iter_blocks(height):
+            self.__balances.add_block(block)
+            self.__mempool.remove_many(tx.transaction_id for tx in block.transactions)
+        # Start from a compacted mempool log, clear() dropped the recorded changes
+        self.__mempool.take_changes()
+        self.__storage.save_open_transactions(self.__mempool.transactions())
+        # Fewer blocks than between two regular snapshots are cheap to replay again next time
+        if len(self.__chain) - height >= self.snapshot_every:
+            self.create_snapshot()
+
+    @write_locked
+    def create_snapshot(self) -> Optional[str]:
+        """ Write a snapshot of the balances and open transactions at the current tip
+
+            :return: the path of the snapshot file or None if it could not be written
+        """
+        try:
+            return self.__snapshots.write(len(self.__chain), self.__chain.hash_at(-1), self.__balances.to_dict(), [tx.to_dict() for tx in self.__mempool.transactions()])
+        except IOError:
+            logger.exception('Writing a snapshot failed')
+            return None
+
+    @write_locked
     def save_data(self):
+        """ Persist everything that is not written incrementally and flush the chain segments """
+        with SAVE_SECONDS.time():
+            try:
+                self.__mempool.take_changes()
+                self.__storage.save_open_transactions(self.__mempool.transactions())
+                self.__storage.save_peer_nodes(self.__peer_nodes)
+                self.__storage.sync()
+            except IOError:
+                logger.exception('Saving blockchain-%s failed', self.node_id)
+            self.create_snapshot()
+
+    def set_public_key(self, public_key):
+        """ Switch to another wallet key, blocks mined from now on reward it
+
+            A running mining job is stopped first, it would keep mining for the old key.
+            The chain, mempool and peers stay as they are, so a node keeps one Blockchain
+            (one set of open files and threads) however often its wallet changes.
+        """
+        self.mining.stop(wait=True)
+        with self.lock.write():
+            self.public_key = public_key
+
+    def close(self):
+        """ Stop mining and the mining processes, hand on the pending transaction batch, deliver the queued gossip and close the storage
+
+            The instance must not be used afterwards, its threads end and its files
+            are flushed, e.g. when the node shuts down.
+        """
+        # The mining thread needs the write lock to finish, so it is waited for first
+        self.mining.stop(wait=True)
+        self.miner.close()
+        # Outside the lock, the requests served meanwhile do not wait for the queued gossip to be delivered
+        self.__tx_batcher.close()
+        self.gossip.close()
+        with self.lock.write():
+            if self.__owns_peer_client:
+                self.peer_client.close()
+            try:
+                self.__chain.close()
+            except IOError:
+                logger.exception('Closing blockchain-%s failed', self.node_id)
+
+    def __append_block(self, block):
+        """ Append a block to the stored chain and the balance index and take its transactions out of the mempool """
+        self.__chain.append(block)
+        self.__balances.add_block(block)
+        self.__mempool.remove_many(tx.transaction_id for tx in block.transactions)
+        # Stored before a snapshot, the stored mempool wins over the snapshot's one on restart
+        self.__save_open_transactions()
+        if len(self.__chain) % self.snapshot_every == 0:
+            self.create_snapshot()
+
+    def __save_open_transactions(self):
+        """ Store the mempool changes since the last save
+
+            Changes are appended to the mempool log. The whole mempool is only
+            rewritten once the log holds more records than MEMPOOL_COMPACT_EVERY
+            and the mempool, so each change costs a constant amount on average.
+        """
+        changes = self.__mempool.take_changes()
         try:
-            # write in binary data
-            with open('blockchain-{}.txt'.format(self.node_id), mode='w') as file:
-                saveable_chain = [block.__dict__ for block in [Block(block_el.index, block_el.previous_hash, [tx.__dict__ for tx in block_el.transactions],block_el.proof, block_el.timestamp) for block_el in self.__chain]]
-                # json dumps gives us back a string in JSON format
-                file.write(json.dumps(saveable_chain))
-                file.write('\n')
-                saveable_tx = [tx.__dict__ for tx in self.__open_transactions]
-                file.write(json.dumps(saveable_tx))
-                file.write('\n')
-                file.write(json.dumps(list(self.__peer_nodes)))
-
-                # Integrate with Pickle
-                # save_data = {
-                #     'chain': blockchain,
-                #     'ot': open_transactions
-                # }
-                # file.write(pickle.dumps(save_data))
+            if self.__mempool_unsaved or self.__storage.mempool_log_records + len(changes) > max(MEMPOOL_COMPACT_EVERY, len(self.__mempool)):
+                self.__storage.save_open_transactions(self.__mempool.transactions())
+            elif changes:
+                self.__storage.append_open_transaction_changes(changes)
+            self.__mempool_unsaved = False
         except IOError:
-            print('Saving Failed')
+            # The changes are gone from the mempool record, the next save has to write the whole mempool
+            self.__mempool_unsaved = True
+            logger.exception('Saving the open transactions failed')
 
-    def proof_of_work(self) -> Union[int, Any]:
-        last_block = self.__chain[-1]
-        last_hash = hash_block(last_block)
-        proof = 0
-        while not Verification.valid_proof(self.__open_transactions, last_hash, proof):
-            proof += 1
-        return proof
+    def __save_peer_nodes(self):
+        try:
+            self.__storage.save_peer_nodes(self.__peer_nodes)
+        except IOError:
+            logger.exception('Saving the peer nodes failed')
 
+    @read_locked
     def get_balance(self, sender=None) -> Union[int, Any]:
         """Calculate and return the balance of a participant"""
 
@@ -123,22 +351,11 @@ class Blockchain:
         else:
             participant = sender
 
-        # Fetch a list of all sent coin amounts for the given person (empty lists)
-        # This fetches sent amounts of transactions that were already included in
-        tx_sender = [[tx.amount for tx in block.transactions if tx.sender == participant] for block in self.__chain]
-        # Fetch a list of all sent coin amounts for the given person (empty lists)
-        # This fetches sent amount of open transactions (to avoid double spending
-        open_tx_sender = [tx.amount for tx in self.__open_transactions if tx.sender == participant]
-        tx_sender.append(open_tx_sender)
-        print(tx_sender)
-        amount_sent = functools.reduce(lambda tx_sum, tx_amt: tx_sum + sum(tx_amt) if len(tx_amt) > 0 else tx_sum + 0, tx_sender, 0)
-        # This fetches received coin amounts of transactions that were already in
-        # We ignore open transactions here because you shouldn't be able to spend
-        tx_recipient = [[tx.amount for tx in block.transactions if tx.recipient == participant] for block in self.__chain]
-        amount_received = functools.reduce(lambda tx_sum, tx_amt: tx_sum + sum(tx_amt) if len(tx_amt) > 0 else tx_sum + 0, tx_recipient, 0)
-        # Return total balance
-        return amount_received - amount_sent
+        # Open transactions only count on the sending side, you shouldn't be able
+        # to spend coins you have not confirmed yet
+        return self.__balances.get_balance(participant) - self.__mempool.pending_spend(participant)
 
+    @read_locked
     def get_last_blockchain_value(self) -> Optional[Block]:
         """
         Returns the last value of the current blockchain
@@ -164,124 +381,315 @@ class Blockchain:
         #     return False
 
         transaction = Transaction(sender=sender, recipient=recipient, signature=signature, amount=amount)
+        # A block mined from it could not be stored
+        if not Verification.valid_transaction_fields(transaction):
+            return False
 
-        if Verification.verify_transaction(transaction,         self.get_balance):
-            self.__open_transactions.append(transaction)
-            self.save_data()
-            
-            if not is_receiving:
-
-                for node in self.__peer_nodes:
-                    url = 'http://{}/broadcast-transaction'.format(node)
-    
-                    try:
-                        response = requests.post(url, json={'sender': sender, 'recipient': recipient, 'amount': amount,'signature': signature, })
-    
-                        if response.status_code == 400 or response.status_code == 500:
-                            print('Transaction failed, needs resolving')
-                            return False
-                    except requests.exceptions.ConnectionError:
-                        continue
-            return True
-        return False
-
-    def mine_block(self):
+        # The RSA check runs outside the lock, a valid signature is cached for the check below
+        if not Wallet.verify_transaction(transaction):
+            return False
+
+        with self.lock.write():
+            if transaction.transaction_id in self.__mempool:
+                return False
+            if not Verification.verify_transaction(transaction,         self.get_balance):
+                return False
+            # Full for this sender (max_per_sender), nothing to save or relay
+            if not self.__mempool.add(transaction):
+                return False
+            self.__save_open_transactions()
+
+        if not is_receiving:
+            self.__tx_batcher.add(transaction)
+        return True
+
+    def add_transactions(self, transactions) -> list[bool]:
+        """
+        Add a batch of transactions received from a peer
+        Funds are checked against one balance snapshot taken for the batch and the
+        open transactions are stored once for the whole batch
+        :param transactions: list of dicts with sender, recipient, signature and amount
+        :return: list[bool] whether each transaction was accepted
+        """
+        converted_transactions = [Transaction.from_dict(tx) for tx in transactions]
+        # Transactions with fields a block could not store are refused without checking their signature
+        well_formed = [tx for tx in converted_transactions if Verification.valid_transaction_fields(tx)]
+        # One batch verification when every signature is fine, single checks to find the bad ones otherwise
+        if Wallet.verify_transactions(well_formed):
+            verified = {id(tx) for tx in well_formed}
+        else:
+            verified = {id(tx) for tx in well_formed if Wallet.verify_transaction(tx)}
+        signatures_valid = [id(tx) in verified for tx in converted_transactions]
+
+        available = {}
+        accepted = []
+        with self.lock.write():
+            for transaction, signature_valid in zip(converted_transactions, signatures_valid):
+                if transaction.sender not in available:
+                    available[transaction.sender] = self.get_balance(transaction.sender)
+                if not signature_valid or available[transaction.sender] < transaction.amount or not self.__mempool.add(transaction):
+                    accepted.append(False)
+                    continue
+                available[transaction.sender] -= transaction.amount
+                accepted.append(True)
+            if any(accepted):
+                self.__save_open_transactions()
+        return accepted
+
+    def mine_block(self, generation=None):
         """
         Create a new block and add open transactions to it
+        :param generation: The miner generation read before the caller decided to mine, default: read here
         :return: bool
         """
 
-        if self.public_key is None:
+        with self.lock.read():
+            # A competing block or a cancelled job from now on stops the search, even before it starts
+            if generation is None:
+                generation = self.miner.generation
+            # The key the reward goes to, set_public_key may change it while the proof is searched
+            recipient = self.public_key
+            if recipient is None:
+                return None
+            # Hash of the currently last block of the blockchain, read from the header index
+            hashed_block = self.__chain.hash_at(-1)
+            height = len(self.__chain)
+            # Copying transaction instead of manipulating the open transactions directly
+            # This ensures that if for some reason the mining should fail, we dont have the reward transaction
+            # It also pins the transactions the proof is computed for while new ones keep arriving
+            # At most max_block_transactions are taken, the rest carries over to the next block
+            copied_transactions = self.__mempool.template(self.max_block_transactions)
+        # No lock is held while searching, reads and new transactions are served in the meantime
+        proof = self.miner.proof_of_work(copied_transactions, hashed_block, generation)
+        if proof is None:
             return None
 
-        # Fetch the currently last block of the blockchain
-        last_block = self.__chain[-1]
-        # Hash the last block (=> to be able to compare it to the stored hash value
-        hashed_block = hash_block(last_block)
-        proof = self.proof_of_work()
-
         # Miners are rewarded via reward transaction
-        reward_transaction = Transaction(sender='MINING', recipient=self.public_key, signature='', amount=MINING_REWARD)
-
-        # Copying transaction instead of manipulating the original open_transactions list [:] means to copy complete list
-        # This ensures that if for some reason the mining should fail, we dont have the reward transaction
-        copied_transactions = self.__open_transactions[:]
+        reward_transaction = Transaction(sender='MINING', recipient=recipient, signature='', amount=MINING_REWARD)
 
-        for tx in copied_transactions:
-            if not Wallet.verify_transaction(tx):
-                return None
+        if not Wallet.verify_transactions(copied_transactions):
+            return None
 
         copied_transactions.append(reward_transaction)
 
-        block = Block(len(self.__chain), hashed_block, copied_transactions, proof)
-
-        self.__chain.append(block)
-        self.__open_transactions = []
-        self.save_data()
-
-        for node in self.__peer_nodes:
-            url = 'http://{}/broadcast-block'.format(node)
-
-            converted_block = block.__dict__.copy()
-
-            converted_block['transactions'] = [tx.__dict__ for tx in converted_block['transactions']]
-
-            try:
-                response = requests.post(url, json={'block': converted_block})
-                if response.status_code == 400 or response.status_code == 500:
-                    print('Block failed, needs resolving')
-                if response.status_code == 409:
-                    self.resolve_conflicts = True
-
-            except requests.exceptions.ConnectionError:
-                continue
+        block = Block(height, hashed_block, copied_transactions, proof)
 
+        with self.lock.write():
+            # A competing block arrived while mining (see add_block), our proof is worthless now
+            if len(self.__chain) != height or self.__chain.hash_at(-1) != hashed_block:
+                return None
+            # Transactions that arrived while mining stay open for the next block
+            self.__append_block(block)
 
+        # Transactions still waiting in a batch have to reach the peers before the block
+        self.__tx_batcher.flush()
+        if self.peer_format == 'binary':
+            payload = codec.encode_blocks([block])
+        else:
+            payload = {'block': block.to_dict()}
+        self.gossip.enqueue(self.get_peer_nodes(), '/broadcast-block', payload)
         return block
 
-    def add_block(self, block):
-        transactions = [Transaction(tx['sender'], tx['recipient'], tx['signature'], tx['amount']) for tx in block['transactions']]
-        proof_is_valid = Verification.valid_proof(transactions[:-1], block['previous_hash'], block['proof'])
-        hashes_match = hash_block(self.chain[-1]) == block['previous_hash']
+    def __broadcast_transactions(self, transactions):
+        """Queue a batch of our own transactions for all peers"""
+        if self.peer_format == 'binary':
+            payload = codec.encode_transactions(transactions)
+        else:
+            payload = {'transactions': [tx.to_dict() for tx in transactions]}
+        self.gossip.enqueue(self.get_peer_nodes(), '/broadcast-transactions', payload)
+
+    def __on_gossip_response(self, node, path, status):
+        """Called by the gossip workers once a peer answered a broadcast"""
+        if status == 400 or status == 500:
+            if path == '/broadcast-block':
+                logger.warning('Block failed on %s, needs resolving', node)
+            else:
+                logger.warning('Transactions failed on %s, needs resolving', node)
+        if status == 409 and path == '/broadcast-block':
+            self.resolve_conflicts = True
 
-        if not proof_is_valid or not hashes_match:
+    def add_block(self, block):
+        converted_block = Block.from_dict(block)
+        transactions = converted_block.transactions
+        proof_is_valid = Verification.valid_proof(transactions[:-1], converted_block.previous_hash, converted_block.proof)
+        if not proof_is_valid:
+            return False
+        # The last transaction is the unsigned mining reward
+        if not Wallet.verify_transactions(transactions[:-1]):
             return False
-        converted_block = Block(block['index'], block['previous_hash'], transactions, block['proof'], block['timestamp'])
-        self.__chain.append(converted_block)
-        stored_transactions = self.__open_transactions[:]
-        for itx in block['transactions']:
-            for opentx in stored_transactions:
-                if opentx.sender == itx['sender'] and opentx.recipient == itx['recipient'] and opentx.amount == itx['amount'] and opentx.signature == itx['signature']:
-                    try:
-                        self.__open_transactions.remove(opentx)
-                    except ValueError:
-                        print('Item was already removed')
-        self.save_data()
+
+        with self.lock.write():
+            hashes_match = self.__chain.hash_at(-1) == converted_block.previous_hash
+            if not hashes_match or not Verification.valid_block_fields(converted_block, len(self.__chain)):
+                return False
+            self.__append_block(converted_block)
+            # Someone else mined this height first, stop searching for our own proof
+            self.miner.cancel()
         return True
 
     def resolve(self):
-        winner_chain = self.chain
+        start = time.perf_counter()
+        replaced = self.__resolve()
+        RESOLVE_SECONDS.labels('replaced' if replaced else 'kept').observe(time.perf_counter() - start)
+        if replaced:
+            logger.info('Chain replaced by a longer chain of a peer, now %d blocks', len(self.__chain))
+        return replaced
+
+    def __resolve(self):
+        # Peers are asked without holding the lock, only reads of our chain take it briefly
+        with self.lock.read():
+            winner_length = len(self.__chain)
+            peer_nodes = list(self.__peer_nodes)
+        # Number of leading blocks the winner chain shares with our local chain and its blocks after them
+        winner_fork = winner_length
+        winner_blocks = []
         replace = False
-        for node in self.__peer_nodes:
-            url = 'http://{}/chain'.format(node)
+        # Ask all peers for their tip at once and try the longest chains first
+        tips = self.peer_client.get_all(peer_nodes, '/chain/tip')
+        lengths = {}
+        for node, tip in tips.items():
+            # Only a malformed answer is dropped, the other peers are still compared
+            if isinstance(tip, dict) and isinstance(tip.get('length'), int) and not isinstance(tip['length'], bool):
+                lengths[node] = tip['length']
+            elif tip is not None:
+                logger.warning('Ignoring the malformed chain tip of %s', node)
+        peers = sorted(lengths, key=lengths.get, reverse=True)
+        for node in peers:
             try:
-                response = requests.get(url)
-                node_chain = response.json()
-                node_chain = [Block(block['index'], block['previous_hash'], [Transaction(tx['sender'], tx['recipient'], tx['signature'], tx['amount']) for tx in block['transactions']], block['proof'], block['timestamp']) for block in node_chain]
-                node_chain_length = len(node_chain)
-                local_chain_length = len(winner_chain)
-                if node_chain_length > local_chain_length and Verification.verify_chain(node_chain):
-                    winner_chain = node_chain
+                # Only a longer chain can win, skip the download otherwise
+                if lengths[node] <= winner_length:
+                    continue
+                fork, node_blocks = self.__fetch_peer_suffix(node, lengths[node])
+                if fork + len(node_blocks) <= winner_length:
+                    continue
+                # A fork at 0 means a different genesis block, that is another network
+                if fork == 0:
+                    continue
+                if not all(Verification.valid_block_fields(block, height) for height, block in enumerate(node_blocks, fork)):
+                    continue
+                # Blocks we share with the peer are already verified, only the new suffix is checked against our block at the fork
+                with self.lock.read():
+                    node_chain = [self.__chain[fork - 1]] + node_blocks
+                    checkpoint_hash = self.__chain.hash_at(fork - 1)
+                if Verification.verify_chain(node_chain, checkpoint_hash=checkpoint_hash) and Wallet.verify_transactions([tx for block in node_blocks for tx in block.transactions[:-1]]):
+                    winner_length = fork + len(node_blocks)
+                    winner_fork = fork
+                    winner_blocks = node_blocks
                     replace = True
-            except requests.exceptions.ConnectionError:
+            # IndexError: our chain was replaced while comparing
+            except (requests.exceptions.RequestException, ValueError, KeyError, IndexError):
                 continue
         self.resolve_conflicts = False
-        self.chain = winner_chain
         if replace:
-            self.__open_transactions = []
-        self.save_data()
+            with self.lock.write():
+                # Blocks may have been added or replaced while we were downloading
+                fork_matches = 0 < winner_fork <= len(self.__chain) and self.__chain.hash_at(winner_fork - 1) == winner_blocks[0].previous_hash
+                replace = fork_matches and winner_length > len(self.__chain)
+                if replace:
+                    replace = self.__replace_chain(winner_fork, winner_blocks)
+                    # Our search builds on a block that may be gone now
+                    self.miner.cancel()
         return replace
 
+    def __fetch_blocks(self, node, from_height, limit) -> list[Block]:
+        """ Download one page of blocks from a peer """
+        blocks = self.peer_client.get(node, '/chain', params={'from_height': from_height, 'limit': limit}, binary=self.peer_format == 'binary')
+        if isinstance(blocks, bytes):
+            return codec.decode_blocks(blocks)
+        return [Block.from_dict(block) for block in blocks]
+
+    def __fetch_peer_suffix(self, node, peer_length):
+        """ Find the fork point with a peer and download only the blocks after it
+
+            Walks back from our tip in exponentially growing pages until a peer block
+            links to one of our blocks by hash, then pages forward to the peer tip.
+
+            Arguments:
+                :node: The peer to sync from
+                :peer_length: The number of blocks the peer reported
+            :return: (fork, blocks) the number of shared blocks and the peer blocks after them
+        """
+        with self.lock.read():
+            top = min(len(self.__chain), peer_length - 1)
+        high = top + 1
+        step = 1
+        fetched = []
+        fork = None
+        while fork is None:
+            low = max(high - step, 0)
+            page = self.__fetch_blocks(node, low, high - low)
+            if len(page) != high - low:
+                raise ValueError('Peer returned an incomplete page')
+            fetched = page + fetched
+            with self.lock.read():
+                for height in range(high - 1, low - 1, -1):
+                    if height == 0 or page[height - low].previous_hash == self.__chain.hash_at(height - 1):
+                        fork = height
+                        break
+            high = low
+            step *= 2
+        blocks = fetched[fork - low:]
+        next_height = top + 1
+        while next_height < peer_length:
+            page = self.__fetch_blocks(node, next_height, CHAIN_PAGE_SIZE)
+            if len(page) == 0:
+                break
+            blocks.extend(page)
+            next_height += len(page)
+        return fork, blocks
+
+    def __replace_chain(self, fork, new_blocks) -> bool:
+        """ Keep the first fork blocks of the local chain and continue it with new_blocks
+
+            Nothing is changed if the genesis block would be replaced or a new block
+            cannot be stored at its height. The blocks are stored first, the balances
+            and the mempool only follow once they are on disk. If storing fails,
+            everything is read back from storage, which may hold only a part of the
+            new blocks then.
+            :return: whether the chain was replaced
+        """
+        if fork < 1 or not all(Verification.valid_block_fields(block, height) for height, block in enumerate(new_blocks, fork)):
+            return False
+        dropped_blocks = self.__chain[fork:]
+        try:
+            self.__chain.replace_from(fork, new_blocks)
+        except IOError:
+            logger.exception('Saving the replaced chain failed, reloading blockchain-%s', self.node_id)
+            self.__reload()
+            return False
+        self.__forget_dropped_transactions(dropped_blocks, new_blocks)
+        for block in dropped_blocks:
+            self.__balances.remove_block(block)
+        for block in new_blocks:
+            self.__balances.add_block(block)
+            self.__mempool.remove_many(tx.transaction_id for tx in block.transactions)
+        # Open transactions the new chain does not cover anymore are dropped, newest first
+        for tx in reversed(self.__mempool.transactions()):
+            if self.get_balance(tx.sender) < 0:
+                self.__mempool.remove(tx.transaction_id)
+        self.__save_open_transactions()
+        self.create_snapshot()
+        return True
+
+    def __reload(self):
+        """ Read the chain, balances and open transactions back from storage after a write failed half way """
+        try:
+            self.__chain.close()
+        except IOError:
+            logger.exception('Closing blockchain-%s failed', self.node_id)
+        # The mempool did not change, a save that failed before is retried so loading does not lose it
+        self.__save_open_transactions()
+        self.__load_data()
+
+    def __forget_dropped_transactions(self, dropped_blocks, new_blocks):
+        """Invalidate cached signature checks of transactions in dropped_blocks that are not part of new_blocks"""
+        kept = {tx.transaction_id for block in new_blocks for tx in block.transactions}
+        for block in dropped_blocks:
+            for tx in block.transactions:
+                if tx.transaction_id not in kept:
+                    Wallet.signature_cache.discard(tx.transaction_id)
+
+    @write_locked
     def add_peer_node(self, node):
         """ Add a new node to the peer node set
 
@@ -289,8 +697,9 @@ class Blockchain:
                 :node: The node URL which be added
         """
         self.__peer_nodes.add(node)
-        self.save_data()
+        self.__save_peer_nodes()
 
+    @write_locked
     def remove_peer_node(self, node):
         """ Remove a node from the peer node set
 
@@ -298,8 +707,9 @@ class Blockchain:
               :node: The node URL which will be removed
         """
         self.__peer_nodes.discard(node)
-        self.save_data()
+        self.__save_peer_nodes()
 
+    @read_locked
     def get_peer_nodes(self):
         """ Return all nodes connected to the peer nodes"""
         return list(self.__peer_nodes)
@@ -1,7 +1,12 @@
-from flask import Flask, jsonify, request, send_from_directory
+import logging
+from flask import Flask, Response, jsonify, request, send_from_directory
 from wallet import Wallet
 from flask_cors import CORS
-from blockchain import Blockchain
+from blockchain import Blockchain, ADDRESS_PAGE_SIZE
+from utility.hash_util import hash_block
+from utility import codec
+from utility.payload import decode_payload, stream_json_blocks
+from utility import metrics
 
 app = Flask(__name__)
 CORS(app)
@@ -17,8 +22,8 @@ def get_network_ui():
 def create_keys():
     wallet.create_keys()
     if wallet.save_keys(): # Possibly can add another route for saving keys instead of doing it in the same route method
-        global blockchain
-        blockchain = Blockchain(wallet.public_key, port)
+        # The same Blockchain (files, threads) keeps serving, only the key blocks are mined for changes
+        blockchain.set_public_key(wallet.public_key)
         response = {
             'public_key': wallet.public_key,
             'private_key': wallet.private_key,
@@ -34,8 +39,8 @@ def create_keys():
 @app.route('/wallet', methods=['GET'])
 def load_keys():
     if wallet.load_keys():
-        global blockchain
-        blockchain = Blockchain(wallet.public_key, port)
+        # The same Blockchain (files, threads) keeps serving, only the key blocks are mined for changes
+        blockchain.set_public_key(wallet.public_key)
         response = {
             'public_key': wallet.public_key,
             'private_key': wallet.private_key,
@@ -107,7 +112,13 @@ def add_transaction():
 
 @app.route('/mine', methods=['POST'])
 def mine():
-
+    # Mining runs in the background, poll GET /mine/<job_id> for the result
+    if wallet.public_key is None:
+        response = {
+            'message': 'No wallet set up',
+            'wallet_set_up': False
+        }
+        return jsonify(response), 400
 
     if blockchain.resolve_conflicts:
         response = {
@@ -116,24 +127,48 @@ def mine():
 
         return jsonify(response), 409
 
-    block = blockchain.mine_block()
-    if block is not None:
-
-        dict_block = block.__dict__.copy()
-        dict_block['transactions'] = [tx.__dict__ for tx in dict_block['transactions']]
+    # {"continuous": true} keeps mining block after block until the job is cancelled
+    values = request.get_json(silent=True) or {}
+    job, started = blockchain.mining.start(continuous=bool(values.get('continuous', False)))
+    if not started:
+        response = {
+            'message': 'Already mining',
+            'job': blockchain.mining.get(job.id)
+        }
+        return jsonify(response), 409
+    response = {
+        'message': 'Mining started',
+        'job': blockchain.mining.get(job.id)
+    }
+    return jsonify(response), 202
 
+@app.route('/mine/<job_id>', methods=['GET'])
+def get_mining_job(job_id):
+    job = blockchain.mining.get(job_id)
+    if job is None:
         response = {
-            'message': 'Block added successfully',
-            'block': dict_block,
-            'funds': blockchain.get_balance()
+            'message': 'Mining job not found'
         }
-        return jsonify(response), 201
-    else:
+        return jsonify(response), 404
+    response = {
+        'job': job,
+        'funds': blockchain.get_balance()
+    }
+    return jsonify(response), 200
+
+@app.route('/mine/<job_id>', methods=['DELETE'])
+def cancel_mining_job(job_id):
+    job = blockchain.mining.cancel(job_id)
+    if job is None:
         response = {
-            'message': 'Adding a block failed',
-            'wallet_set_up': wallet.public_key is not None
+            'message': 'Mining job not found'
         }
-    return jsonify(response), 500
+        return jsonify(response), 404
+    response = {
+        'message': 'Mining job cancelled',
+        'job': job
+    }
+    return jsonify(response), 200
 
 @app.route('/resolve-conflicts', methods=['POST'])
 def resolve_conflicts():
@@ -151,7 +186,7 @@ def resolve_conflicts():
 
 @app.route('/broadcast-transaction', methods=['POST'])
 def broadcast_transaction():
-  values = request.get_json()
+  values = decode_payload(request.mimetype, request.get_data(), lambda data: codec.decode_transactions(data)[0].to_dict())
   if not values:
       response = {
           'message': 'No data found',
@@ -185,9 +220,33 @@ def broadcast_transaction():
       }
       return jsonify(response), 500
 
+@app.route('/broadcast-transactions', methods=['POST'])
+def broadcast_transactions():
+    values = decode_payload(request.mimetype, request.get_data(), lambda data: {'transactions': [tx.to_dict() for tx in codec.decode_transactions(data)]})
+    if not values or 'transactions' not in values:
+        response = {
+            'message': 'No data found',
+        }
+        return jsonify(response), 400
+    required = ['sender', 'recipient', 'amount', 'signature']
+    if not all(key in tx for tx in values['transactions'] for key in required):
+        response = { 'message': 'Required data is missing' }
+        return jsonify(response), 400
+    accepted = blockchain.add_transactions(values['transactions'])
+    response = {
+        'accepted': accepted.count(True),
+        'rejected': accepted.count(False),
+    }
+    if all(accepted):
+        response['message'] = 'Successfully added transactions'
+        return jsonify(response), 201
+    else:
+        response['message'] = 'Some transactions failed.'
+        return jsonify(response), 500
+
 @app.route('/broadcast-block', methods=['POST'])
 def broadcast_block():
-    values = request.get_json()
+    values = decode_payload(request.mimetype, request.get_data(), lambda data: {'block': codec.decode_blocks(data)[0].to_dict()})
 
     if not values:
         response = {
@@ -203,8 +262,9 @@ def broadcast_block():
         return jsonify(response), 400
 
     block = values['block']
+    last_block = blockchain.get_last_blockchain_value()
 
-    if block['index'] == blockchain.chain[-1].index + 1:
+    if block['index'] == last_block.index + 1:
         if blockchain.add_block(block):
             response = {'message': 'Block added successfully'}
             return jsonify(response), 201
@@ -212,7 +272,7 @@ def broadcast_block():
             response = {'message': 'Block seems invalid'}
             return jsonify(response), 409
 
-    elif block['index'] > blockchain.chain[-1].index:
+    elif block['index'] > last_block.index:
         response = {
             'message': 'Blockchain seems to differ from local blockchain',
         }
@@ -229,21 +289,97 @@ def broadcast_block():
 @app.route('/transactions', methods=['GET'])
 def get_open_transactions():
     transactions = blockchain.get_open_transactions()
-    dict_transactions = [tx.__dict__ for tx in transactions]
+    dict_transactions = [tx.to_dict() for tx in transactions]
     return jsonify(dict_transactions), 200
 
 @app.route('/chain', methods=['GET'])
 def get_chain():
-    chain_snapshot = blockchain.chain
+    # Peers syncing a delta only ask for the blocks starting at from_height
+    from_height = request.args.get('from_height', 0, type=int)
+    limit = request.args.get('limit', None, type=int)
+    blocks = blockchain.iter_blocks(from_height, limit)
+
+    # Peers may ask for the compact binary encoding, the UI gets JSON
+    # Both are streamed block by block (chunked transfer encoding) instead of being built in memory
+    if codec.CONTENT_TYPE in request.headers.get('Accept', ''):
+        return Response(codec.iter_encode_blocks(blocks), mimetype=codec.CONTENT_TYPE), 200
+    return Response(stream_json_blocks(blocks), mimetype='application/json'), 200
+
+@app.route('/chain/tip', methods=['GET'])
+def get_chain_tip():
+    last_block = blockchain.get_last_blockchain_value()
+    response = {
+        'height': last_block.index,
+        'length': last_block.index + 1,
+        'hash': hash_block(last_block)
+    }
+    return jsonify(response), 200
 
-    dict_chain = [block.__dict__.copy() for block in chain_snapshot]
+@app.route('/block/<block_hash>', methods=['GET'])
+def get_block_by_hash(block_hash):
+    block = blockchain.get_block_by_hash(block_hash)
+    if block is None:
+        response = {
+            'message': 'Block not found'
+        }
+        return jsonify(response), 404
+    return jsonify(block.to_dict()), 200
 
-    for dict_block in dict_chain:
-        dict_block['transactions'] = [tx.__dict__ for tx in dict_block['transactions']]
+@app.route('/block/height/<int:height>', methods=['GET'])
+def get_block_by_height(height):
+    block = blockchain.get_block(height)
+    if block is None:
+        response = {
+            'message': 'Block not found'
+        }
+        return jsonify(response), 404
+    return jsonify(block.to_dict()), 200
 
-    print(dict_chain)
+@app.route('/tx/<transaction_id>', methods=['GET'])
+def get_transaction(transaction_id):
+    result = blockchain.get_transaction(transaction_id)
+    if result is None:
+        response = {
+            'message': 'Transaction not found'
+        }
+        return jsonify(response), 404
+    transaction, height, position = result
+    response = {
+        'transaction': transaction.to_dict(),
+        'transaction_id': transaction_id,
+        # None while the transaction is still open
+        'block_height': height,
+        'position': position,
+        'confirmed': height is not None
+    }
+    return jsonify(response), 200
 
-    return jsonify(dict_chain), 200
+@app.route('/address/<address>/transactions', methods=['GET'])
+def get_address_transactions(address):
+    # Pass next_cursor of a response as cursor to get the next (older) page
+    cursor = request.args.get('cursor', None)
+    limit = request.args.get('limit', ADDRESS_PAGE_SIZE, type=int)
+    try:
+        entries, next_cursor = blockchain.get_address_history(address, cursor, limit)
+    except ValueError:
+        response = {
+            'message': 'Invalid cursor'
+        }
+        return jsonify(response), 400
+    response = {
+        'transactions': entries,
+        'next_cursor': next_cursor
+    }
+    return jsonify(response), 200
+
+@app.route('/gossip', methods=['GET'])
+def get_gossip_stats():
+    return jsonify(blockchain.gossip.stats()), 200
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheus text format, see utility/metrics.py
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE), 200
 
 @app.route('/node', methods=['POST'])
 def add_node():
@@ -292,8 +428,22 @@ if __name__ == '__main__':
     from argparse import ArgumentParser
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', default=5000, type=int)
+    parser.add_argument('-w', '--workers', default=None, type=int, help='Number of mining processes (default: all cores)')
+    parser.add_argument('--peer-format', default='json', choices=['json', 'binary'], help='Encoding of blocks and transactions sent to peers')
+    parser.add_argument('--storage-format', default='json', choices=['json', 'binary'], help='Encoding of chain segments of a new data directory')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
     args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
     port = args.port
+    blockchain_options = {
+        'mining_workers': args.workers,
+        'peer_format': args.peer_format,
+        'storage_format': args.storage_format,
+    }
     wallet = Wallet(port)
-    blockchain = Blockchain(wallet.public_key, port)
-    app.run(debug=True, host='0.0.0.0', port=port)
+    blockchain = Blockchain(wallet.public_key, port, **blockchain_options)
+    # Requests are served on their own threads, Blockchain.lock keeps its state consistent
+    try:
+        app.run(debug=True, host='0.0.0.0', port=port, threaded=True)
+    finally:
+        blockchain.close()
@@ -0,0 +1,75 @@
+""" Create, list and verify the state snapshots of a node
+
+Run from the folder holding the blockchain-<port> directory:
+    python snapshots.py -p 5000 create
+    python snapshots.py -p 5000 list
+    python snapshots.py -p 5000 verify [--height 1200] [--deep]
+
+list and verify only read the data directory, so they can be run while the
+node is running. create opens the whole blockchain and writes a snapshot, the
+node should be stopped for it.
+"""
+
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from blockchain import Blockchain
+from utility.storage import ChainStorage
+from utility.lazy_chain import ChainView
+from utility.snapshot import SnapshotStore
+
+
+def open_read_only(port):
+    """ Open the stored chain and snapshots of a node without writing to its directory
+
+        :return: (chain, snapshots) with a ChainView and a read-only SnapshotStore
+    """
+    storage = ChainStorage(port, read_only=True)
+    return ChainView(storage), SnapshotStore(storage.directory, read_only=True)
+
+
+def print_snapshots(chain, snapshots):
+    described = snapshots.describe(chain)
+    if len(described) == 0:
+        print('No snapshots')
+    for snapshot in described:
+        created = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(snapshot['created'])) if snapshot['created'] else '-'
+        print('{:>10}  {}  {}  {}'.format(snapshot['height'], snapshot['hash'], created, 'valid' if snapshot['valid'] else 'INVALID'))
+
+
+def verify_snapshots(chain, snapshots, height=None, deep=False) -> bool:
+    heights = [height] if height is not None else snapshots.heights()
+    all_valid = True
+    for snapshot_height in heights:
+        snapshot = snapshots.load(snapshot_height)
+        valid = snapshot is not None and snapshots.verify(snapshot, chain, deep)
+        all_valid = all_valid and valid
+        print('{:>10}  {}'.format(snapshot_height, 'valid' if valid else 'INVALID'))
+    return all_valid
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-p', '--port', default=5000, type=int, help='Port (node id) of the node whose data is used')
+    parser.add_argument('command', choices=['create', 'list', 'verify'])
+    parser.add_argument('--height', default=None, type=int, help='Only verify the snapshot at this height')
+    parser.add_argument('--deep', action='store_true', help='Also recompute the balances from the chain')
+    args = parser.parse_args()
+    directory = 'blockchain-{}'.format(args.port)
+    if not os.path.isdir(directory):
+        # Opening a missing directory would create an empty chain instead
+        print('No data directory {}'.format(directory), file=sys.stderr)
+        sys.exit(1)
+    if args.command == 'create':
+        # Opening the chain restores from the latest snapshot, no peers are contacted
+        blockchain = Blockchain(None, args.port, mining_workers=1)
+        path = blockchain.create_snapshot()
+        blockchain.close()
+        if path is None:
+            sys.exit(1)
+        print('Created {}'.format(path))
+    elif args.command == 'list':
+        print_snapshots(*open_read_only(args.port))
+    elif not verify_snapshots(*open_read_only(args.port), args.height, args.deep):
+        sys.exit(1)
@@ -1,3 +1,5 @@
+import hashlib as hl
+import json
 from collections import OrderedDict
 from utility.printable import Printable
 
@@ -10,12 +12,34 @@ class Transaction(Printable):
         :signature: The signature of the transaction
         :amount: The amount of the transaction
     """
+    # Slots instead of a per-instance __dict__, _id memoizes transaction_id
+    __slots__ = ('sender', 'recipient', 'amount', 'signature', '_id')
+
     def __init__(self, sender, recipient, signature, amount ):
         self.sender = sender
         self.recipient = recipient
         self.amount = amount
         self.signature = signature
+        self._id = None
 
     def to_ordered_dict(self):
         return OrderedDict([('sender', self.sender), ('recipient', self.recipient),('amount', self.amount),])
 
+    def to_dict(self) -> dict:
+        """Return the transaction as a plain dict, used for JSON responses and storage"""
+        return {'sender': self.sender, 'recipient': self.recipient, 'amount': self.amount, 'signature': self.signature}
+
+    @classmethod
+    def from_dict(cls, transaction: dict) -> 'Transaction':
+        return cls(transaction['sender'], transaction['recipient'], transaction['signature'], transaction['amount'])
+
+    def canonical_bytes(self) -> bytes:
+        """The serialization transaction_id is computed from"""
+        return json.dumps([self.sender, self.recipient, self.amount, self.signature]).encode()
+
+    @property
+    def transaction_id(self) -> str:
+        """Digest of sender, recipient, amount and signature which identifies the transaction"""
+        if self._id is None:
+            self._id = hl.sha256(self.canonical_bytes()).hexdigest()
+        return self._id
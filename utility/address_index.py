@@ -0,0 +1,98 @@
+""" Provides a persistent per-address transaction history index """
+
+import bisect
+import hashlib as hl
+import struct
+from utility.block_index import BlockIndex
+
+SENT = 0
+RECEIVED = 1
+DIRECTIONS = {SENT: 'sent', RECEIVED: 'received'}
+# height, position, direction: the leading fields of a sorted record after the address
+_CURSOR = struct.Struct('>QIB')
+
+
+def _address_key(address) -> bytes:
+    # Public keys are a few hundred characters, the index stores their sha256
+    return hl.sha256(str(address).encode()).digest()
+
+
+class AddressIndex(BlockIndex):
+    """Lists the confirmed transactions of every address, oldest first
+
+    Every transaction adds a SENT entry for its sender and a RECEIVED entry for
+    its recipient. The sorted file orders the entries by address, then in chain
+    order (height, position, direction), so the history of an address is one
+    range of it and pages are cut out of it with a binary search. A query costs
+    O(log entries + results).
+    """
+    # height, sha256 of the address, position in the block, direction, amount
+    ENTRY = struct.Struct('>Q32sIBd')
+    FILE_NAME = 'addresses.idx'
+    # sha256 of the address, height, position in the block, direction, amount
+    SORTED_ENTRY = struct.Struct('>32sQIBd')
+    SORTED_FIELDS = (1, 0, 2, 3, 4)
+    SORTED_FILE_NAME = 'addresses.sorted.idx'
+
+    def __init__(self, directory):
+        # (height, position, direction, amount) of the entries added since the last merge, per address
+        self.__recent = {}
+        super().__init__(directory)
+
+    def _clear(self):
+        self.__recent = {}
+
+    def _block_entries(self, block):
+        entries = []
+        for position, tx in enumerate(block.transactions):
+            entries.append((block.index, _address_key(tx.sender), position, SENT, tx.amount))
+            entries.append((block.index, _address_key(tx.recipient), position, RECEIVED, tx.amount))
+        return entries
+
+    def _add_entry(self, entry):
+        height, key, position, direction, amount = entry
+        self.__recent.setdefault(key, []).append((height, position, direction, amount))
+
+    def _remove_entry(self, entry):
+        height, key, position, direction, amount = entry
+        history = self.__recent[key]
+        history.pop()
+        if len(history) == 0:
+            del self.__recent[key]
+
+    def __merged_range(self, key, cursor=None) -> tuple:
+        """ Return the positions of the first and after the last merged entry of key older than the packed cursor """
+        start = self._merged_bisect(key)
+        if cursor is None:
+            return start, self._merged_bisect(key, right=True)
+        return start, self._merged_bisect(key + cursor)
+
+    def page(self, address, before=None, limit=None) -> list:
+        """ Return history entries of an address, newest first
+
+            Arguments:
+                :address: The public key (or 'MINING')
+                :before: Only entries older than this (height, position, direction) cursor
+                :limit: Maximum number of entries
+            :return: list of (height, position, direction, amount)
+            :raises ValueError: if before does not fit a (height, position, direction) cursor
+        """
+        key = _address_key(address)
+        cursor = None
+        if before is not None:
+            try:
+                cursor = _CURSOR.pack(*before)
+            except struct.error as error:
+                raise ValueError('Invalid cursor {}'.format(before)) from error
+        # The recent entries are newer than every merged one
+        recent = self.__recent.get(key, [])
+        end = len(recent) if before is None else bisect.bisect_left(recent, tuple(before))
+        start = 0 if limit is None else max(end - limit, 0)
+        page = recent[start:end][::-1]
+        if limit is not None and len(page) >= limit:
+            return page
+        start, end = self.__merged_range(key, cursor)
+        if limit is not None:
+            start = max(start, end - (limit - len(page)))
+        page.extend((height, position, direction, amount) for height, _, position, direction, amount in reversed(self._merged_entries(start, end)))
+        return page
@@ -0,0 +1,108 @@
+""" Provides HTTP requests to peer nodes on an asyncio event loop """
+
+import asyncio
+import threading
+from typing import Optional
+import aiohttp
+import requests
+from utility import codec
+from utility.peer_client import REQUEST_TIMEOUT, MAX_PARALLEL_REQUESTS
+
+
+class AsyncPeerClient:
+    """Sends requests to peer nodes with aiohttp over one pooled connector
+
+    The session lives on its own event loop thread, so every request to a peer
+    is a coroutine instead of a blocked thread. The methods of PeerClient are
+    kept (post, get, get_all) and can be called from any thread, which
+    lets Blockchain and GossipQueue use either client.
+
+    Errors of get are raised as requests exceptions, like PeerClient does, so
+    callers handle both clients the same way.
+
+    Attributes:
+        :timeout: Seconds to wait for each request
+        :max_parallel: Maximum number of connections open to peers at the same time
+    """
+    def __init__(self, timeout=REQUEST_TIMEOUT, max_parallel=MAX_PARALLEL_REQUESTS):
+        self.timeout = timeout
+        self.max_parallel = max_parallel
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = threading.Thread(target=self.__loop.run_forever, name='async-peer-client', daemon=True)
+        self.__thread.start()
+        self.__session = self.__call(self.__open_session())
+
+    async def __open_session(self):
+        connector = aiohttp.TCPConnector(limit=self.max_parallel)
+        return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    def __call(self, coroutine):
+        """ Run a coroutine on the client loop and wait for its result in the calling thread """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.__loop).result()
+
+    async def __post(self, node, path, payload) -> Optional[int]:
+        try:
+            url = 'http://{}{}'.format(node, path)
+            if isinstance(payload, bytes):
+                request = self.__session.post(url, data=payload, headers={'Content-Type': codec.CONTENT_TYPE})
+            else:
+                request = self.__session.post(url, json=payload)
+            async with request as response:
+                # Read the body so the connection goes back to the pool
+                await response.read()
+                return response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return None
+
+    async def __get(self, node, path, params=None, binary=False):
+        headers = {'Accept': '{}, application/json;q=0.5'.format(codec.CONTENT_TYPE)} if binary else None
+        try:
+            async with self.__session.get('http://{}{}'.format(node, path), params=params, headers=headers) as response:
+                if response.status >= 400:
+                    raise requests.exceptions.HTTPError('{} from {}{}'.format(response.status, node, path))
+                content = await response.read()
+                if binary and response.headers.get('Content-Type', '').startswith(codec.CONTENT_TYPE):
+                    return content
+                return await response.json(content_type=None)
+        except aiohttp.ClientError as error:
+            raise requests.exceptions.ConnectionError(str(error)) from error
+        except asyncio.TimeoutError as error:
+            raise requests.exceptions.Timeout('No answer from {}{}'.format(node, path)) from error
+
+    async def __get_or_none(self, node, path, params):
+        try:
+            return await self.__get(node, path, params)
+        except (requests.exceptions.RequestException, ValueError):
+            return None
+
+    async def __get_all(self, nodes, path, params) -> dict:
+        nodes = list(nodes)
+        results = await asyncio.gather(*(self.__get_or_none(node, path, params) for node in nodes))
+        return dict(zip(nodes, results))
+
+    def post(self, node, path, payload) -> Optional[int]:
+        """ POST a payload to one peer, bytes are sent with the binary codec content type, anything else as JSON
+
+            :return: the status code or None if the peer could not be reached
+        """
+        return self.__call(self.__post(node, path, payload))
+
+    def get(self, node, path, params=None, binary=False):
+        """ GET a path from one peer, errors are raised to the caller
+
+            :return: the decoded JSON, or the raw bytes if binary was asked for and the peer supports it
+        """
+        return self.__call(self.__get(node, path, params, binary))
+
+    def get_all(self, nodes, path, params=None) -> dict:
+        """ GET a path from all nodes concurrently
+
+            :return: dict of node -> decoded JSON (None for nodes that failed)
+        """
+        return self.__call(self.__get_all(nodes, path, params))
+
+    def close(self):
+        """ Close the pooled connections and stop the event loop thread """
+        self.__call(self.__session.close())
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+        self.__thread.join()
@@ -0,0 +1,42 @@
+""" Provides an incrementally maintained per-address balance index """
+
+
+class BalanceIndex:
+    """Keeps running totals per address so balances can be looked up without scanning the chain
+
+    Attributes:
+        :sent: Confirmed amounts sent per address (transactions included in blocks)
+        :received: Confirmed amounts received per address (transactions included in blocks)
+
+    Pending spends of open transactions are tracked by the Mempool.
+    """
+    def __init__(self):
+        self.sent = {}
+        self.received = {}
+
+    def to_dict(self) -> dict:
+        return {'sent': dict(self.sent), 'received': dict(self.received)}
+
+    @classmethod
+    def from_dict(cls, totals) -> 'BalanceIndex':
+        """ Restore an index saved with to_dict """
+        index = cls()
+        index.sent = dict(totals['sent'])
+        index.received = dict(totals['received'])
+        return index
+
+    def add_block(self, block):
+        """ Add the transactions of a newly appended block to the confirmed totals """
+        for tx in block.transactions:
+            self.sent[tx.sender] = self.sent.get(tx.sender, 0) + tx.amount
+            self.received[tx.recipient] = self.received.get(tx.recipient, 0) + tx.amount
+
+    def remove_block(self, block):
+        """ Take the transactions of a block that was dropped from the chain out of the confirmed totals """
+        for tx in block.transactions:
+            self.sent[tx.sender] = self.sent.get(tx.sender, 0) - tx.amount
+            self.received[tx.recipient] = self.received.get(tx.recipient, 0) - tx.amount
+
+    def get_balance(self, participant):
+        """ Return the confirmed amount received minus the confirmed amount sent """
+        return self.received.get(participant, 0) - self.sent.get(participant, 0)
@@ -0,0 +1,318 @@
+""" Provides the base of the persistent secondary indexes kept next to the chain segments """
+
+import heapq
+import mmap
+import os
+import struct
+import tempfile
+from abc import ABC, abstractmethod
+
+# Number of entries of the newest blocks kept in memory before they are merged into the sorted file
+MERGE_EVERY = 4096
+# The sorted file starts with the number of blocks whose entries it holds
+_SORTED_HEADER = struct.Struct('>Q')
+
+
+class BlockIndex(ABC):
+    """An index over the blocks of a LazyChain which stays on disk
+
+    Subclasses set ENTRY, a struct.Struct whose first field is the block height,
+    FILE_NAME, SORTED_FILE_NAME, SORTED_ENTRY and SORTED_FIELDS, and implement
+    _block_entries, _clear, _add_entry and _remove_entry.
+
+    Every entry is appended to FILE_NAME in block order. From time to time the
+    new entries are merged into SORTED_FILE_NAME. There every entry is stored as
+    a SORTED_ENTRY record holding the fields of ENTRY in the order SORTED_FIELDS
+    lists them, all big endian, so the records sort like the byte strings they
+    are and a lookup is a binary search over the memory mapped file. Only the
+    entries added since the last merge, at most about MERGE_EVERY, are kept in
+    memory (_add_entry) and searched by the subclass. Opening an index reads
+    nothing but these.
+
+    LazyChain truncates an index before the chain and extends it after the chain,
+    so after a crash an index can only lag behind and is caught up by indexing
+    the missing blocks again (open, catch_up and finish_catch_up). FILE_NAME is
+    synced before a merge, so the sorted file never holds entries it lacks.
+
+    Attributes:
+        :path: The file holding the entries in block order
+        :sorted_path: The file holding the merged records in sorted order
+        :merged_height: The entries of the blocks below this height are in the sorted file
+    """
+    ENTRY = None
+    FILE_NAME = None
+    SORTED_FILE_NAME = None
+    SORTED_ENTRY = None
+    SORTED_FIELDS = None
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, self.FILE_NAME)
+        self.sorted_path = os.path.join(directory, self.SORTED_FILE_NAME)
+        self.merged_height = 0
+        self.__sorted = None
+        self.__sorted_count = 0
+        # Position of every ENTRY field in a SORTED_ENTRY record
+        self.__entry_fields = [self.SORTED_FIELDS.index(field) for field in range(len(self.SORTED_FIELDS))]
+        # Number of indexed blocks
+        self.__height = 0
+        # Where the entries not merged yet start in FILE_NAME and how many there are
+        self.__recent_offset = 0
+        self.__recent_count = 0
+        self.__catch_up_file = None
+
+    @abstractmethod
+    def _block_entries(self, block) -> list:
+        """ Return the entries (tuples matching ENTRY) of a block """
+
+    @abstractmethod
+    def _clear(self):
+        """ Forget every entry kept in memory """
+
+    @abstractmethod
+    def _add_entry(self, entry):
+        """ Keep an entry which is not merged yet in memory """
+
+    @abstractmethod
+    def _remove_entry(self, entry):
+        """ Undo _add_entry for an entry of a truncated block """
+
+    def __sorted_record(self, entry) -> bytes:
+        return self.SORTED_ENTRY.pack(*(entry[field] for field in self.SORTED_FIELDS))
+
+    def __entry(self, record) -> tuple:
+        fields = self.SORTED_ENTRY.unpack(record)
+        return tuple(fields[position] for position in self.__entry_fields)
+
+    def _merged_bisect(self, prefix, right=False) -> int:
+        """ Return the position of the first merged record which does not start below prefix (right: above it)
+
+            Arguments:
+                :prefix: The packed leading fields of a SORTED_ENTRY record
+                :right: Skip the records starting with prefix as well
+        """
+        low, high = 0, self.__sorted_count
+        while low < high:
+            middle = (low + high) // 2
+            offset = _SORTED_HEADER.size + middle * self.SORTED_ENTRY.size
+            start = self.__sorted[offset:offset + len(prefix)]
+            if start < prefix or (right and start == prefix):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _merged_entries(self, start, end) -> list:
+        """ Return the merged entries (tuples matching ENTRY) from position start up to end """
+        end = min(end, self.__sorted_count)
+        return [self.__entry(record) for record in self.__merged_records(start, end)]
+
+    def __merged_records(self, start, end) -> list:
+        if start >= end:
+            return []
+        size = self.SORTED_ENTRY.size
+        content = self.__sorted[_SORTED_HEADER.size + start * size:_SORTED_HEADER.size + end * size]
+        return [content[offset:offset + size] for offset in range(0, len(content), size)]
+
+    def __iter_merged(self):
+        for start in range(0, self.__sorted_count, MERGE_EVERY):
+            yield from self.__merged_records(start, min(start + MERGE_EVERY, self.__sorted_count))
+
+    def __iter_records(self, file, size):
+        for content in iter(lambda: file.read(MERGE_EVERY * size), b''):
+            yield from (content[offset:offset + size] for offset in range(0, len(content), size))
+
+    def __iter_entries(self, file):
+        for content in iter(lambda: file.read(MERGE_EVERY * self.ENTRY.size), b''):
+            yield from self.ENTRY.iter_unpack(content)
+
+    def __log_offset(self, file, height) -> int:
+        # Entries are in block order, so the first one of a height is found by a binary search
+        low, high = 0, os.fstat(file.fileno()).st_size // self.ENTRY.size
+        while low < high:
+            middle = (low + high) // 2
+            file.seek(middle * self.ENTRY.size)
+            if self.ENTRY.unpack(file.read(self.ENTRY.size))[0] < height:
+                low = middle + 1
+            else:
+                high = middle
+        return low * self.ENTRY.size
+
+    def __open_sorted(self):
+        if self.__sorted is not None:
+            self.__sorted.close()
+            self.__sorted = None
+        if not os.path.exists(self.sorted_path) or os.path.getsize(self.sorted_path) < _SORTED_HEADER.size:
+            self.__write_sorted(0, [])
+            return
+        with open(self.sorted_path, mode='rb') as file:
+            self.__sorted = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.merged_height = _SORTED_HEADER.unpack_from(self.__sorted)[0]
+        self.__sorted_count = (len(self.__sorted) - _SORTED_HEADER.size) // self.SORTED_ENTRY.size
+
+    def __write_sorted(self, height, records):
+        """ Replace the sorted file with records, which are in order and may be read from the current file """
+        tmp_path = self.sorted_path + '.tmp'
+        with open(tmp_path, mode='wb') as file:
+            file.write(_SORTED_HEADER.pack(height))
+            chunk = []
+            for record in records:
+                chunk.append(record)
+                if len(chunk) == MERGE_EVERY:
+                    file.write(b''.join(chunk))
+                    chunk = []
+            file.write(b''.join(chunk))
+            file.flush()
+            os.fsync(file.fileno())
+        # Unmapped first, a mapped file cannot be replaced everywhere
+        if self.__sorted is not None:
+            self.__sorted.close()
+            self.__sorted = None
+        os.replace(tmp_path, self.sorted_path)
+        self.__open_sorted()
+
+    def __merge(self):
+        """ Merge the entries added since the last merge into the sorted file
+
+            They are read back from FILE_NAME and sorted in runs of MERGE_EVERY
+            entries, so catching up on many blocks does not need them in memory.
+        """
+        runs = []
+        try:
+            with open(self.path, mode='r+b') as file:
+                os.fsync(file.fileno())
+                file.seek(self.__recent_offset)
+                for content in iter(lambda: file.read(MERGE_EVERY * self.ENTRY.size), b''):
+                    run = tempfile.TemporaryFile(dir=self.directory)
+                    run.write(b''.join(sorted(self.__sorted_record(entry) for entry in self.ENTRY.iter_unpack(content))))
+                    run.seek(0)
+                    runs.append(run)
+                end = file.tell()
+            merged = heapq.merge(self.__iter_merged(), *(self.__iter_records(run, self.SORTED_ENTRY.size) for run in runs))
+            self.__write_sorted(self.__height, merged)
+        finally:
+            for run in runs:
+                run.close()
+        self._clear()
+        self.__recent_offset = end
+        self.__recent_count = 0
+
+    def __drop_merged(self, height):
+        """ Rewrite the sorted file without the entries of the blocks from height on """
+        self.__write_sorted(height, (record for record in self.__iter_merged() if self.__entry(record)[0] < height))
+
+    def open(self, length) -> int:
+        """ Open the index files and drop the entries of blocks the chain does not have
+
+            Arguments:
+                :length: The number of blocks of the chain
+            :return: The height from which the blocks have to be passed to catch_up
+        """
+        self.__open_sorted()
+        open(self.path, mode='ab').close()
+        with open(self.path, mode='r+b') as file:
+            # A torn entry at the end and the entries of blocks the chain does not have anymore
+            size = os.fstat(file.fileno()).st_size
+            file.truncate(size - size % self.ENTRY.size)
+            file.truncate(self.__log_offset(file, length))
+            if self.merged_height > length:
+                self.__drop_merged(length)
+            start = self.merged_height
+            end = os.fstat(file.fileno()).st_size
+            if end > 0:
+                file.seek(end - self.ENTRY.size)
+                last_height = self.ENTRY.unpack(file.read(self.ENTRY.size))[0]
+                # The entries of the last block may be incomplete after a crash, it is indexed again
+                if last_height >= self.merged_height:
+                    file.truncate(self.__log_offset(file, last_height))
+                    start = last_height
+            self.__recent_offset = self.__log_offset(file, self.merged_height)
+            self.__recent_count = (os.fstat(file.fileno()).st_size - self.__recent_offset) // self.ENTRY.size
+        self.__height = start
+        return start
+
+    def catch_up(self, block):
+        """ Index the next of the blocks open() reported missing
+
+            The entries only go to FILE_NAME, finish_catch_up merges them at once,
+            so indexing a whole chain neither keeps it in memory nor merges over and over.
+        """
+        if self.__catch_up_file is None:
+            self.__catch_up_file = open(self.path, mode='ab')
+        encoded = self.encode_block(block)
+        self.__catch_up_file.write(encoded)
+        self.__recent_count += len(encoded) // self.ENTRY.size
+        self.__height = block.index + 1
+
+    def finish_catch_up(self):
+        """ Make the blocks passed to catch_up searchable, call it after open() even if none were missing """
+        if self.__catch_up_file is not None:
+            self.__catch_up_file.close()
+            self.__catch_up_file = None
+        self.__load_recent()
+
+    def __load_recent(self):
+        """ Keep the entries added since the last merge in memory, or merge them if there are too many """
+        if self.__recent_count > MERGE_EVERY:
+            self.__merge()
+            return
+        self._clear()
+        with open(self.path, mode='rb') as file:
+            file.seek(self.__recent_offset)
+            for entry in self.__iter_entries(file):
+                self._add_entry(entry)
+
+    def encode_block(self, block) -> bytes:
+        """ Pack the entries of a block without storing them
+
+            LazyChain encodes a block for every index before it stores the block,
+            so a block the index cannot hold (struct.error) leaves nothing behind.
+        """
+        return b''.join(self.ENTRY.pack(*entry) for entry in self._block_entries(block))
+
+    def add_block(self, block, encoded=None):
+        """ Index the block following the indexed ones
+
+            Arguments:
+                :block: The block
+                :encoded: The result of encode_block for it, if it was packed already
+        """
+        if encoded is None:
+            encoded = self.encode_block(block)
+        with open(self.path, mode='ab') as file:
+            file.write(encoded)
+        self.__height = block.index + 1
+        for entry in self.ENTRY.iter_unpack(encoded):
+            self._add_entry(entry)
+            self.__recent_count += 1
+        if self.__recent_count > MERGE_EVERY:
+            self.__merge()
+
+    def truncate(self, height):
+        """ Remove the entries of every block from height on """
+        if height >= self.__height:
+            return
+        if height < self.merged_height:
+            # A fork below the last merge, the sorted file is rewritten without the dropped entries
+            self.__drop_merged(height)
+            self._clear()
+            with open(self.path, mode='r+b') as file:
+                self.__recent_offset = self.__log_offset(file, height)
+                file.truncate(self.__recent_offset)
+            self.__recent_count = 0
+        else:
+            with open(self.path, mode='r+b') as file:
+                start = self.__log_offset(file, height)
+                file.seek(start)
+                dropped = list(self.__iter_entries(file))
+                file.truncate(start)
+            for entry in reversed(dropped):
+                self._remove_entry(entry)
+            self.__recent_count -= len(dropped)
+        self.__height = height
+
+    def close(self):
+        """ Unmap the sorted file """
+        if self.__sorted is not None:
+            self.__sorted.close()
+            self.__sorted = None
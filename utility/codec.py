@@ -0,0 +1,193 @@
+""" Provides a compact, versioned binary encoding for blocks and transactions
+
+Layout (all integers big endian):
+    blocks / transactions payload:  version (B) | count (I) | records
+    block:        index (q) | previous_hash (str) | timestamp (num) | proof (q) | count (I) | transactions
+    transaction:  sender (str) | recipient (str) | amount (num) | signature (str)
+    str:          kind (B) | length (H) | bytes   kind 0 = UTF-8 text, 1 = raw bytes of a lowercase hex string
+    num:          kind (B) | value              kind 0 = int (q), 1 = float (d)
+
+Keys, signatures and hashes are hex strings in JSON, here they are stored as raw
+bytes which halves their size. Ints and floats keep their type so hashes and
+proofs computed from a decoded block match the original.
+"""
+
+import struct
+from block import Block
+from transaction import Transaction
+
+FORMAT_VERSION = 1
+# Content type used on /chain and the broadcast endpoints for this encoding
+CONTENT_TYPE = 'application/x-blockchain'
+
+_TEXT = 0
+_HEX = 1
+_INT = 0
+_FLOAT = 1
+
+_HEADER = struct.Struct('>BI')
+_STR = struct.Struct('>BH')
+_KIND = struct.Struct('>B')
+_INT64 = struct.Struct('>q')
+_FLOAT64 = struct.Struct('>d')
+_COUNT = struct.Struct('>I')
+_BLOCK = struct.Struct('>q')
+# Longest string (in encoded bytes) a str field can hold
+MAX_STR_BYTES = 0xFFFF
+
+
+def _encode_str(value, out):
+    value = str(value)
+    kind = _TEXT
+    data = value.encode('utf8')
+    if len(value) % 2 == 0 and len(value) > 0:
+        try:
+            raw = bytes.fromhex(value)
+            # Only use the raw form if it turns back into exactly the same string
+            if raw.hex() == value:
+                kind, data = _HEX, raw
+        except ValueError:
+            pass
+    if len(data) > MAX_STR_BYTES:
+        raise ValueError('String too long to encode')
+    out.append(_STR.pack(kind, len(data)))
+    out.append(data)
+
+
+def encodable_str(value) -> bool:
+    """ Return whether value is a str this encoding can store """
+    if not isinstance(value, str):
+        return False
+    try:
+        # UnicodeEncodeError (a lone surrogate from JSON) is a ValueError as well
+        _encode_str(value, [])
+    except ValueError:
+        return False
+    return True
+
+
+def _decode_str(data, offset):
+    kind, length = _STR.unpack_from(data, offset)
+    offset += _STR.size
+    raw = data[offset:offset + length]
+    if len(raw) != length:
+        raise ValueError('Truncated string')
+    value = raw.hex() if kind == _HEX else raw.decode('utf8')
+    return value, offset + length
+
+
+def _encode_num(value, out):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError('Cannot encode {!r} as a number'.format(value))
+    if isinstance(value, int):
+        out.append(_KIND.pack(_INT))
+        out.append(_INT64.pack(value))
+    else:
+        out.append(_KIND.pack(_FLOAT))
+        out.append(_FLOAT64.pack(value))
+
+
+def _decode_num(data, offset):
+    kind = data[offset]
+    offset += 1
+    if kind == _INT:
+        return _INT64.unpack_from(data, offset)[0], offset + _INT64.size
+    return _FLOAT64.unpack_from(data, offset)[0], offset + _FLOAT64.size
+
+
+def _encode_transaction(transaction, out):
+    _encode_str(transaction.sender, out)
+    _encode_str(transaction.recipient, out)
+    _encode_num(transaction.amount, out)
+    _encode_str(transaction.signature, out)
+
+
+def _decode_transaction(data, offset):
+    sender, offset = _decode_str(data, offset)
+    recipient, offset = _decode_str(data, offset)
+    amount, offset = _decode_num(data, offset)
+    signature, offset = _decode_str(data, offset)
+    return Transaction(sender, recipient, signature, amount), offset
+
+
+def _encode_block(block, out):
+    out.append(_BLOCK.pack(block.index))
+    _encode_str(block.previous_hash, out)
+    _encode_num(block.timestamp, out)
+    out.append(_BLOCK.pack(block.proof))
+    out.append(_COUNT.pack(len(block.transactions)))
+    for tx in block.transactions:
+        _encode_transaction(tx, out)
+
+
+def _decode_block(data, offset):
+    index = _BLOCK.unpack_from(data, offset)[0]
+    offset += _BLOCK.size
+    previous_hash, offset = _decode_str(data, offset)
+    timestamp, offset = _decode_num(data, offset)
+    proof = _BLOCK.unpack_from(data, offset)[0]
+    offset += _BLOCK.size
+    count = _COUNT.unpack_from(data, offset)[0]
+    offset += _COUNT.size
+    transactions = []
+    for _ in range(count):
+        tx, offset = _decode_transaction(data, offset)
+        transactions.append(tx)
+    return Block(index, previous_hash, transactions, proof, timestamp), offset
+
+
+def encode_block(block) -> bytes:
+    """ Encode a single block without the version header (used for storage records) """
+    out = []
+    _encode_block(block, out)
+    return b''.join(out)
+
+
+def decode_block(data) -> Block:
+    """ Decode a single block written by encode_block """
+    try:
+        block, _ = _decode_block(data, 0)
+    except (struct.error, IndexError, UnicodeDecodeError) as error:
+        raise ValueError('Invalid block encoding') from error
+    return block
+
+
+def encode_blocks(blocks) -> bytes:
+    return b''.join(iter_encode_blocks(blocks))
+
+
+def iter_encode_blocks(blocks):
+    """ Yield the encode_blocks payload piece by piece, the header first and then one chunk per block """
+    yield _HEADER.pack(FORMAT_VERSION, len(blocks))
+    for block in blocks:
+        yield encode_block(block)
+
+
+def decode_blocks(data) -> list[Block]:
+    return _decode_list(data, _decode_block)
+
+
+def encode_transactions(transactions) -> bytes:
+    out = [_HEADER.pack(FORMAT_VERSION, len(transactions))]
+    for tx in transactions:
+        _encode_transaction(tx, out)
+    return b''.join(out)
+
+
+def decode_transactions(data) -> list[Transaction]:
+    return _decode_list(data, _decode_transaction)
+
+
+def _decode_list(data, decode_item):
+    try:
+        version, count = _HEADER.unpack_from(data, 0)
+        if version != FORMAT_VERSION:
+            raise ValueError('Unsupported encoding version {}'.format(version))
+        offset = _HEADER.size
+        items = []
+        for _ in range(count):
+            item, offset = decode_item(data, offset)
+            items.append(item)
+    except (struct.error, IndexError, UnicodeDecodeError) as error:
+        raise ValueError('Invalid encoding') from error
+    return items
@@ -0,0 +1,211 @@
+""" Provides a background queue which propagates transactions and blocks to peers """
+
+import itertools
+import queue
+import threading
+import time
+from utility import metrics
+
+# Number of threads delivering messages to peers
+GOSSIP_WORKERS = 4
+# How often a delivery is retried when the peer cannot be reached
+MAX_RETRIES = 5
+# Seconds to wait before the first retry, doubled for every further attempt
+RETRY_BASE_DELAY = 0.5
+# Maximum number of transactions sent to peers in one batch
+BATCH_SIZE = 100
+# Seconds a transaction waits for more transactions to join its batch
+BATCH_WINDOW = 0.2
+# Seconds close() gives the workers to deliver the messages still queued
+DRAIN_TIMEOUT = 5.0
+
+DELIVERY_SECONDS = metrics.timer('gossip_delivery_seconds', 'Time spent sending one broadcast to one peer', ['path'])
+DELIVERIES = metrics.counter('gossip_deliveries_total', 'Broadcasts sent to peers by outcome (status code or unreachable)', ['path', 'outcome'])
+DROPPED = metrics.counter('gossip_dropped_total', 'Broadcasts given up after the last retry')
+QUEUE_DEPTH = metrics.gauge('gossip_queue_depth', 'Broadcasts waiting to be sent')
+
+
+class GossipQueue:
+    """Delivers outbound messages to peers on worker threads
+
+    Every peer is always served by the same worker, so messages to one peer
+    arrive in the order they were queued. Deliveries to unreachable peers are
+    retried with exponential backoff. close() gives the workers a few seconds
+    to deliver what is queued, then stops them and the retry timers.
+
+    Attributes:
+        :peer_client: The PeerClient used to send the messages
+        :on_response: Called with (node, path, status) once a peer answered
+    """
+    def __init__(self, peer_client, on_response=None, workers=GOSSIP_WORKERS, max_retries=MAX_RETRIES, retry_base_delay=RETRY_BASE_DELAY):
+        self.peer_client = peer_client
+        self.on_response = on_response
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.__queues = [queue.Queue() for _ in range(workers)]
+        self.__lock = threading.Lock()
+        self.__waiting_retries = 0
+        self.__sent = 0
+        self.__dropped = 0
+        self.__retries = {}
+        self.__last_success = {}
+        # Retry timers that did not fire yet, by retry id
+        self.__timers = {}
+        self.__retry_ids = itertools.count()
+        self.__closed = False
+        QUEUE_DEPTH.set_function(lambda: sum(work_queue.qsize() for work_queue in self.__queues))
+        self.__workers = []
+        for number, work_queue in enumerate(self.__queues):
+            worker = threading.Thread(target=self.__work, args=(work_queue,), name='gossip-{}'.format(number), daemon=True)
+            worker.start()
+            self.__workers.append(worker)
+
+    def enqueue(self, nodes, path, payload):
+        """ Queue a message for every node and return immediately, nothing is queued after close() """
+        if self.__closed:
+            return
+        for node in nodes:
+            self.__put(node, path, payload, 0)
+
+    def close(self, timeout=None, drain_timeout=DRAIN_TIMEOUT):
+        """ Deliver the queued messages, then stop the workers and cancel the waiting retries
+
+            Messages still queued after drain_timeout are dropped, a delivery in
+            progress is finished first. Failed deliveries are not retried anymore.
+            Arguments:
+                :timeout: Seconds to wait for each worker, None to wait until it stopped
+                :drain_timeout: Seconds to wait for the queued messages to be delivered
+        """
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__closed = True
+            timers = list(self.__timers.values())
+            self.__timers.clear()
+            self.__waiting_retries = 0
+        for timer in timers:
+            timer.cancel()
+        if drain_timeout > 0:
+            # Queued behind the messages, a worker stops once it delivered all of its own
+            for work_queue in self.__queues:
+                work_queue.put(None)
+            deadline = time.monotonic() + drain_timeout
+            for worker in self.__workers:
+                if worker is not threading.current_thread():
+                    worker.join(max(deadline - time.monotonic(), 0))
+        for work_queue in self.__queues:
+            while True:
+                try:
+                    work_queue.get_nowait()
+                except queue.Empty:
+                    break
+                work_queue.task_done()
+            # Wakes the worker up and tells it to stop
+            work_queue.put(None)
+        for worker in self.__workers:
+            if worker is not threading.current_thread():
+                worker.join(timeout)
+
+    def __put(self, node, path, payload, attempt):
+        self.__queues[hash(node) % len(self.__queues)].put((node, path, payload, attempt))
+
+    def __work(self, work_queue):
+        while True:
+            message = work_queue.get()
+            if message is None:
+                work_queue.task_done()
+                return
+            node, path, payload, attempt = message
+            with DELIVERY_SECONDS.labels(path).time():
+                status = self.peer_client.post(node, path, payload)
+            DELIVERIES.labels(path, 'unreachable' if status is None else str(status)).inc()
+            if status is None:
+                self.__schedule_retry(node, path, payload, attempt)
+            else:
+                with self.__lock:
+                    self.__sent += 1
+                    self.__last_success[node] = time.time()
+                if self.on_response is not None:
+                    self.on_response(node, path, status)
+            work_queue.task_done()
+
+    def __schedule_retry(self, node, path, payload, attempt):
+        with self.__lock:
+            if attempt >= self.max_retries or self.__closed:
+                self.__dropped += 1
+                DROPPED.inc()
+                return
+            self.__retries[node] = self.__retries.get(node, 0) + 1
+            self.__waiting_retries += 1
+            retry_id = next(self.__retry_ids)
+            timer = threading.Timer(self.retry_base_delay * 2 ** attempt, self.__retry, args=(retry_id, node, path, payload, attempt + 1))
+            timer.daemon = True
+            self.__timers[retry_id] = timer
+        timer.start()
+
+    def __retry(self, retry_id, node, path, payload, attempt):
+        with self.__lock:
+            if self.__closed:
+                return
+            del self.__timers[retry_id]
+            self.__waiting_retries -= 1
+        self.__put(node, path, payload, attempt)
+
+    def stats(self):
+        """ Return queue depth, retry counts and the last successful delivery per peer """
+        with self.__lock:
+            return {
+                'queue_depth': sum(work_queue.qsize() for work_queue in self.__queues),
+                'waiting_retries': self.__waiting_retries,
+                'sent': self.__sent,
+                'dropped': self.__dropped,
+                'retries': dict(self.__retries),
+                'last_success': dict(self.__last_success),
+            }
+
+
+class TransactionBatcher:
+    """Groups outgoing transactions and hands them on as one batch
+
+    A batch is flushed once it holds batch_size transactions or batch_window
+    seconds after its first transaction was added, whichever comes first.
+    After close() every transaction is handed on right away.
+
+    Attributes:
+        :send: Called with the list of transactions of every flushed batch
+    """
+    def __init__(self, send, batch_size=BATCH_SIZE, batch_window=BATCH_WINDOW):
+        self.send = send
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.__pending = []
+        self.__timer = None
+        self.__closed = False
+        self.__lock = threading.Lock()
+
+    def add(self, transaction):
+        with self.__lock:
+            self.__pending.append(transaction)
+            if len(self.__pending) < self.batch_size and not self.__closed:
+                if self.__timer is None:
+                    self.__timer = threading.Timer(self.batch_window, self.flush)
+                    self.__timer.daemon = True
+                    self.__timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        with self.__lock:
+            batch = self.__pending
+            self.__pending = []
+            if self.__timer is not None:
+                self.__timer.cancel()
+                self.__timer = None
+        if len(batch) > 0:
+            self.send(batch)
+
+    def close(self):
+        """ Hand on the pending batch and stop waiting for more transactions """
+        with self.__lock:
+            self.__closed = True
+        self.flush()
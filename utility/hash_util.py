@@ -1,6 +1,10 @@
 import hashlib as hl
+import time
 from block import Block
-import json
+from utility import metrics
+
+# Only hashes that are computed are timed, memoized lookups stay free
+HASH_BLOCK_SECONDS = metrics.timer('blockchain_hash_block_seconds', 'Time spent computing block hashes (memoized lookups excluded)')
 
 # Export only the functions listed in the list
 # __all__ = ['hash_string_256', 'hash_block']
@@ -16,10 +20,12 @@ def hash_string_256(value) -> str:
 def hash_block(block: Block) -> str:
     """
     Hashes a block and returns a string representation of the block
+    The hash is computed once and memoized on the block, blocks are not modified after creation
     :param block:
     :return: string representation of the block
     """
-    # Convert Block class to a dict data type + copy the block instance
-    hashable_block = block.__dict__.copy()
-    hashable_block['transactions'] =  [tx.to_ordered_dict() for tx in hashable_block['transactions']]
-    return hash_string_256(json.dumps(hashable_block, sort_keys=True).encode())
\ No newline at end of file
+    if block._hash is None:
+        start = time.perf_counter()
+        block._hash = hash_string_256(block.canonical_bytes())
+        HASH_BLOCK_SECONDS.observe(time.perf_counter() - start)
+    return block._hash
\ No newline at end of file
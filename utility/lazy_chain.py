@@ -0,0 +1,196 @@
+""" Provides a list-like view of the stored chain which decodes blocks on demand """
+
+import threading
+from collections import OrderedDict
+from typing import Optional
+from block import Block
+from utility.tx_index import TransactionIndex
+from utility.address_index import AddressIndex
+
+# Number of decoded blocks kept in memory
+BLOCK_CACHE_SIZE = 1000
+
+
+class BlockStream:
+    """An iterator over a range of blocks which knows its length before the first block is read
+
+    The binary codec writes the number of blocks ahead of them, so a stream must
+    know it up front. If the stream ends early (the chain was replaced while it
+    was read), fewer blocks than len() are yielded.
+
+    Attributes:
+        :count: Number of blocks in the range when the stream was opened
+    """
+    def __init__(self, count, blocks):
+        self.count = count
+        self.__blocks = blocks
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return self.__blocks
+
+
+class ChainView:
+    """A read-only view of a stored chain: its length, the hash at a height and the blocks in order
+
+    Unlike LazyChain it keeps no cache and opens no index, so nothing is written
+    and it can be used on the data directory of a running node (see snapshots.py).
+
+    Attributes:
+        :storage: The ChainStorage holding the blocks, usually opened read_only
+    """
+    def __init__(self, storage):
+        self.storage = storage
+        self.__headers = storage.load_headers()
+
+    def __len__(self):
+        return len(self.__headers)
+
+    def hash_at(self, height) -> str:
+        """ Return the hash of the block at height without decoding it """
+        return self.__headers[height].hash
+
+    def iter_blocks(self, from_height=0, end=None):
+        """ Yield the blocks from from_height up to end (default: the tip) one at a time """
+        for header in self.__headers[from_height:end]:
+            yield self.storage.read_block(header)
+
+
+class LazyChain:
+    """The blockchain as a sequence backed by ChainStorage
+
+    Opening it only reads the header index. Blocks are read from their segment
+    when they are first accessed and the most recently used ones are kept in an
+    LRU cache, so the tip and the blocks around it cost nothing after the first
+    access. Appending or truncating writes through to the storage.
+
+    Reads may come from several threads at once (the Blockchain read lock), the
+    cache has its own lock. Appending and truncating need the caller to exclude
+    every other access.
+
+    Blocks can be looked up by hash in constant time, confirmed transactions by
+    id and the history of every address through indexes which stay on disk (see
+    utility/block_index.py). All indexes are kept up to date on append and truncate.
+
+    Attributes:
+        :storage: The ChainStorage holding the blocks
+        :cache_size: Maximum number of decoded blocks kept in memory
+        :transactions: The TransactionIndex of all confirmed transactions
+        :addresses: The AddressIndex with the history of every address
+    """
+    def __init__(self, storage, cache_size=BLOCK_CACHE_SIZE):
+        self.storage = storage
+        self.cache_size = cache_size
+        self.__headers = storage.load_headers()
+        self.__heights = {header.hash: header.index for header in self.__headers}
+        self.__cache = OrderedDict()
+        self.__cache_lock = threading.Lock()
+        self.transactions = TransactionIndex(storage.directory)
+        self.addresses = AddressIndex(storage.directory)
+        self.__indexes = [self.transactions, self.addresses]
+        starts = [index.open(len(self.__headers)) for index in self.__indexes]
+        # The blocks missing from any index are read once for all of them
+        first = min(starts)
+        for height, block in enumerate(self.iter_blocks(first), first):
+            for index, start in zip(self.__indexes, starts):
+                if height >= start:
+                    index.catch_up(block)
+        for index in self.__indexes:
+            index.finish_catch_up()
+
+    def __len__(self):
+        return len(self.__headers)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self.__block(height) for height in range(*key.indices(len(self.__headers)))]
+        if key < 0:
+            key += len(self.__headers)
+        if key < 0 or key >= len(self.__headers):
+            raise IndexError('block index out of range')
+        return self.__block(key)
+
+    def __iter__(self):
+        return self.iter_blocks()
+
+    def iter_blocks(self, from_height=0, end=None):
+        """ Yield the blocks from from_height up to end (default: the tip) one at a time
+
+            Blocks read for a scan are not added to the cache, so a full scan neither
+            holds the whole chain nor evicts the blocks around the tip.
+        """
+        end = len(self.__headers) if end is None else min(end, len(self.__headers))
+        for height in range(from_height, end):
+            with self.__cache_lock:
+                block = self.__cache.get(height)
+            yield block if block is not None else self.storage.read_block(self.__headers[height])
+
+    def __block(self, height) -> Block:
+        with self.__cache_lock:
+            block = self.__cache.get(height)
+            if block is not None:
+                self.__cache.move_to_end(height)
+                return block
+        # Read outside the lock, two threads missing the same block both decode it
+        block = self.storage.read_block(self.__headers[height])
+        self.__remember(height, block)
+        return block
+
+    def __remember(self, height, block):
+        with self.__cache_lock:
+            self.__cache[height] = block
+            self.__cache.move_to_end(height)
+            while len(self.__cache) > self.cache_size:
+                self.__cache.popitem(last=False)
+
+    def hash_at(self, height) -> str:
+        """ Return the hash of the block at height without decoding it """
+        return self.__headers[height].hash
+
+    def height_of(self, block_hash) -> Optional[int]:
+        """ Return the height of the block with the given hash, None if it is not in the chain """
+        return self.__heights.get(block_hash)
+
+    def locate_transaction(self, transaction_id) -> Optional[tuple]:
+        """ Return (height, position) of a confirmed transaction, None if it is not in the chain """
+        return self.transactions.locate(transaction_id)
+
+    def append(self, block):
+        """ Store a block at the tip """
+        # Packed before anything is written, a block an index cannot hold is not stored at all
+        encoded = [index.encode_block(block) for index in self.__indexes]
+        header = self.storage.append_block(block)
+        self.__headers.append(header)
+        self.__heights[header.hash] = header.index
+        self.__remember(header.index, block)
+        for index, entries in zip(self.__indexes, encoded):
+            index.add_block(block, entries)
+
+    def truncate(self, height):
+        """ Drop every block with an index of height or above """
+        if height >= len(self.__headers):
+            return
+        for index in self.__indexes:
+            index.truncate(height)
+        self.storage.truncate(height)
+        for header in self.__headers[height:]:
+            del self.__heights[header.hash]
+        del self.__headers[height:]
+        with self.__cache_lock:
+            for cached_height in [cached_height for cached_height in self.__cache if cached_height >= height]:
+                del self.__cache[cached_height]
+
+    def replace_from(self, height, blocks):
+        """ Replace the blocks from height on with blocks and flush them to disk """
+        self.truncate(height)
+        for block in blocks:
+            self.append(block)
+        self.storage.sync()
+
+    def close(self):
+        """ Close the indexes and the storage """
+        for index in self.__indexes:
+            index.close()
+        self.storage.close()
@@ -0,0 +1,113 @@
+""" Provides the pool of open (not yet mined) transactions """
+
+import itertools
+from typing import Optional
+
+# Maximum number of open transactions, the oldest ones are evicted beyond it
+MAX_MEMPOOL_SIZE = 10000
+# Maximum number of open transactions per sender (None for no limit)
+MAX_PENDING_PER_SENDER = None
+
+
+class Mempool:
+    """Open transactions keyed by their transaction_id, in the order they arrived
+
+    Membership checks, duplicate detection and removal of mined transactions
+    are dict operations, and the amount every sender has pending is kept up to date.
+    Every add and remove is also recorded, so the storage only has to write what
+    changed since the last take_changes() instead of the whole pool.
+
+    Attributes:
+        :max_size: Maximum number of transactions, adding beyond it evicts the oldest one
+        :max_per_sender: Maximum number of transactions per sender, more are rejected (None for no limit)
+        :evictions: Number of transactions evicted because the pool was full
+    """
+    def __init__(self, transactions=(), max_size=MAX_MEMPOOL_SIZE, max_per_sender=MAX_PENDING_PER_SENDER):
+        self.max_size = max_size
+        self.max_per_sender = max_per_sender
+        self.evictions = 0
+        self.__transactions = {}
+        self.__pending_spend = {}
+        self.__pending_count = {}
+        self.__changes = []
+        for tx in transactions:
+            self.add(tx)
+
+    def __len__(self):
+        return len(self.__transactions)
+
+    def __iter__(self):
+        return iter(list(self.__transactions.values()))
+
+    def __contains__(self, transaction_id):
+        return transaction_id in self.__transactions
+
+    def get(self, transaction_id) -> Optional[object]:
+        """ Return the open transaction with the given id, None if it is not in the pool """
+        return self.__transactions.get(transaction_id)
+
+    def add(self, transaction) -> bool:
+        """ Add a transaction, returns False if it is already in the pool or its sender reached max_per_sender """
+        transaction_id = transaction.transaction_id
+        if transaction_id in self.__transactions:
+            return False
+        if self.max_per_sender is not None and self.__pending_count.get(transaction.sender, 0) >= self.max_per_sender:
+            return False
+        while len(self.__transactions) >= self.max_size:
+            # dicts keep insertion order, the first key is the oldest transaction
+            self.remove(next(iter(self.__transactions)))
+            self.evictions += 1
+        self.__transactions[transaction_id] = transaction
+        self.__pending_spend[transaction.sender] = self.__pending_spend.get(transaction.sender, 0) + transaction.amount
+        self.__pending_count[transaction.sender] = self.__pending_count.get(transaction.sender, 0) + 1
+        self.__changes.append(('add', transaction))
+        return True
+
+    def remove(self, transaction_id) -> Optional[object]:
+        """ Remove a transaction by id and return it (None if it was not in the pool) """
+        transaction = self.__transactions.pop(transaction_id, None)
+        if transaction is not None:
+            count = self.__pending_count[transaction.sender] - 1
+            if count:
+                self.__pending_spend[transaction.sender] -= transaction.amount
+                self.__pending_count[transaction.sender] = count
+            else:
+                del self.__pending_spend[transaction.sender]
+                del self.__pending_count[transaction.sender]
+            self.__changes.append(('remove', transaction_id))
+        return transaction
+
+    def remove_many(self, transaction_ids) -> list:
+        """ Remove all given transaction ids, e.g. the transactions of a new block """
+        removed = []
+        for transaction_id in transaction_ids:
+            transaction = self.remove(transaction_id)
+            if transaction is not None:
+                removed.append(transaction)
+        return removed
+
+    def clear(self):
+        """ Remove every transaction, the recorded changes are dropped too so the whole pool has to be saved afterwards """
+        self.__transactions = {}
+        self.__pending_spend = {}
+        self.__pending_count = {}
+        self.__changes = []
+
+    def take_changes(self) -> list:
+        """ Return the ('add', transaction) and ('remove', transaction_id) changes since the last call, oldest first """
+        changes, self.__changes = self.__changes, []
+        return changes
+
+    def transactions(self) -> list:
+        """ Return the open transactions in arrival order """
+        return list(self.__transactions.values())
+
+    def template(self, max_count=None) -> list:
+        """ Return the oldest max_count transactions to be mined into the next block """
+        if max_count is None or max_count >= len(self.__transactions):
+            return self.transactions()
+        return list(itertools.islice(self.__transactions.values(), max_count))
+
+    def pending_spend(self, sender):
+        """ Return the amount sender spends in open transactions """
+        return self.__pending_spend.get(sender, 0)
@@ -0,0 +1,174 @@
+""" Provides counters, gauges and timers rendered in the Prometheus text format
+
+Metrics are created once at module level where they are used, e.g.
+
+    BLOCKS = metrics.counter('blockchain_blocks_added_total', 'Blocks appended to the chain')
+    BLOCKS.inc()
+
+and GET /metrics returns REGISTRY.render(). Recording a value is a lock and an
+addition, cheap enough for the hot paths. Values that already exist elsewhere
+(chain height, mempool depth, cache statistics) are read when /metrics is
+requested through a function instead of being updated on every change.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+SUMMARY = 'summary'
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ''
+    pairs = ('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Child:
+    """The value of a metric for one combination of label values"""
+    __slots__ = ('count', 'total', '_lock')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.total += amount
+
+    def set(self, value):
+        with self._lock:
+            self.total = value
+
+    def observe(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+
+    @contextmanager
+    def time(self):
+        """ Observe the seconds the with block took """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Metric:
+    """A counter, gauge or summary (count and sum of observed seconds)
+
+    Without label names the metric records values itself (inc, set, observe,
+    time). With label names, labels(*values) returns the child to record on.
+
+    Attributes:
+        :name: The metric name
+        :help: One line description
+        :kind: counter, gauge or summary
+        :label_names: Names of the labels, in the order labels() takes their values
+        :function: Called at render time for the value, instead of recorded values
+    """
+    def __init__(self, name, help, kind, label_names=(), function=None):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.label_names = tuple(label_names)
+        self.function = function
+        self.__children = {}
+        self.__lock = threading.Lock()
+        if not self.label_names:
+            self.__children[()] = _Child()
+
+    def labels(self, *values) -> _Child:
+        child = self.__children.get(values)
+        if child is None:
+            with self.__lock:
+                child = self.__children.setdefault(values, _Child())
+        return child
+
+    def inc(self, amount=1):
+        self.__children[()].inc(amount)
+
+    def set(self, value):
+        self.__children[()].set(value)
+
+    def observe(self, seconds):
+        self.__children[()].observe(seconds)
+
+    def time(self):
+        return self.__children[()].time()
+
+    def set_function(self, function):
+        """ Read the value from function() whenever the metrics are rendered """
+        self.function = function
+
+    def render(self) -> list:
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception:
+                # A gauge must not break the whole page, e.g. while the chain is being reopened
+                return lines
+            lines.append('{} {}'.format(self.name, _format_value(value)))
+            return lines
+        with self.__lock:
+            children = sorted(self.__children.items())
+        for values, child in children:
+            labels = _format_labels(self.label_names, values)
+            if self.kind == SUMMARY:
+                lines.append('{}_count{} {}'.format(self.name, labels, child.count))
+                lines.append('{}_sum{} {}'.format(self.name, labels, _format_value(child.total)))
+            else:
+                lines.append('{}{} {}'.format(self.name, labels, _format_value(child.total)))
+        return lines
+
+
+class Registry:
+    """All metrics of the process, in the order they were created"""
+    def __init__(self):
+        self.__metrics = {}
+        self.__lock = threading.Lock()
+
+    def register(self, metric) -> Metric:
+        with self.__lock:
+            if metric.name in self.__metrics:
+                raise ValueError('Metric {} already exists'.format(metric.name))
+            self.__metrics[metric.name] = metric
+        return metric
+
+    def get(self, name):
+        return self.__metrics.get(name)
+
+    def render(self) -> str:
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+        return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+
+REGISTRY = Registry()
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def counter(name, help, labels=(), function=None) -> Metric:
+    return REGISTRY.register(Metric(name, help, COUNTER, labels, function))
+
+
+def gauge(name, help, labels=(), function=None) -> Metric:
+    return REGISTRY.register(Metric(name, help, GAUGE, labels, function))
+
+
+def timer(name, help, labels=()) -> Metric:
+    """ A summary of durations, name should end in _seconds """
+    return REGISTRY.register(Metric(name, help, SUMMARY, labels))
@@ -0,0 +1,174 @@
+""" Provides a multiprocess proof of work search """
+
+import hashlib as hl
+import os
+import threading
+import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+from utility import metrics
+from utility.process_pool import pool_context, exit_with_parent
+from utility.verification import Verification
+
+# Number of nonces handed to a worker at once
+CHUNK_SIZE = 5000
+# How often (in nonces) a worker checks whether it should stop
+CHECK_EVERY = 256
+# Marker for "no proof found yet" in the shared found value
+NOT_FOUND = 2 ** 63 - 1
+
+POW_SECONDS = metrics.timer('blockchain_pow_seconds', 'Time spent searching proofs of work', ['result'])
+POW_NONCES = metrics.counter('blockchain_pow_nonces_total', 'Proofs tried by proof of work searches')
+POW_HASH_RATE = metrics.gauge('blockchain_pow_hash_rate', 'Proofs tried per second by the last proof of work search')
+
+# Shared state of a worker process, set up by _init_worker
+_found = None
+_abort = None
+
+
+def _init_worker(found, abort):
+    global _found, _abort
+    _found = found
+    _abort = abort
+    exit_with_parent()
+
+
+def _search_range(prefix: bytes, start: int, stop: int) -> Optional[int]:
+    """
+    Search the nonces in [start, stop) for a valid proof
+    Stops early when mining was cancelled or another worker already found a smaller proof
+    :return: the smallest valid proof in the range or None
+    """
+    midstate = hl.sha256(prefix)
+    for proof in range(start, stop):
+        if proof % CHECK_EVERY == 0 and (_abort.is_set() or _found.value < start):
+            return None
+        if Verification.valid_proof_from(midstate, proof):
+            with _found.get_lock():
+                if proof < _found.value:
+                    _found.value = proof
+            return proof
+    return None
+
+
+class Miner:
+    """Searches proofs of work by splitting the nonce space across a process pool
+
+    The result is always the smallest valid proof, the same one the single
+    threaded loop over Verification.valid_proof would return. The pool is
+    started by the first search and reused by the later ones until close().
+
+    cancel() only stops the search running at that moment. A caller which reads
+    generation before it decides to search and passes it to proof_of_work also
+    has the cancels between the two stop its search.
+
+    Attributes:
+        :workers: The number of worker processes (1 searches in the calling process)
+        :chunk_size: The number of nonces handed to a worker at once
+        :nonces_tried: The number of proofs the current (or last) search has tried so far
+    """
+    def __init__(self, workers=None, chunk_size=CHUNK_SIZE):
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.nonces_tried = 0
+        self.__context = pool_context()
+        self.__abort = self.__context.Event()
+        # Smallest proof found by the workers of the current search, shared with them when the pool starts
+        self.__found = self.__context.Value('q', NOT_FOUND)
+        self.__pool = None
+        self.__shutdown_pool = None
+        # One search at a time, concurrent searches would compete for the same cores and abort flag
+        self.__lock = threading.Lock()
+        self.__generation = 0
+        self.__generation_lock = threading.Lock()
+
+    @property
+    def generation(self) -> int:
+        """ The number of cancel() calls so far """
+        return self.__generation
+
+    def cancel(self):
+        """ Stop a running search, proof_of_work returns None """
+        # Counted before the flag is set, a search clearing the flag meanwhile sees the new generation
+        with self.__generation_lock:
+            self.__generation += 1
+        self.__abort.set()
+
+    def close(self):
+        """ Stop a running search and the worker processes """
+        self.cancel()
+        with self.__lock:
+            if self.__pool is not None:
+                self.__shutdown_pool()
+            self.__pool = None
+
+    def proof_of_work(self, transactions, last_hash, generation=None) -> Optional[int]:
+        """
+        Find the smallest proof for the given transactions and hash of the last block
+        :param transactions: The transactions of the block to be mined (without the reward)
+        :param last_hash: The hash of the current last block
+        :param generation: The generation read before last_hash, a cancel() after that stops the search even if it came before this call
+        :return: the proof or None if the search was cancelled
+        """
+        with self.__lock:
+            start = time.perf_counter()
+            proof = self.__search(transactions, last_hash, generation)
+            seconds = time.perf_counter() - start
+            nonces_tried = self.nonces_tried
+        POW_SECONDS.labels('found' if proof is not None else 'cancelled').observe(seconds)
+        POW_NONCES.inc(nonces_tried)
+        if seconds > 0:
+            POW_HASH_RATE.set(nonces_tried / seconds)
+        return proof
+
+    def __search(self, transactions, last_hash, generation) -> Optional[int]:
+        self.__abort.clear()
+        self.nonces_tried = 0
+        # Checked after the clear, a cancel() in between is either counted here or sets the flag again
+        if generation is not None and generation != self.__generation:
+            return None
+        # The serialized transactions and hash are the same for every guess, build them once
+        prefix = Verification.proof_prefix(transactions, last_hash)
+        if self.workers == 1:
+            return self.__search_inline(prefix)
+
+        if self.__pool is None:
+            self.__pool = ProcessPoolExecutor(self.workers, mp_context=self.__context, initializer=_init_worker, initargs=(self.__found, self.__abort))
+            # A Miner dropped without close() still waits for its workers, they share found and abort with it
+            self.__shutdown_pool = weakref.finalize(self, self.__pool.shutdown, cancel_futures=True)
+        self.__found.value = NOT_FOUND
+        start = 0
+        while not self.__abort.is_set():
+            stop = start + self.chunk_size * self.workers
+            chunk_starts = range(start, stop, self.chunk_size)
+            try:
+                # Every range of the round is finished before the next search resets found
+                proofs = list(self.__pool.map(_search_range, [prefix] * len(chunk_starts), chunk_starts, [chunk_start + self.chunk_size for chunk_start in chunk_starts]))
+            except BrokenProcessPool:
+                # A worker process died, the next search starts a new pool
+                self.__shutdown_pool()
+                self.__pool = None
+                raise
+            # Results come back in nonce order, so the first hit is the smallest proof
+            for proof in proofs:
+                if proof is not None:
+                    self.nonces_tried = proof + 1
+                    return proof
+            start = stop
+            # Workers do not report their progress, count whole rounds
+            self.nonces_tried = stop
+        return None
+
+    def __search_inline(self, prefix: bytes) -> Optional[int]:
+        midstate = hl.sha256(prefix)
+        proof = 0
+        while not Verification.valid_proof_from(midstate, proof):
+            proof += 1
+            if proof % CHECK_EVERY == 0:
+                self.nonces_tried = proof
+                if self.__abort.is_set():
+                    return None
+        self.nonces_tried = proof + 1
+        return proof
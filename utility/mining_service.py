@@ -0,0 +1,169 @@
+""" Provides background mining jobs so a request does not wait for the proof of work """
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional
+from utility.hash_util import hash_block
+
+# Number of finished jobs whose status can still be looked up
+JOB_HISTORY_SIZE = 100
+
+RUNNING = 'running'
+MINED = 'mined'
+CANCELLED = 'cancelled'
+ABORTED = 'aborted'
+FAILED = 'failed'
+
+
+class MiningJob:
+    """The status of one background mining job
+
+    Attributes:
+        :id: The job id handed out by POST /mine
+        :continuous: Whether the job keeps mining block after block until it is cancelled
+        :state: running, mined, cancelled, aborted (a competing block won) or failed
+        :blocks: index and hash of every block the job mined
+        :aborts: Number of searches stopped because a competing block was added
+        :nonces_tried: Number of proofs tried by finished searches
+        :message: Why the job stopped, if it did not simply mine its block
+    """
+    def __init__(self, continuous=False):
+        self.id = uuid.uuid4().hex
+        self.continuous = continuous
+        self.state = RUNNING
+        self.blocks = []
+        self.aborts = 0
+        self.nonces_tried = 0
+        self.message = None
+        self.started = time.time()
+        self.finished = None
+        self.cancel_requested = False
+
+    def to_dict(self, current_nonces=0) -> dict:
+        nonces_tried = self.nonces_tried + current_nonces
+        seconds = (self.finished or time.time()) - self.started
+        return {
+            'id': self.id,
+            'state': self.state,
+            'continuous': self.continuous,
+            'started': self.started,
+            'finished': self.finished,
+            'blocks': list(self.blocks),
+            'aborts': self.aborts,
+            'nonces_tried': nonces_tried,
+            'hash_rate': nonces_tried / seconds if seconds > 0 else 0,
+            'message': self.message,
+        }
+
+
+class MiningService:
+    """Runs mining jobs of a Blockchain on a background thread, one job at a time
+
+    A competing block added through Blockchain.add_block cancels the running
+    search (Miner.cancel). A single job then ends as aborted, a continuous job
+    starts over on top of the new block.
+
+    Attributes:
+        :blockchain: The Blockchain whose mine_block is called
+    """
+    def __init__(self, blockchain):
+        self.blockchain = blockchain
+        self.__jobs = OrderedDict()
+        self.__current = None
+        self.__worker = None
+        self.__lock = threading.Lock()
+
+    def start(self, continuous=False) -> tuple:
+        """ Start a job unless one is running
+
+            :return: (job, started) with the running job and False if there already was one
+        """
+        with self.__lock:
+            if self.__current is not None:
+                return self.__current, False
+            job = MiningJob(continuous)
+            self.__current = job
+            self.__jobs[job.id] = job
+            while len(self.__jobs) > JOB_HISTORY_SIZE:
+                self.__jobs.popitem(last=False)
+            self.__worker = threading.Thread(target=self.__run, args=(job,), name='mining-{}'.format(job.id[:8]), daemon=True)
+            self.__worker.start()
+        return job, True
+
+    def get(self, job_id) -> Optional[dict]:
+        """ Return the status of a job, None if the id is unknown """
+        with self.__lock:
+            job = self.__jobs.get(job_id)
+            if job is None:
+                return None
+            current_nonces = self.blockchain.miner.nonces_tried if job is self.__current else 0
+            return job.to_dict(current_nonces)
+
+    def cancel(self, job_id) -> Optional[dict]:
+        """ Stop a job, returns its status or None if the id is unknown """
+        with self.__lock:
+            job = self.__jobs.get(job_id)
+            if job is None:
+                return None
+            if job is self.__current:
+                job.cancel_requested = True
+                self.blockchain.miner.cancel()
+        return self.get(job_id)
+
+    def stop(self, wait=False):
+        """ Cancel the running job, if any
+
+            Arguments:
+                :wait: Also wait until the job thread has stopped, e.g. before the blockchain is closed
+        """
+        with self.__lock:
+            job = self.__current
+            worker = self.__worker
+        if job is not None:
+            self.cancel(job.id)
+        if wait and worker is not None and worker is not threading.current_thread():
+            worker.join()
+
+    def __run(self, job):
+        try:
+            while True:
+                # Read before the checks, a cancel (or competing block) from now on stops this round's search
+                generation = self.blockchain.miner.generation
+                if job.cancel_requested:
+                    self.__finish(job, CANCELLED)
+                    return
+                if self.blockchain.resolve_conflicts:
+                    self.__finish(job, FAILED, 'Resolving conflicts first, block not added')
+                    return
+                tip = hash_block(self.blockchain.get_last_blockchain_value())
+                block = self.blockchain.mine_block(generation)
+                with self.__lock:
+                    job.nonces_tried += self.blockchain.miner.nonces_tried
+                if block is not None:
+                    job.blocks.append({'index': block.index, 'hash': hash_block(block)})
+                    if not job.continuous:
+                        self.__finish(job, MINED)
+                        return
+                elif job.cancel_requested:
+                    self.__finish(job, CANCELLED)
+                    return
+                elif hash_block(self.blockchain.get_last_blockchain_value()) != tip:
+                    job.aborts += 1
+                    if not job.continuous:
+                        self.__finish(job, ABORTED, 'A competing block was added first')
+                        return
+                else:
+                    self.__finish(job, FAILED, 'Adding a block failed')
+                    return
+        except Exception as error:
+            self.__finish(job, FAILED, str(error))
+
+    def __finish(self, job, state, message=None):
+        with self.__lock:
+            job.state = state
+            job.message = message
+            job.finished = time.time()
+            if self.__current is job:
+                self.__current = None
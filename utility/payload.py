@@ -0,0 +1,35 @@
+""" Provides the request and response bodies shared by node.py and async_node.py """
+
+import json
+from utility import codec
+
+
+def decode_payload(content_type, body, decode_binary):
+    """
+    Decode a request body, bodies sent with the binary codec content type are decoded by decode_binary, anything else as JSON
+    :param content_type: The mimetype of the request
+    :param body: The raw request body
+    :param decode_binary: Turns a binary codec body into the same values the JSON body would have
+    :return: the values or None if the body is empty or cannot be decoded
+    """
+    if content_type == codec.CONTENT_TYPE:
+        try:
+            return decode_binary(body)
+        except (ValueError, IndexError):
+            return None
+    if not body:
+        return None
+    try:
+        return json.loads(body)
+    except ValueError:
+        return None
+
+
+def stream_json_blocks(blocks):
+    """Yield a JSON array of blocks one block at a time"""
+    yield '['
+    for position, block in enumerate(blocks):
+        if position > 0:
+            yield ','
+        yield json.dumps(block.to_dict())
+    yield ']'
@@ -0,0 +1,77 @@
+""" Provides concurrent HTTP requests to peer nodes """
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+import requests
+from requests.adapters import HTTPAdapter
+from utility import codec
+
+# Seconds to wait for a peer to connect and respond
+REQUEST_TIMEOUT = 5
+# Maximum number of requests to peers in flight at the same time
+MAX_PARALLEL_REQUESTS = 16
+
+
+class PeerClient:
+    """Sends requests to peer nodes over pooled keep-alive connections
+
+    Requests to all peers (get_all) run concurrently, bounded by max_parallel, and
+    every request has a timeout so one slow node cannot hold up the others.
+
+    Attributes:
+        :timeout: Seconds to wait for each request
+        :max_parallel: Maximum number of concurrent requests
+    """
+    def __init__(self, timeout=REQUEST_TIMEOUT, max_parallel=MAX_PARALLEL_REQUESTS):
+        self.timeout = timeout
+        self.max_parallel = max_parallel
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_parallel, pool_maxsize=max_parallel)
+        self.session.mount('http://', adapter)
+        self.__executor = ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix='peer-client')
+
+    def post(self, node, path, payload) -> Optional[int]:
+        """ POST a payload to one peer, bytes are sent with the binary codec content type, anything else as JSON
+
+            :return: the status code or None if the peer could not be reached
+        """
+        try:
+            url = 'http://{}{}'.format(node, path)
+            if isinstance(payload, bytes):
+                response = self.session.post(url, data=payload, headers={'Content-Type': codec.CONTENT_TYPE}, timeout=self.timeout)
+            else:
+                response = self.session.post(url, json=payload, timeout=self.timeout)
+            return response.status_code
+        except requests.exceptions.RequestException:
+            return None
+
+    def get(self, node, path, params=None, binary=False):
+        """ GET a path from one peer, errors are raised to the caller
+
+            :return: the decoded JSON, or the raw bytes if binary was asked for and the peer supports it
+        """
+        headers = {'Accept': '{}, application/json;q=0.5'.format(codec.CONTENT_TYPE)} if binary else None
+        response = self.session.get('http://{}{}'.format(node, path), params=params, headers=headers, timeout=self.timeout)
+        response.raise_for_status()
+        if binary and response.headers.get('Content-Type', '').startswith(codec.CONTENT_TYPE):
+            return response.content
+        return response.json()
+
+    def get_all(self, nodes, path, params=None) -> dict:
+        """ GET a path from all nodes concurrently
+
+            :return: dict of node -> decoded JSON (None for nodes that failed)
+        """
+        futures = {node: self.__executor.submit(self.__get_or_none, node, path, params) for node in nodes}
+        return {node: future.result() for node, future in futures.items()}
+
+    def __get_or_none(self, node, path, params):
+        try:
+            return self.get(node, path, params)
+        except (requests.exceptions.RequestException, ValueError):
+            return None
+
+    def close(self):
+        """ Close the pooled connections and stop the threads of get_all """
+        self.__executor.shutdown(wait=False)
+        self.session.close()
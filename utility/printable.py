@@ -1,5 +1,7 @@
 class Printable:
+    # No per-instance __dict__, subclasses declare their attributes in __slots__
+    __slots__ = ()
 
     # Define what is outputted when print this class object
     def __repr__(self):
-        return str(self.__dict__)
\ No newline at end of file
+        return str(self.to_dict())
@@ -0,0 +1,43 @@
+""" Provides how worker process pools are started and tied to the process that started them """
+
+import multiprocessing
+import os
+import threading
+import time
+
+# Seconds between two checks of a worker whether the process that started its pool still runs
+PARENT_CHECK_INTERVAL = 1.0
+
+
+def pool_context():
+    """ Return a forkserver context where the platform has one, spawn otherwise
+
+        The nodes serve requests and deliver gossip on threads, forking such a
+        process can copy a lock one of them holds into the child. Workers started
+        through forkserver or spawn begin from a fresh process instead. Starting
+        them is slower, so pools are created once and reused.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def exit_with_parent():
+    """ Pool initializer which ends the worker once the process that started the pool is gone
+
+        Idle workers wait for tasks forever, the workers of a node killed before
+        it closed its pools would keep running (and keep the forkserver alive).
+    """
+    parent = multiprocessing.parent_process()
+    if parent is not None:
+        threading.Thread(target=_watch_parent, args=(parent.pid,), name='watch-parent', daemon=True).start()
+
+
+def _watch_parent(pid):
+    while True:
+        time.sleep(PARENT_CHECK_INTERVAL)
+        try:
+            os.kill(pid, 0)
+        except (ProcessLookupError, PermissionError):
+            # PermissionError: the pid was reused by a process of another user
+            os._exit(0)
@@ -0,0 +1,105 @@
+""" Provides a reader-writer lock and decorators to guard methods with it """
+
+import functools
+import threading
+from contextlib import contextmanager
+
+
+class ReadWriteLock:
+    """Lets any number of readers or a single writer in at a time
+
+    Waiting writers block new readers, so a steady stream of reads cannot starve
+    a write. Both sides are reentrant: a thread holding the lock for reading can
+    read again, and a thread holding it for writing can read or write again.
+    Upgrading a read to a write is not possible and raises RuntimeError.
+    """
+    def __init__(self):
+        self.__condition = threading.Condition(threading.Lock())
+        self.__readers = 0
+        self.__writer = None
+        self.__write_depth = 0
+        self.__waiting_writers = 0
+        self.__local = threading.local()
+
+    def __read_depth(self):
+        return getattr(self.__local, 'depth', 0)
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        if self.__writer == me or self.__read_depth() > 0:
+            self.__local.depth = self.__read_depth() + 1
+            if self.__writer != me:
+                with self.__condition:
+                    self.__readers += 1
+            return
+        with self.__condition:
+            while self.__writer is not None or self.__waiting_writers > 0:
+                self.__condition.wait()
+            self.__readers += 1
+        self.__local.depth = 1
+
+    def release_read(self):
+        self.__local.depth = self.__read_depth() - 1
+        if self.__writer == threading.get_ident():
+            return
+        with self.__condition:
+            self.__readers -= 1
+            if self.__readers == 0:
+                self.__condition.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        if self.__writer == me:
+            self.__write_depth += 1
+            return
+        if self.__read_depth() > 0:
+            raise RuntimeError('Cannot upgrade a read lock to a write lock')
+        with self.__condition:
+            self.__waiting_writers += 1
+            while self.__writer is not None or self.__readers > 0:
+                self.__condition.wait()
+            self.__waiting_writers -= 1
+            self.__writer = me
+            self.__write_depth = 1
+
+    def release_write(self):
+        self.__write_depth -= 1
+        if self.__write_depth > 0:
+            return
+        with self.__condition:
+            self.__writer = None
+            self.__condition.notify_all()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+def read_locked(method):
+    """ Run a method while holding self.lock for reading """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock.read():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def write_locked(method):
+    """ Run a method while holding self.lock for writing """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock.write():
+            return method(self, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,53 @@
+""" Provides a bounded cache of transaction signatures that were already verified """
+
+import threading
+from collections import OrderedDict
+
+# Number of verified transaction digests kept in memory
+SIGNATURE_CACHE_SIZE = 100000
+
+
+class SignatureCache:
+    """Remembers the digests of transactions whose signature was verified successfully
+
+    Only valid signatures are stored, the least recently used digest is evicted
+    once max_size is reached. It is shared by all threads of a node and locks itself.
+
+    Attributes:
+        :max_size: The maximum number of digests kept
+        :hits: Number of lookups that found a verified digest
+        :misses: Number of lookups that had to fall back to RSA verification
+    """
+    def __init__(self, max_size=SIGNATURE_CACHE_SIZE):
+        self.max_size = max_size
+        self.__digests = OrderedDict()
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.__digests)
+
+    def contains(self, digest) -> bool:
+        with self.__lock:
+            if digest in self.__digests:
+                self.__digests.move_to_end(digest)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, digest):
+        with self.__lock:
+            self.__digests[digest] = True
+            self.__digests.move_to_end(digest)
+            if len(self.__digests) > self.max_size:
+                self.__digests.popitem(last=False)
+
+    def discard(self, digest):
+        with self.__lock:
+            self.__digests.pop(digest, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__digests.clear()
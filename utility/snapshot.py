@@ -0,0 +1,142 @@
+""" Provides checkpoints of the node state so a restart does not depend on the chain length """
+
+import hashlib as hl
+import json
+import math
+import os
+import time
+from typing import Optional
+from utility.balance_index import BalanceIndex
+from utility.storage import atomic_write
+
+SNAPSHOT_VERSION = 1
+# Number of snapshot files kept, older ones are deleted
+KEEP_SNAPSHOTS = 3
+
+
+class SnapshotStore:
+    """Keeps the latest snapshots of a node in blockchain-<node_id>/snapshots/
+
+    A snapshot holds the balance totals and the open transactions as they were
+    with height blocks in the chain, together with the hash of the last of those
+    blocks. It carries a checksum over its content and is only used while the
+    block it was taken at is still part of the chain.
+
+    Opened read_only, the folder is not created and write must not be called,
+    so the snapshots of a running node can be inspected.
+
+    Attributes:
+        :directory: The folder holding the snapshot files
+        :keep: Number of snapshots kept
+    """
+    def __init__(self, data_directory, keep=KEEP_SNAPSHOTS, read_only=False):
+        self.directory = os.path.join(data_directory, 'snapshots')
+        self.keep = keep
+        if not read_only:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def __path(self, height):
+        return os.path.join(self.directory, 'snapshot-{:010d}.json'.format(height))
+
+    @staticmethod
+    def checksum(snapshot) -> str:
+        """ Hash everything except the checksum itself """
+        content = {key: value for key, value in snapshot.items() if key != 'checksum'}
+        return hl.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def heights(self) -> list[int]:
+        """ Return the heights of all stored snapshots, oldest first """
+        heights = []
+        if not os.path.isdir(self.directory):
+            return heights
+        for name in os.listdir(self.directory):
+            if name.startswith('snapshot-') and name.endswith('.json'):
+                heights.append(int(name[9:-5]))
+        return sorted(heights)
+
+    def write(self, height, tip_hash, balances, open_transactions) -> str:
+        """ Store a snapshot and drop the oldest ones beyond keep
+
+            Arguments:
+                :height: The number of blocks the state covers
+                :tip_hash: The hash of the last of those blocks
+                :balances: BalanceIndex.to_dict() of the state
+                :open_transactions: The open transactions as dicts
+            :return: the path of the snapshot file
+        """
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'height': height,
+            'hash': tip_hash,
+            'created': time.time(),
+            'balances': balances,
+            'open_transactions': open_transactions,
+        }
+        snapshot['checksum'] = self.checksum(snapshot)
+        path = self.__path(height)
+        atomic_write(path, json.dumps(snapshot))
+        for old_height in self.heights()[:-self.keep]:
+            os.remove(self.__path(old_height))
+        return path
+
+    def load(self, height) -> Optional[dict]:
+        """ Read one snapshot, None if it is missing or not valid JSON """
+        try:
+            with open(self.__path(height), mode='r') as file:
+                return json.loads(file.read())
+        except (IOError, ValueError):
+            return None
+
+    def describe(self, chain) -> list[dict]:
+        """ Return height, tip hash, creation time and validity for chain of every stored snapshot, oldest first """
+        snapshots = []
+        for height in self.heights():
+            snapshot = self.load(height)
+            snapshots.append({
+                'height': height,
+                'hash': snapshot.get('hash') if snapshot is not None else None,
+                'created': snapshot.get('created') if snapshot is not None else None,
+                'valid': snapshot is not None and self.is_valid(snapshot, chain),
+            })
+        return snapshots
+
+    def is_valid(self, snapshot, chain) -> bool:
+        """ Check the checksum of a snapshot and that the block it was taken at is part of chain
+
+            Arguments:
+                :snapshot: The loaded snapshot
+                :chain: The LazyChain (or read-only ChainView) the snapshot should belong to
+        """
+        try:
+            if snapshot['version'] != SNAPSHOT_VERSION or snapshot['checksum'] != self.checksum(snapshot):
+                return False
+            height = snapshot['height']
+            return 0 < height <= len(chain) and chain.hash_at(height - 1) == snapshot['hash']
+        except (KeyError, TypeError):
+            return False
+
+    def latest_valid(self, chain) -> Optional[dict]:
+        """ Return the newest snapshot which is valid for chain, None if there is none """
+        for height in reversed(self.heights()):
+            snapshot = self.load(height)
+            if snapshot is not None and self.is_valid(snapshot, chain):
+                return snapshot
+        return None
+
+    def verify(self, snapshot, chain, deep=False) -> bool:
+        """ is_valid, and with deep also recompute the balances from the chain and compare them
+
+            The open transactions cannot be checked against the chain, only their checksum is.
+        """
+        if not self.is_valid(snapshot, chain):
+            return False
+        if not deep:
+            return True
+        balances = BalanceIndex()
+        for block in chain.iter_blocks(0):
+            if block.index >= snapshot['height']:
+                break
+            balances.add_block(block)
+        stored = BalanceIndex.from_dict(snapshot['balances'])
+        participants = set(balances.sent) | set(balances.received) | set(stored.sent) | set(stored.received)
+        return all(math.isclose(balances.get_balance(participant), stored.get_balance(participant), abs_tol=1e-9) for participant in participants)
@@ -0,0 +1,429 @@
+""" Provides append-only, segmented persistence for the blockchain """
+
+import json
+import logging
+import os
+import struct
+from block import Block
+from transaction import Transaction
+from utility import codec
+from utility.hash_util import hash_block
+
+logger = logging.getLogger(__name__)
+
+# Number of blocks stored in one segment file
+BLOCKS_PER_SEGMENT = 1000
+# Number of appended blocks after which the segment is fsynced to disk
+SYNC_EVERY = 8
+# Length prefix of a record in a binary segment
+_RECORD_LENGTH = struct.Struct('>I')
+# One entry of headers.idx: hash, previous hash, timestamp, proof, transaction count, segment, offset, length
+_HEADER_RECORD = struct.Struct('>32s32sdqIIQI')
+
+
+def atomic_write(path, content):
+    """ Write a file so that readers either see the old or the new content, never a partial one
+
+        Arguments:
+            :path: The file to replace
+            :content: The string or bytes to write
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, mode='wb' if isinstance(content, bytes) else 'w') as file:
+        file.write(content)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+class BlockHeader:
+    """Everything about a stored block except its transactions
+
+    Attributes:
+        :index: The height of the block
+        :hash: The hash of the block
+        :previous_hash: The hash of the block before it ('' for the genesis block)
+        :timestamp: The timestamp of the block
+        :proof: The proof of work of the block
+        :transaction_count: The number of transactions in the block
+        :segment: The segment file holding the block record
+        :offset: Where the record starts in the segment, including its length prefix
+        :length: The length of the encoded block
+    """
+    __slots__ = ('index', 'hash', 'previous_hash', 'timestamp', 'proof', 'transaction_count', 'segment', 'offset', 'length')
+
+    def __init__(self, index, hash, previous_hash, timestamp, proof, transaction_count, segment, offset, length):
+        self.index = index
+        self.hash = hash
+        self.previous_hash = previous_hash
+        self.timestamp = timestamp
+        self.proof = proof
+        self.transaction_count = transaction_count
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+
+    def to_dict(self) -> dict:
+        return {
+            'index': self.index,
+            'hash': self.hash,
+            'previous_hash': self.previous_hash,
+            'timestamp': self.timestamp,
+            'proof': self.proof,
+            'transaction_count': self.transaction_count,
+        }
+
+    def pack(self) -> bytes:
+        previous_hash = bytes.fromhex(self.previous_hash) if self.previous_hash else bytes(32)
+        return _HEADER_RECORD.pack(bytes.fromhex(self.hash), previous_hash, self.timestamp, self.proof, self.transaction_count, self.segment, self.offset, self.length)
+
+    @classmethod
+    def unpack(cls, index, content, position=0) -> 'BlockHeader':
+        block_hash, previous_hash, timestamp, proof, transaction_count, segment, offset, length = _HEADER_RECORD.unpack_from(content, position)
+        return cls(index, block_hash.hex(), previous_hash.hex() if any(previous_hash) else '', timestamp, proof, transaction_count, segment, offset, length)
+
+
+class ChainStorage:
+    """Stores every block as one record appended to segment files
+
+    The mempool and the peer nodes are kept in their own small files, so adding
+    a transaction or a peer never rewrites the chain. Changes of the mempool are
+    appended to mempool.log and folded into mempool.json from time to time, so
+    adding a transaction does not rewrite the whole mempool either.
+    headers.idx holds a fixed size BlockHeader per block, so the chain can be
+    opened without decoding a single block and any block can be read with one seek.
+
+    Layout of blockchain-<node_id>/:
+        chain-00000.log, chain-00001.log, ...  one JSON block per line (record_format 'json')
+        chain-00000.bin, chain-00001.bin, ...  length prefixed utility.codec blocks (record_format 'binary')
+        headers.idx                            one BlockHeader per block
+        transactions.idx, addresses.idx        secondary indexes in block order, see utility/block_index.py
+        transactions.sorted.idx, ...           the same entries sorted for lookups
+        snapshots/                             state snapshots, see utility/snapshot.py
+        mempool.json                           the open transactions when the mempool was last saved as a whole
+        mempool.log                            one JSON line per transaction added or removed since then
+        peers.json                             the peer nodes
+
+    record_format only applies to a new directory, existing segments keep their format.
+    Opened read_only, the directory has to exist and nothing is written to it, not
+    even the repairs load_headers does after a crash, so the data of a running node
+    can be read. Only load_headers and read_block may be used then.
+    """
+    def __init__(self, node_id, blocks_per_segment=BLOCKS_PER_SEGMENT, sync_every=SYNC_EVERY, record_format='json', read_only=False):
+        self.node_id = node_id
+        self.directory = 'blockchain-{}'.format(node_id)
+        self.blocks_per_segment = blocks_per_segment
+        self.sync_every = sync_every
+        self.__headers = []
+        self.__segment_file = None
+        self.__segment_number = None
+        self.__header_file = None
+        self.__unsynced = 0
+        self.__mempool_log = None
+        self.__mempool_unsynced = 0
+        # Number of records in mempool.log, used to decide when to compact it
+        self.mempool_log_records = 0
+        self.read_only = read_only
+        if read_only:
+            if not os.path.isdir(self.directory):
+                raise FileNotFoundError('No data directory {}'.format(self.directory))
+        else:
+            os.makedirs(self.directory, exist_ok=True)
+        self.record_format = record_format
+        for name in os.listdir(self.directory):
+            if name.startswith('chain-') and name.endswith('.log'):
+                self.record_format = 'json'
+            elif name.startswith('chain-') and name.endswith('.bin'):
+                self.record_format = 'binary'
+        self.__extension = '.bin' if self.record_format == 'binary' else '.log'
+        # Bytes before and after the encoded block in a segment
+        self.__prefix_length = _RECORD_LENGTH.size if self.record_format == 'binary' else 0
+        self.__suffix = b'' if self.record_format == 'binary' else b'\n'
+        self.__header_path = os.path.join(self.directory, 'headers.idx')
+        self.__mempool_log_path = os.path.join(self.directory, 'mempool.log')
+
+    def __segment_path(self, number):
+        return os.path.join(self.directory, 'chain-{:05d}{}'.format(number, self.__extension))
+
+    def __segment_numbers(self):
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.startswith('chain-') and name.endswith(self.__extension):
+                numbers.append(int(name[6:-4]))
+        return sorted(numbers)
+
+    def __encode_record(self, block) -> bytes:
+        if self.record_format == 'binary':
+            return codec.encode_block(block)
+        return json.dumps(block.to_dict()).encode()
+
+    def __frame(self, record) -> bytes:
+        """ Add the record separator, a length prefix for binary and a newline for JSON segments """
+        if self.record_format == 'binary':
+            return _RECORD_LENGTH.pack(len(record)) + record
+        return record + self.__suffix
+
+    def __split_records(self, content, start=0):
+        """ Find the complete records of a segment from byte start on
+
+            :return: (list of (offset, length) per record, end of the last complete record)
+        """
+        records = []
+        offset = start
+        if self.record_format == 'binary':
+            while offset + _RECORD_LENGTH.size <= len(content):
+                length = _RECORD_LENGTH.unpack_from(content, offset)[0]
+                end = offset + _RECORD_LENGTH.size + length
+                if end > len(content):
+                    break
+                records.append((offset, length))
+                offset = end
+            return records, offset
+        while True:
+            end = content.find(b'\n', offset)
+            # A record without its newline is a torn write
+            if end < 0:
+                return records, offset
+            records.append((offset, end - offset))
+            offset = end + 1
+
+    def __decode_record(self, record) -> Block:
+        if self.record_format == 'binary':
+            return codec.decode_block(record)
+        return Block.from_dict(json.loads(record))
+
+    def __end_of(self, header):
+        return header.offset + self.__prefix_length + header.length + len(self.__suffix)
+
+    def has_chain(self):
+        return len(self.__segment_numbers()) > 0
+
+    def load_headers(self) -> list:
+        """ Read headers.idx and return one BlockHeader per stored block
+
+            Only the records written after the last complete header are decoded, which
+            happens after a crash between the two writes or for a directory from before
+            headers.idx existed. A torn record at the end of the last segment is
+            dropped and cut off the file.
+        """
+        self.close()
+        headers = []
+        try:
+            with open(self.__header_path, mode='rb') as file:
+                header_content = file.read()
+        except IOError:
+            header_content = b''
+        for index in range(len(header_content) // _HEADER_RECORD.size):
+            headers.append(BlockHeader.unpack(index, header_content, index * _HEADER_RECORD.size))
+
+        numbers = self.__segment_numbers()
+        segment_sizes = {number: os.path.getsize(self.__segment_path(number)) for number in numbers}
+        # Headers of records that never made it to disk
+        while len(headers) > 0 and self.__end_of(headers[-1]) > segment_sizes.get(headers[-1].segment, -1):
+            headers.pop()
+        rewrite_headers = len(header_content) != len(headers) * _HEADER_RECORD.size or not os.path.exists(self.__header_path)
+
+        resume_segment, resume_offset = (headers[-1].segment, self.__end_of(headers[-1])) if headers else (0, 0)
+        for number in numbers:
+            if number < resume_segment:
+                continue
+            path = self.__segment_path(number)
+            with open(path, mode='rb') as file:
+                content = file.read()
+            records, complete_length = self.__split_records(content, resume_offset if number == resume_segment else 0)
+            for offset, length in records:
+                record_start = offset + self.__prefix_length
+                block = self.__decode_record(content[record_start:record_start + length])
+                headers.append(BlockHeader(len(headers), hash_block(block), block.previous_hash, block.timestamp, block.proof, len(block.transactions), number, offset, length))
+                rewrite_headers = True
+            if complete_length != len(content):
+                if number != numbers[-1]:
+                    raise ValueError('Corrupt segment {}'.format(path))
+                # Read only, the record may still be being written by the node
+                if not self.read_only:
+                    logger.warning('Dropping incomplete block record in %s', path)
+                    atomic_write(path, content[:complete_length])
+
+        if rewrite_headers and not self.read_only:
+            atomic_write(self.__header_path, b''.join(header.pack() for header in headers))
+        self.__headers = headers
+        return headers[:]
+
+    def load_chain(self) -> list[Block]:
+        """ Read and decode every stored block, use load_headers and read_block to read them on demand """
+        return [self.read_block(header) for header in self.load_headers()]
+
+    def read_block(self, header) -> Block:
+        """ Read the block a header points to with a single seek """
+        with open(self.__segment_path(header.segment), mode='rb') as file:
+            file.seek(header.offset + self.__prefix_length)
+            return self.__decode_record(file.read(header.length))
+
+    def load_open_transactions(self):
+        """ Return the stored open transactions, mempool.json with the changes in mempool.log replayed on top
+
+            :return: list of transaction dicts, None if mempool.json is missing or unreadable (the log only makes sense on top of it)
+        """
+        open_transactions = self.__load_json('mempool.json', None)
+        records = self.__read_mempool_log()
+        self.mempool_log_records = len(records)
+        if open_transactions is None or not records:
+            return open_transactions
+        transactions = {Transaction.from_dict(tx).transaction_id: tx for tx in open_transactions}
+        for record in records:
+            if 'add' in record:
+                transactions.setdefault(Transaction.from_dict(record['add']).transaction_id, record['add'])
+            else:
+                transactions.pop(record['remove'], None)
+        return list(transactions.values())
+
+    def __read_mempool_log(self) -> list:
+        records = []
+        try:
+            with open(self.__mempool_log_path, mode='r') as file:
+                for line in file:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # A line torn by a crash can only be the last one
+                        break
+        except IOError:
+            pass
+        return records
+
+    def load_peer_nodes(self):
+        return self.__load_json('peers.json', [])
+
+    def __load_json(self, name, default):
+        try:
+            with open(os.path.join(self.directory, name), mode='r') as file:
+                return json.loads(file.read())
+        except (IOError, ValueError):
+            return default
+
+    def append_block(self, block) -> BlockHeader:
+        """ Append one block record to the current segment and its header to headers.idx
+
+            The files are fsynced every sync_every blocks, call sync() to force it.
+            :return: the BlockHeader of the stored block
+        """
+        number = len(self.__headers) // self.blocks_per_segment
+        if self.__segment_file is None or self.__segment_number != number:
+            self.close()
+            self.__segment_file = open(self.__segment_path(number), mode='ab')
+            self.__header_file = open(self.__header_path, mode='ab')
+            self.__segment_number = number
+        record = self.__encode_record(block)
+        header = BlockHeader(len(self.__headers), hash_block(block), block.previous_hash, block.timestamp, block.proof, len(block.transactions), number, self.__segment_file.tell(), len(record))
+        self.__segment_file.write(self.__frame(record))
+        self.__segment_file.flush()
+        # The header goes second, a header without its record is dropped by load_headers
+        self.__header_file.write(header.pack())
+        self.__header_file.flush()
+        self.__headers.append(header)
+        self.__unsynced += 1
+        if self.__unsynced >= self.sync_every:
+            self.sync()
+        return header
+
+    def truncate(self, height):
+        """ Drop every stored block with an index of height or above
+
+            Arguments:
+                :height: The number of blocks to keep
+        """
+        self.close()
+        if height >= len(self.__headers):
+            return
+        first_dropped = self.__headers[height]
+        for number in self.__segment_numbers():
+            if number > first_dropped.segment:
+                os.remove(self.__segment_path(number))
+        os.truncate(self.__segment_path(first_dropped.segment), first_dropped.offset)
+        os.truncate(self.__header_path, height * _HEADER_RECORD.size)
+        del self.__headers[height:]
+
+    def save_open_transactions(self, open_transactions):
+        """ Replace mempool.json with all open transactions and start an empty mempool.log
+
+            mempool.json is written first, replaying the old log on top of it again
+            (a crash before the log is removed) gives the same transactions.
+        """
+        atomic_write(os.path.join(self.directory, 'mempool.json'), json.dumps([tx.to_dict() for tx in open_transactions]))
+        self.__close_mempool_log()
+        if os.path.exists(self.__mempool_log_path):
+            os.remove(self.__mempool_log_path)
+        self.mempool_log_records = 0
+
+    def append_open_transaction_changes(self, changes):
+        """ Append the changes of Mempool.take_changes() to mempool.log
+
+            The log is fsynced every sync_every records, call sync() to force it.
+        """
+        if self.__mempool_log is None:
+            self.__mempool_log = open(self.__mempool_log_path, mode='a')
+        lines = []
+        for action, value in changes:
+            record = {'add': value.to_dict()} if action == 'add' else {'remove': value}
+            lines.append(json.dumps(record) + '\n')
+        self.__mempool_log.write(''.join(lines))
+        self.__mempool_log.flush()
+        self.mempool_log_records += len(lines)
+        self.__mempool_unsynced += len(lines)
+        if self.__mempool_unsynced >= self.sync_every:
+            os.fsync(self.__mempool_log.fileno())
+            self.__mempool_unsynced = 0
+
+    def __close_mempool_log(self):
+        if self.__mempool_log is not None:
+            if self.__mempool_unsynced > 0:
+                os.fsync(self.__mempool_log.fileno())
+            self.__mempool_log.close()
+        self.__mempool_log = None
+        self.__mempool_unsynced = 0
+
+    def save_peer_nodes(self, peer_nodes):
+        atomic_write(os.path.join(self.directory, 'peers.json'), json.dumps(list(peer_nodes)))
+
+    def sync(self):
+        if self.__segment_file is not None and self.__unsynced > 0:
+            os.fsync(self.__segment_file.fileno())
+            os.fsync(self.__header_file.fileno())
+        self.__unsynced = 0
+        if self.__mempool_log is not None and self.__mempool_unsynced > 0:
+            os.fsync(self.__mempool_log.fileno())
+        self.__mempool_unsynced = 0
+
+    def close(self):
+        if self.__segment_file is not None:
+            self.sync()
+            self.__segment_file.close()
+            self.__header_file.close()
+        self.__segment_file = None
+        self.__header_file = None
+        self.__segment_number = None
+        self.__close_mempool_log()
+
+    def migrate_legacy_file(self):
+        """ One-time import of the old three line blockchain-<node_id>.txt format
+
+            The old file is renamed to blockchain-<node_id>.txt.migrated afterwards.
+            :return: bool whether a legacy file was migrated
+        """
+        legacy_path = 'blockchain-{}.txt'.format(self.node_id)
+        if self.has_chain() or not os.path.exists(legacy_path):
+            return False
+        with open(legacy_path, mode='r') as file:
+            file_content = file.readlines()
+        blockchain = json.loads(file_content[0])
+        open_transactions = json.loads(file_content[1]) if len(file_content) > 1 else []
+        peer_nodes = json.loads(file_content[2]) if len(file_content) > 2 else []
+        # Start from an empty header index, a stale one may be left from an earlier attempt
+        self.load_headers()
+        for block in blockchain:
+            self.append_block(Block.from_dict(block))
+        self.close()
+        atomic_write(os.path.join(self.directory, 'mempool.json'), json.dumps(open_transactions))
+        atomic_write(os.path.join(self.directory, 'peers.json'), json.dumps(peer_nodes))
+        os.replace(legacy_path, legacy_path + '.migrated')
+        return True
@@ -0,0 +1,61 @@
+""" Provides a persistent transaction id -> (height, position) index """
+
+import struct
+from typing import Optional
+from utility.block_index import BlockIndex
+
+
+class TransactionIndex(BlockIndex):
+    """Finds the block and position of every confirmed transaction without a scan
+
+    A transaction id found in several blocks (mining rewards to the same key are
+    identical) points at the first of them. The sorted file orders the entries
+    by transaction id, then height, so the first entry of an id is that one.
+    """
+    # height, transaction id, position in the block
+    ENTRY = struct.Struct('>Q32sI')
+    FILE_NAME = 'transactions.idx'
+    # transaction id, height, position in the block
+    SORTED_ENTRY = struct.Struct('>32sQI')
+    SORTED_FIELDS = (1, 0, 2)
+    SORTED_FILE_NAME = 'transactions.sorted.idx'
+
+    def __init__(self, directory):
+        # Locations of the transactions added since the last merge
+        self.__recent = {}
+        super().__init__(directory)
+
+    def __contains__(self, transaction_id):
+        return self.locate(transaction_id) is not None
+
+    def _clear(self):
+        self.__recent = {}
+
+    def _block_entries(self, block):
+        return [(block.index, bytes.fromhex(tx.transaction_id), position) for position, tx in enumerate(block.transactions)]
+
+    def _add_entry(self, entry):
+        height, transaction_id, position = entry
+        self.__recent.setdefault(transaction_id.hex(), (height, position))
+
+    def _remove_entry(self, entry):
+        height, transaction_id, position = entry
+        # Keep the location if the transaction was first confirmed in an earlier block
+        if self.__recent.get(transaction_id.hex()) == (height, position):
+            del self.__recent[transaction_id.hex()]
+
+    def locate(self, transaction_id) -> Optional[tuple]:
+        """ Return (height, position) of a confirmed transaction, None if it is not in the chain """
+        try:
+            key = bytes.fromhex(transaction_id)
+        except ValueError:
+            return None
+        # A shorter key would match the ids starting with it
+        if len(key) != 32:
+            return None
+        # Merged entries belong to older blocks than the recent ones
+        start = self._merged_bisect(key)
+        for height, merged_id, position in self._merged_entries(start, start + 1):
+            if merged_id == key:
+                return height, position
+        return self.__recent.get(key.hex())
@@ -1,27 +1,112 @@
 """ Provides verification helper methods """
 
-from utility.hash_util import hash_string_256, hash_block
+import hashlib as hl
+import logging
+from utility.hash_util import hash_block
+from utility import codec
 from transaction import Transaction
 from wallet import Wallet
+
+logger = logging.getLogger(__name__)
+
+
 class Verification:
 
     @classmethod
-    def verify_chain(cls, blockchain) -> bool:
+    def verify_chain(cls, blockchain, start_height=0, checkpoint_hash=None) -> bool:
         """
         A helper class which offers various static and class based verification methods
+        Blocks below start_height (or up to the block hashing to checkpoint_hash) are trusted and skipped
+        :param blockchain:
+        :param start_height: number of leading blocks known to be valid
+        :param checkpoint_hash: hash of the last block known to be valid
         :return: bool
         """
+        if checkpoint_hash is not None:
+            start_height = cls.checkpoint_height(blockchain, checkpoint_hash)
+            if start_height is None:
+                return False
         # enumerate: give you back a tuple with two pieces of info - index:element
-        for (index, block) in enumerate(blockchain):
+        for (index, block) in enumerate(blockchain[start_height:], start_height):
             if index == 0:
                 continue
             if block.previous_hash != hash_block(blockchain[index - 1]):
                 return False
             if not cls.valid_proof(block.transactions[:-1], block.previous_hash, block.proof):
-                print('Proof of work is invalid')
+                logger.warning('Proof of work of block %s is invalid', index)
                 return False
         return True
 
+    @staticmethod
+    def valid_block_fields(block, height) -> bool:
+        """
+        Check that a block received from a peer can be stored at height
+        Storage packs the previous hash as a sha256 digest and the index, proof and timestamp as numbers,
+        the indexes pack every amount as a number, so a block failing this would be stored only in part
+        :param block: The block to check
+        :param height: The height the block would be stored at
+        :return: bool
+        """
+        if isinstance(block.index, bool) or block.index != height:
+            return False
+        if isinstance(block.proof, bool) or not isinstance(block.proof, int) or not 0 <= block.proof < 2 ** 63:
+            return False
+        if isinstance(block.timestamp, bool) or not isinstance(block.timestamp, (int, float)):
+            return False
+        if not isinstance(block.previous_hash, str) or len(block.previous_hash) != 64:
+            return False
+        try:
+            bytes.fromhex(block.previous_hash)
+        except ValueError:
+            return False
+        return all(Verification.valid_transaction_fields(tx) for tx in block.transactions)
+
+    @staticmethod
+    def valid_transaction_fields(transaction: Transaction) -> bool:
+        """
+        Check that the fields of a transaction have the types storage and the indexes can encode
+        :param transaction: The transaction to check
+        :return: bool
+        """
+        if not all(codec.encodable_str(value) for value in (transaction.sender, transaction.recipient, transaction.signature)):
+            return False
+        amount = transaction.amount
+        if isinstance(amount, bool) or not isinstance(amount, (int, float)):
+            return False
+        # The codec stores ints in 8 bytes
+        return not isinstance(amount, int) or -2 ** 63 <= amount < 2 ** 63
+
+    @staticmethod
+    def checkpoint_height(blockchain, checkpoint_hash):
+        """
+        Find the number of blocks up to and including the block with the given hash
+        Walks back from the tip comparing stored previous hashes, so only the suffix is touched
+        :return: int or None if no block has that hash
+        """
+        for index in range(len(blockchain) - 1, 0, -1):
+            if blockchain[index].previous_hash == checkpoint_hash:
+                return index
+        if len(blockchain) > 0 and hash_block(blockchain[-1]) == checkpoint_hash:
+            return len(blockchain)
+        return None
+
+    @staticmethod
+    def common_prefix_length(local_chain, other_chain) -> int:
+        """
+        Return how many leading blocks other_chain shares with local_chain
+        Uses a binary search over the previous hashes of other_chain, local block hashes are memoized
+        :return: int
+        """
+        low, high = 0, min(len(local_chain), len(other_chain) - 1)
+        # Invariant: the first `low` blocks are shared
+        while low < high:
+            middle = (low + high + 1) // 2
+            if other_chain[middle].previous_hash == hash_block(local_chain[middle - 1]):
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
     @staticmethod
     def verify_transaction(transaction: Transaction, get_balance, check_funds=True):
         if check_funds:
@@ -36,7 +121,7 @@ class Verification:
         Verifies all open transactions
         :return: bool
         """
-        return all([cls.verify_transaction(tx, get_balance, False) for tx in open_transactions])
+        return Wallet.verify_transactions(open_transactions)
 
     @staticmethod
     def valid_proof(transactions: list, last_hash: str, proof: int) -> bool:
@@ -47,6 +132,37 @@ class Verification:
         :param proof:
         :return: bool
         """
-        guess = (str([tx.to_ordered_dict() for tx in transactions]) + str(last_hash) + str(proof)).encode()
-        guess_hash = hash_string_256(guess)
-        return guess_hash[0:2] == '00'
\ No newline at end of file
+        return Verification.valid_proof_from(Verification.proof_hasher(transactions, last_hash), proof)
+
+    @staticmethod
+    def proof_prefix(transactions: list, last_hash: str) -> bytes:
+        """
+        Build the part of the proof of work guess that does not depend on the proof
+        :param transactions:
+        :param last_hash:
+        :return: bytes
+        """
+        return (str([tx.to_ordered_dict() for tx in transactions]) + str(last_hash)).encode()
+
+    @staticmethod
+    def proof_hasher(transactions: list, last_hash: str):
+        """
+        Hash the proof prefix once, the returned sha256 object is the midstate valid_proof_from copies for every guess
+        :param transactions:
+        :param last_hash:
+        :return: hashlib sha256 object
+        """
+        return hl.sha256(Verification.proof_prefix(transactions, last_hash))
+
+    @staticmethod
+    def valid_proof_from(hasher, proof: int) -> bool:
+        """
+        Validate a proof against a precomputed proof_hasher midstate
+        :param hasher:
+        :param proof:
+        :return: bool
+        """
+        guess_hash = hasher.copy()
+        guess_hash.update(str(proof).encode())
+        # hexdigest()[0:2] == '00' is the same as a zero first byte
+        return guess_hash.digest()[0] == 0
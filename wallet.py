@@ -1,11 +1,87 @@
+import functools
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from typing import Optional
 from Crypto.PublicKey import RSA
 from Crypto.Signature import PKCS1_v1_5
 from Crypto.Hash import SHA256
 import Crypto.Random
 import binascii
+from utility.signature_cache import SignatureCache
+from utility.process_pool import pool_context, exit_with_parent
+from utility import metrics
+
+logger = logging.getLogger(__name__)
+
+# Batches with at least this many transactions are verified in a process pool
+PARALLEL_VERIFY_THRESHOLD = 2048
+# Number of parsed public keys kept in memory
+PUBLIC_KEY_CACHE_SIZE = 1024
+
+VERIFY_SECONDS = metrics.timer('wallet_verify_transaction_seconds', 'Time spent in Wallet.verify_transaction, by whether the signature cache answered', ['source'])
+VERIFY_BATCH_SECONDS = metrics.timer('wallet_verify_transactions_seconds', 'Time spent verifying batches of transactions in Wallet.verify_transactions')
+RSA_CHECKS = metrics.counter('wallet_rsa_verifications_total', 'Signatures handed to RSA verification by Wallet.verify_transactions')
+# The signature cache counts for itself, its numbers are read when /metrics is requested
+metrics.counter('wallet_signature_cache_hits_total', 'Signature checks answered by the signature cache', function=lambda: Wallet.signature_cache.hits)
+metrics.counter('wallet_signature_cache_misses_total', 'Signature checks the signature cache could not answer', function=lambda: Wallet.signature_cache.misses)
+metrics.gauge('wallet_signature_cache_size', 'Verified signatures in the signature cache', function=lambda: len(Wallet.signature_cache))
+
+
+@functools.lru_cache(maxsize=PUBLIC_KEY_CACHE_SIZE)
+def _import_public_key(public_key):
+    """Parse a hex encoded DER public key, the same senders sign over and over so results are cached"""
+    return RSA.importKey(binascii.unhexlify(public_key))
+
+
+def _verify_chunk(transactions):
+    return all(Wallet._verify_signature(tx) for tx in transactions)
+
+
+# Process pools of the parallel signature checks by number of workers, started on first use and kept
+_verify_pools = {}
+_verify_pools_lock = threading.Lock()
+
+
+def _verify_pool(workers) -> ProcessPoolExecutor:
+    with _verify_pools_lock:
+        pool = _verify_pools.get(workers)
+        if pool is None:
+            pool = _verify_pools[workers] = ProcessPoolExecutor(workers, mp_context=pool_context(), initializer=exit_with_parent)
+        return pool
+
+
+def _verify_parallel(transactions, workers) -> Optional[bool]:
+    """ Verify the signatures in chunks on the worker pool
+
+        :return: whether all are valid, None if the pool broke (a worker process died)
+    """
+    chunk_size = -(-len(transactions) // (workers * 4))
+    chunks = [transactions[i:i + chunk_size] for i in range(0, len(transactions), chunk_size)]
+    pool = _verify_pool(workers)
+    futures = []
+    try:
+        futures = [pool.submit(_verify_chunk, chunk) for chunk in chunks]
+        return all(future.result() for future in as_completed(futures))
+    except BrokenProcessPool:
+        with _verify_pools_lock:
+            if _verify_pools.get(workers) is pool:
+                del _verify_pools[workers]
+        logger.warning('Signature verification pool broke, verifying in this process')
+        return None
+    finally:
+        # Chunks not started yet are skipped once one of them was invalid
+        for future in futures:
+            future.cancel()
+
 
 class Wallet:
+    # Shared by every verification path, see utility/signature_cache.py
+    signature_cache = SignatureCache()
+
     def __init__(self, node_id):
 
         self.private_key = None
@@ -27,7 +103,7 @@ class Wallet:
                 self.private_key = private_key
             return True
         except (IOError, IndexError):
-            print('Loading wallet failed')
+            logger.warning('Loading wallet-%s.txt failed', self.node_id)
             return False
 
     def save_keys(self)-> Optional[bool]:
@@ -39,7 +115,7 @@ class Wallet:
                     file.write(self.private_key)
                 return True
             except (IOError, IndexError):
-                print('Saving wallet failed')
+                logger.error('Saving wallet-%s.txt failed', self.node_id)
                 return False
         return None
 
@@ -64,10 +140,60 @@ class Wallet:
         Arguments:
             :transaction (Transaction): transaction to verify
         """
-        public_key = RSA.importKey(binascii.unhexlify(transaction.sender))
+        start = time.perf_counter()
+        digest = transaction.transaction_id
+        if Wallet.signature_cache.contains(digest):
+            VERIFY_SECONDS.labels('cache').observe(time.perf_counter() - start)
+            return True
+        valid = Wallet._verify_signature(transaction)
+        if valid:
+            Wallet.signature_cache.add(digest)
+        VERIFY_SECONDS.labels('rsa').observe(time.perf_counter() - start)
+        return valid
+
+    @staticmethod
+    def _verify_signature(transaction):
+        """Run the RSA signature check without consulting the signature cache"""
+        try:
+            public_key = _import_public_key(transaction.sender)
+            signature = binascii.unhexlify(transaction.signature)
+        except (ValueError, TypeError, IndexError):
+            # Not a hex encoded key or signature, only this transaction is invalid, not the whole batch
+            return False
 
         verifier = PKCS1_v1_5.new(public_key)
 
         h = SHA256.new((str(transaction.sender) + str(transaction.recipient) + str(transaction.amount)).encode('utf8'))
 
-        return verifier.verify(h, binascii.unhexlify(transaction.signature))
+        return verifier.verify(h, signature)
+
+    @staticmethod
+    def verify_transactions(transactions, workers=None):
+        """
+        Verify the signatures of a batch of transactions, stops at the first invalid one
+
+        Arguments:
+            :transactions (list[Transaction]): transactions to verify
+            :workers: number of processes used for large batches (default: all cores)
+        """
+        with VERIFY_BATCH_SECONDS.time():
+            return Wallet.__verify_batch(transactions, workers)
+
+    @staticmethod
+    def __verify_batch(transactions, workers):
+        # Signatures we already checked cost a lookup instead of an RSA operation
+        transactions = [tx for tx in transactions if not Wallet.signature_cache.contains(tx.transaction_id)]
+        RSA_CHECKS.inc(len(transactions))
+        if len(transactions) >= PARALLEL_VERIFY_THRESHOLD:
+            valid = _verify_parallel(transactions, workers or multiprocessing.cpu_count())
+            if valid is not None:
+                if valid:
+                    # The workers run in other processes, record the verified digests in our cache
+                    for tx in transactions:
+                        Wallet.signature_cache.add(tx.transaction_id)
+                return valid
+        for tx in transactions:
+            if not Wallet._verify_signature(tx):
+                return False
+            Wallet.signature_cache.add(tx.transaction_id)
+        return True